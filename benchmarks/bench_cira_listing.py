@@ -0,0 +1,97 @@
+"""
+Time to list the newest 60 frames from a large CIRA archive page: the old
+BeautifulSoup scrape of the whole page, the streaming LinkParser over the
+whole page and stopping at 60 links, and CiraListing.refresh over HTTP
+when the page changed (200) and when it didn't (304).
+
+Pass a saved copy of archive_hi_res.asp to use it instead of a synthetic
+page with `num_links` frames.
+
+    PYTHONPATH=. python -m benchmarks.bench_cira_listing [num_links] [page.asp]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks import standins
+from cira_listing import CiraListing, parse_links
+
+NUM = 60
+REPEATS = 5
+ROW = ('<tr><td class="date">{0}</td><td><a href="images/{1}">Hi-Res Image</a></td>'
+       '<td><a href="images/thumb_{1}">Thumbnail</a></td></tr>\n')
+
+
+def synthetic_page(num_links):
+    """An archive page shaped like CIRA's: a table row per frame, newest
+    first."""
+    rows = []
+    for i in reversed(range(num_links)):
+        name = 'full_disk_ahi_true_color_2016{0:010d}.jpg'.format(i)
+        rows.append(ROW.format(i, name))
+    return ('<html><head><title>Archive</title></head><body><table>\n' + ''.join(rows) +
+            '</table></body></html>\n').encode('utf-8')
+
+
+def best_of(func, repeats=REPEATS):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def chunks(page, size=16 * 1024):
+    return (page[i:i + size] for i in range(0, len(page), size))
+
+
+def main(num_links=20000, page_file=None):
+    if page_file:
+        with open(page_file, 'rb') as f:
+            page = f.read()
+    else:
+        page = synthetic_page(num_links)
+
+    results = {}
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        BeautifulSoup = None
+    if BeautifulSoup is not None:
+        results['bs4 scrape'] = best_of(lambda: BeautifulSoup(page, 'html.parser').find_all(
+            'a', string=re.compile('^Hi-Res Image'), limit=NUM))
+    results['stream, whole page'] = best_of(lambda: parse_links(chunks(page)))
+    results['stream, first {0}'.format(NUM)] = best_of(lambda: parse_links(chunks(page), NUM))
+
+    root = tempfile.mkdtemp()
+    http = None
+    try:
+        os.makedirs(os.path.join(root, 'cira'))
+        with open(os.path.join(root, 'cira', standins.CIRA_PAGE), 'wb') as f:
+            f.write(page)
+        http = standins.HttpStandin(root)
+        url = '{0}/cira/{1}'.format(http.url, standins.CIRA_PAGE)
+        results['refresh, 200'] = best_of(lambda: CiraListing(url).refresh(NUM))
+        listing = CiraListing(url)
+        listing.refresh(NUM)
+        results['refresh, 304'] = best_of(lambda: listing.refresh(NUM))
+    finally:
+        if http is not None:
+            http.close()
+        shutil.rmtree(root)
+
+    print("{0:.1f} KB page".format(len(page) / 1024.0))
+    for name, seconds in results.items():
+        print("{0:>20}: {1:8.2f} ms".format(name, seconds * 1000))
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(arg) if arg.isdigit() else arg for arg in sys.argv[1:]])
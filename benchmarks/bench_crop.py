@@ -0,0 +1,57 @@
+"""
+Compares cropping a 720x720 window by decoding the whole full disk frame
+against reading only the overlapping tiles from the tile cache.
+
+    PYTHONPATH=. python -m benchmarks.bench_crop [num_frames]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+import tiles
+from benchmarks.harness import measure, synthetic_frame
+
+BOX = (2000, 1500, 2720, 2220)
+
+
+def crop_full(frames):
+    for frame in frames:
+        Image.open(frame).crop(BOX).load()
+
+
+def crop_tiled(frames):
+    for frame in frames:
+        tiles.read_region(frame, BOX).load()
+
+
+def main(num_frames=5):
+    folder = tempfile.mkdtemp()
+    try:
+        frames = [synthetic_frame(os.path.join(folder, 'full_{0}.jpg'.format(i)), seed=i)
+                  for i in range(num_frames)]
+
+        start = time.time()
+        tiles.build_missing_tiles(frames)
+        tile_secs = (time.time() - start) / num_frames
+
+        full = measure(crop_full, frames)
+        tiled = measure(crop_tiled, frames)
+
+        print("one-off tiling: {0:.0f} ms/frame".format(tile_secs * 1000))
+        for name, result in (('full decode', full), ('tiled', tiled)):
+            print("{0:>12}: {1:7.1f} ms/frame, peak RSS {2:6.1f} MB".format(
+                name, result['seconds'] * 1000 / num_frames, result['peak_rss_mb']))
+        return {'tile_ms': tile_secs * 1000, 'full': full, 'tiled': tiled}
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
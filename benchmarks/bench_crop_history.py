@@ -0,0 +1,54 @@
+"""
+Cost of telling which of a batch of candidate crop centres are near recent
+posts: the bit-at-a-time interleave osm_shortlink used to do, one point at a
+time, against crop_history's vectorized cell keys and set lookups.
+
+    PYTHONPATH=. python -m benchmarks.bench_crop_history [num_points] [num_posts]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import sys
+import time
+
+import numpy as np
+
+from crop_history import CELL_BITS, CropHistory
+
+
+def interleave_bits(x, y):
+    c = 0
+    for i in range(31, 0, -1):
+        c = (c << 1) | ((x >> i) & 1)
+        c = (c << 1) | ((y >> i) & 1)
+    return c
+
+
+def covered_loop(history, lats, lons):
+    out = []
+    for lat, lon in zip(lats, lons):
+        code = interleave_bits(int((lon + 180.0) * 2**32 / 360.0),
+                               int((lat + 90.0) * 2**32 / 180.0))
+        out.append(code >> (62 - 2 * CELL_BITS) in history.cells)
+    return out
+
+
+def main(num_points=4000, num_posts=200):
+    rng = np.random.RandomState(0)
+    history = CropHistory()
+    for lat, lon in zip(rng.uniform(-60, 60, num_posts), rng.uniform(80, 200, num_posts)):
+        history.record(lat, (lon + 180) % 360 - 180)
+    lats, lons = rng.uniform(-80, 80, num_points), rng.uniform(-180, 180, num_points)
+
+    results = {}
+    for name, func in (('loop', covered_loop), ('vectorized', CropHistory.covered)):
+        start = time.time()
+        found = func(history, lats, lons)
+        results[name] = {'ms': (time.time() - start) * 1000, 'covered': int(np.sum(found))}
+        print("{0:>10}: {1:7.2f} ms for {2} points ({3} covered)".format(
+            name, results[name]['ms'], num_points, results[name]['covered']))
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
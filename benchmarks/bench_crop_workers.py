@@ -0,0 +1,50 @@
+"""
+Times crop_hires_images at 1, 2 and 4 workers and reports the speedup over
+the serial run.
+
+    PYTHONPATH=. python -m benchmarks.bench_crop_workers [num_frames]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+
+import himawari_hires
+import tiles
+from benchmarks.harness import measure, synthetic_frame
+
+WORKER_COUNTS = (1, 2, 4)
+
+
+def run_crop(folder, workers):
+    himawari_hires.HIRES_FOLDER = folder
+    images = [img for img in os.listdir(folder) if img.startswith('full')]
+    himawari_hires.crop_hires_images(images, lat_start=1500, lng_start=2000,
+                                     workers=workers)
+
+
+def main(num_frames=12):
+    folder = tempfile.mkdtemp()
+    try:
+        frames = [synthetic_frame(os.path.join(folder, 'full_{0:03d}.jpg'.format(i)), seed=i)
+                  for i in range(num_frames)]
+        tiles.build_missing_tiles(frames)
+
+        results = {}
+        for workers in WORKER_COUNTS:
+            results[workers] = measure(run_crop, folder, workers)
+        serial = results[1]['seconds']
+        print("{0} frames, {1} CPUs".format(num_frames, os.cpu_count()))
+        for workers in WORKER_COUNTS:
+            secs = results[workers]['seconds']
+            print("{0} workers: {1:6.2f}s ({2:.2f}x)".format(workers, secs, serial / secs))
+        return results
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+"""
+Compares making a hi-res video by writing PNG crops for hires_mp4.sh against
+piping raw crops straight into ffmpeg. Reports wall time and the bytes of
+intermediate files written.
+
+    PYTHONPATH=. python -m benchmarks.bench_encode [num_frames]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+
+import himawari_hires
+import tiles
+from benchmarks.harness import measure, synthetic_frame
+
+
+def _intermediate_bytes(folder):
+    return sum(os.path.getsize(os.path.join(folder, f))
+               for f in os.listdir(folder) if f.endswith('.png'))
+
+
+def run_encode(folder, stream):
+    himawari_hires.HIRES_FOLDER = folder
+    himawari_hires.BASE_DIR = os.path.dirname(os.path.abspath(himawari_hires.__file__))
+    images = [img for img in os.listdir(folder) if img.startswith('full')]
+    out = os.path.join(folder, 'out.mp4')
+    if stream:
+        frames = himawari_hires.iter_hires_crops(images, lat_start=1500, lng_start=2000)
+        himawari_hires.encode_frames_mp4(frames, out)
+    else:
+        himawari_hires.crop_hires_images(images, lat_start=1500, lng_start=2000)
+        himawari_hires.encode_mp4(folder, out)
+
+
+def main(num_frames=12):
+    if not shutil.which('ffmpeg'):
+        print("ffmpeg not found on PATH; skipping")
+        return None
+
+    folder = tempfile.mkdtemp()
+    try:
+        frames = [synthetic_frame(os.path.join(folder, 'full_{0:03d}.jpg'.format(i)), seed=i)
+                  for i in range(num_frames)]
+        tiles.build_missing_tiles(frames)
+
+        results = {}
+        for name, stream in (('png + script', False), ('raw pipe', True)):
+            results[name] = measure(run_encode, folder, stream)
+            results[name]['intermediate_bytes'] = _intermediate_bytes(folder)
+            for f in os.listdir(folder):
+                if f.endswith('.png') or f.endswith('.mp4'):
+                    os.remove(os.path.join(folder, f))
+
+        for name, result in results.items():
+            print("{0:>12}: {1:6.2f}s, {2:6.1f} MB of intermediate files".format(
+                name, result['seconds'], result['intermediate_bytes'] / 1048576.0))
+        return results
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,56 @@
+"""
+Per-frame cost of frame_quality.filter_frames on hi-res and lowres frames,
+against decoding each frame in full (what the encoders do anyway), on a
+cold cache and then a warm one, where only the cache file is read.
+
+    PYTHONPATH=. python -m benchmarks.bench_frame_quality [num_frames]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+
+from PIL import Image
+
+import frame_quality
+from benchmarks.harness import HIRES_SIZE, LOWRES_SIZE, measure, synthetic_frame
+
+
+def decode(frames):
+    for frame in frames:
+        Image.open(frame).load()
+
+
+def check(frames, cache_file):
+    frame_quality.filter_frames(frames, frame_quality.QualityCache(cache_file))
+
+
+def main(num_frames=8):
+    folder = tempfile.mkdtemp()
+    try:
+        results = {}
+        for name, size in (('hires', HIRES_SIZE), ('lowres', LOWRES_SIZE)):
+            frames = [synthetic_frame(os.path.join(folder, '{0}_{1}.jpg'.format(name, i)),
+                                      size=size, seed=i)
+                      for i in range(num_frames)]
+            cache_file = os.path.join(folder, name + '.json')
+            results[name] = {
+                'decode': measure(decode, frames),
+                'cold': measure(check, frames, cache_file),
+                'warm': measure(check, frames, cache_file),
+            }
+            for run in ('decode', 'cold', 'warm'):
+                result = results[name][run]
+                result['ms_per_frame'] = result['seconds'] * 1000 / num_frames
+                print("{0:>6} {1:>6}: {2:7.2f} ms/frame, peak RSS {3:6.1f} MB".format(
+                    name, run, result['ms_per_frame'], result['peak_rss_mb']))
+        return results
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
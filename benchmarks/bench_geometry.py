@@ -0,0 +1,38 @@
+"""
+Points per second for pixel -> lat/long conversion, one point at a time
+through px_to_lat_long against a single px_to_lat_long_array call.
+
+    PYTHONPATH=. python -m benchmarks.bench_geometry [num_points]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import sys
+import time
+
+import numpy as np
+
+import geometry
+
+
+def main(num_points=100000):
+    rng = np.random.RandomState(0)
+    lat_px = rng.randint(0, 5500, num_points)
+    lng_px = rng.randint(0, 5500, num_points)
+
+    start = time.time()
+    for lat, lng in zip(lat_px.tolist(), lng_px.tolist()):
+        geometry.px_to_lat_long(lat, lng)
+    scalar = num_points / (time.time() - start)
+
+    start = time.time()
+    geometry.px_to_lat_long_array(lat_px, lng_px)
+    vector = num_points / (time.time() - start)
+
+    print("scalar: {0:12,.0f} points/s".format(scalar))
+    print(" array: {0:12,.0f} points/s ({1:.0f}x)".format(vector, vector / scalar))
+    return {'scalar_points_per_sec': scalar, 'array_points_per_sec': vector}
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
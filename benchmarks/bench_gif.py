@@ -0,0 +1,65 @@
+"""
+Per-run time and CPU for building the rolling 48 frame GIF: the two-pass
+mp4_to_gif.sh script against GifBuilder, both cold and on a typical
+10-minute run where one frame joins the window and one leaves.
+
+    PYTHONPATH=. python -m benchmarks.bench_gif [num_frames]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from gif_builder import GifBuilder
+from benchmarks.harness import LOWRES_SIZE, synthetic_frame
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'mp4_to_gif.sh')
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_script(folder):
+    start, cpu_start = time.time(), _children_cpu()
+    subprocess.check_call([SCRIPT, folder, os.path.join(folder, 'script.gif')],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return {'seconds': time.time() - start, 'cpu_seconds': _children_cpu() - cpu_start}
+
+
+def main(num_frames=48):
+    folder = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(folder, 'lowres'))
+        frames = [synthetic_frame(os.path.join(folder, 'lowres', 'f{0:03d}.png'.format(i)),
+                                  size=LOWRES_SIZE, fmt='PNG', seed=i)
+                  for i in range(num_frames + 1)]
+        results = {}
+        if shutil.which('ffmpeg'):
+            os.remove(frames[-1])
+            results['script'] = run_script(folder)
+            synthetic_frame(frames[-1], size=LOWRES_SIZE, fmt='PNG', seed=num_frames)
+
+        builder = GifBuilder(os.path.join(folder, 'cache'))
+        out = os.path.join(folder, 'builder.gif')
+        results['builder cold'] = builder.build(frames[:-1], out)
+        results['builder +1/-1'] = builder.build(frames[1:], out)
+
+        for name, result in results.items():
+            print("{0:>14}: {1:6.2f}s wall, {2:6.2f}s CPU".format(
+                name, result['seconds'], result['cpu_seconds']))
+        return results
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,63 @@
+"""
+Time and peak memory for preparing a full window of lowres frames: the old
+pad-then-resize process_image, one frame at a time, against the fused
+resize into a reused canvas on one and on PREP_WORKERS threads.
+
+    PYTHONPATH=. python -m benchmarks.bench_lowres_prep [num_frames]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+
+from PIL import Image
+
+import himawari_lowres as hl
+from benchmarks.harness import LOWRES_SIZE, measure, synthetic_frame
+
+
+def pad_then_resize(frames, out_folder):
+    for frame in frames:
+        im = Image.open(frame)
+        new_im = Image.new("RGB", (650, 650))
+        new_im.paste(im, ((650 - im.size[0]) // 2, (650 - im.size[1]) // 2))
+        new_im = new_im.resize((500, 500), Image.BICUBIC)
+        new_im.save(os.path.join(out_folder, os.path.basename(frame)), format='PNG')
+
+
+def fused(frames, out_folder, workers):
+    hl.PROCESSED_FOLDER = out_folder
+    hl.process_images(frames, workers=workers)
+
+
+def main(num_frames=48):
+    folder = tempfile.mkdtemp()
+    try:
+        start = datetime.datetime(2016, 10, 23)
+        names = [hl.date_to_jma_filename(start + datetime.timedelta(minutes=10 * i))
+                 .replace('/', '') for i in range(num_frames)]
+        frames = [synthetic_frame(os.path.join(folder, name), size=LOWRES_SIZE, fmt='PNG', seed=i)
+                  for i, name in enumerate(names)]
+        out_folder = os.path.join(folder, 'processed')
+        os.makedirs(out_folder)
+
+        results = [('pad + resize', measure(pad_then_resize, frames, out_folder))]
+        for workers in sorted(set([1, hl.PREP_WORKERS])):
+            results.append(('fused x{0}'.format(workers),
+                            measure(fused, frames, out_folder, workers)))
+
+        for name, result in results:
+            print("{0:>13}: {1:6.2f}s for {2} frames, {3:6.2f}s CPU, peak RSS {4:6.1f} MB".format(
+                name, result['seconds'], num_frames, result['cpu_seconds'],
+                result['peak_rss_mb']))
+        return dict(results)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,222 @@
+"""
+End-to-end timings for the hires, lowres and FTP pipelines against local
+stand-ins for CIRA, JMA and NOAA serving synthetic frames.
+
+Each stage runs in a fresh process, in pipeline order, on the files the
+previous stages left behind, and is reported with its wall time, CPU time
+and peak RSS. Results can be written as JSON and compared with an earlier
+run to spot regressions between versions.
+
+    PYTHONPATH=. python -m benchmarks.bench_pipeline [--hires-frames N]
+        [--ftp-frames N] [--json out.json] [--baseline old.json]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from os.path import abspath, dirname, join
+
+import ftp_lowres
+import himawari_hires as hh
+import himawari_lowres as hl
+from benchmarks import standins
+from benchmarks.harness import measure
+from frame_sources import FtpSource, SourcePool
+from ftp_mirror import FtpMirror
+
+REPO_DIR = dirname(dirname(abspath(__file__)))
+
+# Top-left corner of the hires crop, as in bench_encode.
+CROP_START = (1500, 2000)
+JMA_FRAMES = 48
+# Stages this much slower than the baseline are flagged, unless they take
+# less than MIN_SECONDS either way (too short to time reliably).
+REGRESSION_RATIO = 1.2
+MIN_SECONDS = 0.1
+
+
+def configure(env):
+    """Points the pipeline modules at the stand-ins and the work folder."""
+    work = env['work']
+    hh.BASE_DIR = work
+    hh.HIRES_FOLDER = join(work, 'hires')
+    hh.CIRA_IMG_BASE_URL = env['http'] + '/cira/'
+    hh.CIRA_LIST_URL = env['http'] + '/cira/' + standins.CIRA_PAGE
+    hh.CIRA_LISTING = join(work, 'cira_listing.json')
+    hh.SOURCE_HEALTH = join(work, 'source_health_hires.json')
+    hh.QUALITY_CACHE = join(work, 'quality_hires.json')
+
+    hl.BASE_DIR = work
+    hl.LOWRES_FOLDER = join(work, 'lowres/')
+    hl.PROCESSED_FOLDER = join(work, 'lowres', 'processed/')
+    hl.JMA_URL = env['http'] + '/jma/'
+    hl.FRAME_DB = join(work, 'lowres_frames.sqlite')
+    hl.GIF_CACHE = join(work, 'gif_cache')
+    hl.QUALITY_CACHE = join(work, 'quality_lowres.json')
+    hl.NOAA_URL = 'ftp://{0}:{1}/{2}/'.format(env['ftp_host'], env['ftp_port'], standins.NOAA_PATH)
+    hl.NOAA_LISTING = join(work, 'noaa_listing.json')
+    hl.NOAA_FOLDER = join(work, 'lowres', 'noaa/')
+    hl.SOURCE_HEALTH = join(work, 'source_health_lowres.json')
+    hl.RENDER_FOLDER = join(work, 'render_frames')
+
+    ftp_lowres.LOWRES_FOLDER = join(work, 'noaa/')
+    ftp_lowres.QUALITY_CACHE = join(work, 'quality_ftp.json')
+    ftp_lowres.RENDER_FOLDER = join(work, 'render_frames_ftp')
+    mirror = FtpMirror(env['ftp_host'], standins.NOAA_PATH, ftp_lowres.LOWRES_FOLDER,
+                       port=env['ftp_port'], listing_file=join(work, 'ftp_listing.json'),
+                       local_name=ftp_lowres.local_name)
+    ftp_lowres._pool = SourcePool([FtpSource('noaa', mirror)])
+
+
+def run_stage(stage, env):
+    configure(env)
+    stage(env)
+
+
+def refresh_images(env):
+    hh.refresh_images(num=env['hires_frames'])
+
+
+def crop_hires_images(env):
+    images = [os.path.basename(img) for img in hh.cira_frames()]
+    hh.crop_hires_images(images, *CROP_START)
+
+
+def make_hires_animation(env):
+    hh.make_hires_animation(*CROP_START)
+
+
+def download_jma_images(env):
+    hl.download_jma_images()
+
+
+def process_image(env):
+    # download_jma_images already prepared every frame; this times
+    # process_image on its own, one frame at a time, into a scratch folder.
+    out = join(env['work'], 'process_image')
+    os.makedirs(out)
+    for image in hl.get_frame_store().frames():
+        hl.process_image(join(hl.LOWRES_FOLDER, image), out=join(out, image))
+
+
+def images_to_gif(env):
+    hl.images_to_gif()
+
+
+def delete_old_images(env):
+    hl.delete_old_images(num=JMA_FRAMES // 2)
+
+
+def ftp_download_images(env):
+    ftp_lowres.download_images(num=env['ftp_frames'])
+
+
+# name: (function, needs ffmpeg)
+STAGES = [
+    ('refresh_images', refresh_images, False),
+    ('crop_hires_images', crop_hires_images, False),
+    ('make_hires_animation', make_hires_animation, True),
+    ('download_jma_images', download_jma_images, False),
+    ('process_image', process_image, False),
+    ('images_to_gif', images_to_gif, False),
+    ('delete_old_images', delete_old_images, False),
+    ('ftp_download_images', ftp_download_images, False),
+]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Prints each stage's time against `baseline` (an earlier run's
+    results) and returns the names of stages that got slower by more than
+    REGRESSION_RATIO."""
+    slower = []
+    print("\nAgainst {0} ({1}):".format(baseline.get('commit'), baseline.get('created')))
+    for name, result in results['stages'].items():
+        old = baseline.get('stages', {}).get(name, {})
+        if 'seconds' not in result or 'seconds' not in old:
+            continue
+        ratio = result['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+        flag = ''
+        if ratio > REGRESSION_RATIO and max(result['seconds'], old['seconds']) >= MIN_SECONDS:
+            slower.append(name)
+            flag = '  <- slower'
+        print("{0:>21}: {1:7.2f}s -> {2:7.2f}s ({3:5.2f}x){4}".format(
+            name, old['seconds'], result['seconds'], ratio, flag))
+    return slower
+
+
+def main(hires_frames=6, ftp_frames=48, json_out=None, baseline=None):
+    have_ffmpeg = bool(shutil.which('ffmpeg'))
+    remote = tempfile.mkdtemp()
+    work = tempfile.mkdtemp()
+    http = ftp = None
+    try:
+        for folder in ('hires', 'lowres/processed', 'noaa'):
+            os.makedirs(join(work, folder))
+        standins.make_cira(remote, hires_frames)
+        # A couple of extra frames in case the clock ticks over into the
+        # next 10 minute slot before the JMA stage runs.
+        standins.make_jma(remote, standins.jma_images(JMA_FRAMES + 2))
+        standins.make_noaa(remote, ftp_frames)
+
+        http = standins.HttpStandin(remote)
+        ftp = standins.FtpStandin(join(remote, 'noaa'))
+        env = {'work': work, 'http': http.url, 'ftp_host': ftp.host, 'ftp_port': ftp.port,
+               'hires_frames': hires_frames, 'ftp_frames': ftp_frames}
+
+        results = {
+            'created': datetime.datetime.utcnow().isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'params': {'hires_frames': hires_frames, 'jma_frames': JMA_FRAMES,
+                       'ftp_frames': ftp_frames},
+            'stages': {},
+        }
+        for name, stage, needs_ffmpeg in STAGES:
+            if needs_ffmpeg and not have_ffmpeg:
+                results['stages'][name] = {'skipped': 'ffmpeg not found on PATH'}
+                print("{0:>21}: skipped, ffmpeg not found on PATH".format(name))
+                continue
+            result = measure(run_stage, stage, env)
+            results['stages'][name] = result
+            print("{0:>21}: {1:7.2f}s, {2:7.2f}s CPU, peak RSS {3:7.1f} MB".format(
+                name, result['seconds'], result['cpu_seconds'], result['peak_rss_mb']))
+    finally:
+        for standin in (http, ftp):
+            if standin is not None:
+                standin.close()
+        shutil.rmtree(remote)
+        shutil.rmtree(work)
+
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if baseline:
+        with open(baseline) as f:
+            results['slower'] = compare(results, json.load(f))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--hires-frames', type=int, default=6)
+    parser.add_argument('--ftp-frames', type=int, default=48)
+    parser.add_argument('--json', dest='json_out', help="write results to this file")
+    parser.add_argument('--baseline', help="compare with results written by an earlier run")
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,97 @@
+"""
+Crop latency, peak RSS and disk use of the three ways a 720x720 window can
+be read from a full disk frame: decoding the JPEG, decoding the tiles it
+overlaps, and slicing the memory-mapped raw copy. Timings are with a warm
+page cache.
+
+    PYTHONPATH=. python -m benchmarks.bench_raw [num_frames] [crops_per_frame]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+import raw_frames
+import tiles
+from benchmarks.harness import HIRES_SIZE, measure, synthetic_frame
+
+
+def boxes(count, seed=0):
+    rng = random.Random(seed)
+    out = []
+    for _ in range(count):
+        left, top = rng.randint(0, HIRES_SIZE - 720), rng.randint(0, HIRES_SIZE - 720)
+        out.append((left, top, left + 720, top + 720))
+    return out
+
+
+def crop_jpeg(frames, crops):
+    for frame in frames:
+        for box in crops:
+            Image.open(frame).crop(box).load()
+
+
+def crop_tiled(frames, crops):
+    for frame in frames:
+        for box in crops:
+            tiles.read_region(frame, box).load()
+
+
+def crop_raw(frames, crops):
+    for frame in frames:
+        for box in crops:
+            raw_frames.read_regions(frame, [box])[0].load()
+
+
+def folder_bytes(folder):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(folder) for name in names)
+
+
+def main(num_frames=3, crops_per_frame=4):
+    folder = tempfile.mkdtemp()
+    try:
+        frames = [synthetic_frame(os.path.join(folder, 'full_{0}.jpg'.format(i)), seed=i)
+                  for i in range(num_frames)]
+        crops = boxes(crops_per_frame)
+        disk = {'jpeg': sum(os.path.getsize(f) for f in frames)}
+        once = {}
+        results = {'jpeg': measure(crop_jpeg, frames, crops)}
+
+        start = time.time()
+        tiles.build_missing_tiles(frames)
+        once['tiled'] = (time.time() - start) / num_frames
+        disk['tiled'] = folder_bytes(os.path.join(folder, tiles.TILE_FOLDER))
+        results['tiled'] = measure(crop_tiled, frames, crops)
+
+        # Built last: tiles.read_region reads raw copies when there are any.
+        start = time.time()
+        for frame in frames:
+            raw_frames.build_raw(frame)
+        once['raw'] = (time.time() - start) / num_frames
+        disk['raw'] = raw_frames.disk_usage(folder)['bytes']
+        results['raw'] = measure(crop_raw, frames, crops)
+
+        for name in ('jpeg', 'tiled', 'raw'):
+            result = results[name]
+            result['ms_per_crop'] = result['seconds'] * 1000 / (num_frames * crops_per_frame)
+            result['mb_per_frame'] = disk[name] / 1048576.0 / num_frames
+            print("{0:>6}: {1:7.1f} ms/crop, peak RSS {2:6.1f} MB, {3:6.1f} MB/frame on disk"
+                  "{4}".format(name, result['ms_per_crop'], result['peak_rss_mb'],
+                               result['mb_per_frame'],
+                               ", {0:.0f} ms/frame to build".format(once[name] * 1000)
+                               if name in once else ''))
+        return results
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,35 @@
+"""
+Time to pick the most interesting crop out of N candidates on a synthetic
+full disk frame, including the reduced-size decode.
+
+    PYTHONPATH=. python -m benchmarks.bench_scoring [candidates]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import himawari_hires
+from benchmarks.harness import synthetic_frame
+
+
+def main(candidates=4000):
+    folder = tempfile.mkdtemp()
+    try:
+        frame = synthetic_frame(os.path.join(folder, 'full.jpg'))
+        himawari_hires.get_crop_index()
+        start = time.time()
+        coord = himawari_hires.get_interesting_coord(frame, candidates=candidates)
+        elapsed = time.time() - start
+        print("{0} candidates scored in {1:.3f}s, best at {2}".format(candidates, elapsed, coord))
+        return {'candidates': candidates, 'seconds': elapsed}
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
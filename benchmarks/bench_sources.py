@@ -0,0 +1,90 @@
+"""
+Time to fetch a few rounds of frames from three HTTP stand-ins for the same
+source: a slow one listed first, a flaky one answering half its requests
+with a 503, and a fast one listed last. Compares trying them in the order
+listed, passing failed frames on (as a fixed mirror list would), with a
+SourcePool ranking them by what it measures.
+
+    PYTHONPATH=. python -m benchmarks.bench_sources [rounds] [frames_per_round]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks import standins
+from benchmarks.harness import LOWRES_SIZE, synthetic_frame
+from downloader import Downloader, make_session
+from frame_sources import HttpSource, SourceHealth, SourcePool
+
+MIRRORS = (('slow', {'delay': 0.2}),
+           ('flaky', {'delay': 0.02, 'fail_rate': 0.5}),
+           ('fast', {'delay': 0.02}))
+
+
+class FixedOrder(SourceHealth):
+    """Health that never learns anything, so the pool keeps to the order
+    given."""
+
+    def record(self, *args):
+        pass
+
+
+def sources(servers, folder):
+    found = []
+    for name, server in servers:
+        downloader = Downloader(session=make_session(), retries=0)
+        found.append(HttpSource(
+            name, lambda frame, url=server.url: '{0}/frames/{1}.png'.format(url, frame[1]),
+            lambda frame, name=name: os.path.join(folder, str(frame[0]), name,
+                                                  '{0}.png'.format(frame[1])),
+            downloader=downloader))
+    return found
+
+
+def run(pool, rounds, num):
+    times, counts = [], {}
+    for r in range(rounds):
+        for source in pool.sources:
+            os.makedirs(os.path.join(os.path.dirname(source.dest((r, 0)))))
+        start = time.time()
+        stats = pool.fetch([(r, i) for i in range(num)])
+        times.append(time.time() - start)
+        for name, count in stats.sources.items():
+            counts[name] = counts.get(name, 0) + count
+    return times, counts
+
+
+def main(rounds=5, num=12):
+    root = tempfile.mkdtemp()
+    servers = []
+    try:
+        os.makedirs(os.path.join(root, 'frames'))
+        for i in range(num):
+            synthetic_frame(os.path.join(root, 'frames', '{0}.png'.format(i)),
+                            size=LOWRES_SIZE, fmt='PNG', seed=i)
+        servers = [(name, standins.HttpStandin(root, **kwargs)) for name, kwargs in MIRRORS]
+        results = {}
+        for label, health in (('fixed order', FixedOrder()), ('measured', SourceHealth())):
+            folder = os.path.join(root, label.replace(' ', '_'))
+            pool = SourcePool(sources(servers, folder), health=health)
+            results[label] = run(pool, rounds, num)
+    finally:
+        for _, server in servers:
+            server.close()
+        shutil.rmtree(root)
+
+    print("{0} rounds of {1} frames".format(rounds, num))
+    for label, (times, counts) in results.items():
+        print("{0:>12}: {1:6.2f}s total, rounds {2}; from {3}".format(
+            label, sum(times), ' '.join('{0:.2f}'.format(t) for t in times),
+            ', '.join('{0} {1}'.format(n, c) for n, c in sorted(counts.items()))))
+    return results
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
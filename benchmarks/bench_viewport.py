@@ -0,0 +1,76 @@
+"""
+Render time per output frame for pan and zoom camera paths: resizing the
+view straight out of the decoded full disk frame against tiles.read_view,
+which reads only the tiles it needs from the smallest pyramid level that
+fills the output.
+
+    PYTHONPATH=. python -m benchmarks.bench_viewport [num_frames] [steps]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+import tiles
+import viewport
+from benchmarks.harness import HIRES_SIZE, measure, synthetic_frame
+
+SIZE = (720, 720)
+CENTER = (2600, 2400)
+
+
+def paths(steps):
+    return {
+        'zoom 4000->720': viewport.zoom_path(CENTER, 4000, 720, steps),
+        'pan at 720': viewport.pan_path((1000, 2000), (4000, 3000), 720, steps),
+        'pan at 2880': viewport.pan_path((1800, 2200), (3700, 3300), 2880, steps),
+    }
+
+
+def render_direct(frames, boxes):
+    # The paths stay inside the frame, so the box can go straight to resize.
+    for i, box in enumerate(boxes):
+        frame = frames[i * len(frames) // len(boxes)]
+        Image.open(frame).resize(SIZE, Image.BILINEAR, box=box)
+
+
+def render_tiled(frames, boxes):
+    for i, box in enumerate(boxes):
+        frame = frames[i * len(frames) // len(boxes)]
+        tiles.read_view(frame, box, SIZE)
+
+
+def main(num_frames=4, steps=12):
+    folder = tempfile.mkdtemp()
+    try:
+        frames = [synthetic_frame(os.path.join(folder, 'full_{0}.jpg'.format(i)), seed=i)
+                  for i in range(num_frames)]
+        start = time.time()
+        tiles.build_missing_tiles(frames)
+        tile_secs = (time.time() - start) / num_frames
+        print("one-off pyramid: {0:.0f} ms/frame ({1} levels, {2}px full disk)".format(
+            tile_secs * 1000, tiles.PYRAMID_LEVELS, HIRES_SIZE))
+
+        results = {'pyramid_ms': tile_secs * 1000}
+        for name, boxes in paths(steps).items():
+            direct = measure(render_direct, frames, boxes)
+            tiled = measure(render_tiled, frames, boxes)
+            results[name] = {'direct': direct, 'tiled': tiled}
+            print("{0:>15}: direct {1:7.1f} ms/frame, tiled {2:6.1f} ms/frame ({3:.0f}x), "
+                  "peak RSS {4:.0f} -> {5:.0f} MB".format(
+                      name, direct['seconds'] * 1000 / steps, tiled['seconds'] * 1000 / steps,
+                      direct['seconds'] / tiled['seconds'], direct['peak_rss_mb'],
+                      tiled['peak_rss_mb']))
+        return results
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,53 @@
+"""Shared helpers for the benchmark scripts: synthetic frames and timing of a
+call in a fresh process so peak memory figures aren't polluted by earlier
+runs."""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import multiprocessing
+import time
+
+from PIL import Image, ImageChops
+
+from common import peak_rss_mb
+
+HIRES_SIZE = 5500
+LOWRES_SIZE = 550
+
+
+def synthetic_frame(path, size=HIRES_SIZE, fmt='JPEG', seed=0):
+    """Writes a `size` x `size` RGB image that compresses roughly like a real
+    full disk frame (smooth gradients plus cloud-ish noise)."""
+    noise = Image.effect_noise((size // 16 + seed, size // 16 + seed), 60)
+    noise = noise.resize((size, size), Image.BILINEAR)
+    grad = Image.radial_gradient('L').resize((size, size), Image.BILINEAR)
+    im = Image.merge('RGB', (noise, ImageChops.invert(grad), grad))
+    im.save(path, fmt, **({'quality': 90} if fmt == 'JPEG' else {}))
+    return path
+
+
+def _run(queue, func, args, kwargs):
+    start = time.time()
+    cpu_start = time.process_time()
+    func(*args, **kwargs)
+    queue.put({
+        'seconds': time.time() - start,
+        'cpu_seconds': time.process_time() - cpu_start,
+        'peak_rss_mb': peak_rss_mb(),
+    })
+
+
+def measure(func, *args, **kwargs):
+    """
+    Calls func(*args, **kwargs) in a freshly spawned process.
+
+    Returns:
+        dict: wall seconds, CPU seconds and peak RSS of the child process.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run, args=(queue, func, args, kwargs))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
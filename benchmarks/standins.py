@@ -0,0 +1,175 @@
+"""
+Local stand-ins for the three image sources, serving synthetic frames from
+a folder so the pipelines can be benchmarked without touching the network:
+CIRA (an archive page plus hi-res frames over HTTP), JMA (PNG tiles over
+HTTP) and NOAA (JPEGs over FTP).
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import datetime
+import functools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+try:
+    from http.server import SimpleHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import himawari_lowres
+from benchmarks.harness import HIRES_SIZE, LOWRES_SIZE, synthetic_frame
+
+CIRA_PAGE = 'archive_hi_res.asp'
+CIRA_LINK = '<a href="images/{0}">Hi-Res Image</a><br>\n'
+NOAA_PATH = 'GOES/HIMAWARI/simplecontrast'
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class SlowHandler(QuietHandler):
+    """Waits server.delay seconds before each answer, and answers
+    server.fail_rate of requests with a 503."""
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        if self.server.random.random() < self.server.fail_rate:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        QuietHandler.do_GET(self)
+
+
+class ThreadedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that stop reading part way, as CiraListing does, reset the
+        # connection; that's expected.
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+def serve(handler, **attrs):
+    """
+    Starts a ThreadedServer for `handler` on a free local port, in a daemon
+    thread. `attrs` are set on the server first, for the handler to read as
+    self.server.<name>. Its address is in `url`; call stop() when done.
+    """
+    server = ThreadedServer(('127.0.0.1', 0), handler)
+    for name, value in attrs.items():
+        setattr(server, name, value)
+    server.url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+
+
+def make_cira(root, num, size=HIRES_SIZE, start=None):
+    """Writes `num` full disk JPEGs under root/cira/images and an archive
+    page linking them newest first, like CIRA's. Returns the frame names."""
+    start = start or datetime.datetime(2016, 10, 23, 0, 0)
+    folder = os.path.join(root, 'cira', 'images')
+    os.makedirs(folder)
+    names = []
+    for i in range(num):
+        stamp = (start + datetime.timedelta(minutes=10 * i)).strftime('%Y%m%d%H%M%S')
+        name = 'full_disk_ahi_true_color_{0}.jpg'.format(stamp)
+        synthetic_frame(os.path.join(folder, name), size=size, seed=i)
+        names.append(name)
+    with open(os.path.join(root, 'cira', CIRA_PAGE), 'w') as f:
+        f.write('<html><body>\n')
+        f.writelines(CIRA_LINK.format(name) for name in reversed(names))
+        f.write('</body></html>\n')
+    return names
+
+
+def make_jma(root, images, size=LOWRES_SIZE):
+    """Writes a PNG under root/jma for each of `images`, as listed by
+    himawari_lowres.get_jma_images."""
+    for i, image in enumerate(images):
+        path = os.path.join(root, 'jma', image)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        synthetic_frame(path, size=size, fmt='PNG', seed=i)
+
+
+def make_noaa(root, num, size=LOWRES_SIZE, start=None):
+    """Writes `num` JPEGs named like NOAA's under root/noaa/NOAA_PATH."""
+    start = start or datetime.datetime(2016, 10, 23, 0, 0)
+    folder = os.path.join(root, 'noaa', NOAA_PATH)
+    os.makedirs(folder)
+    for i in range(num):
+        stamp = (start + datetime.timedelta(minutes=10 * i)).strftime('%Y-%m-%dT%H:%M:%S')
+        synthetic_frame(os.path.join(folder, '{0}.JPG'.format(stamp)), size=size, seed=i)
+
+
+def jma_images(num=48):
+    """The JMA frames download_jma_images will ask for if run now."""
+    return himawari_lowres.get_jma_images(
+        start_time=himawari_lowres.round_time_10(datetime.datetime.utcnow()), num=num)
+
+
+class HttpStandin(object):
+    """
+    Serves `root` over HTTP on a free local port.
+
+    Args:
+        root (str)
+        delay (float): seconds to wait before each answer.
+        fail_rate (float): share of requests answered with a 503.
+    """
+
+    def __init__(self, root, delay=0.0, fail_rate=0.0):
+        slow = delay or fail_rate
+        handler = functools.partial(SlowHandler if slow else QuietHandler, directory=root)
+        self.server = serve(handler, delay=delay, fail_rate=fail_rate,
+                            random=random.Random(0))
+        self.url = self.server.url
+
+    def close(self):
+        stop(self.server)
+
+
+class FtpStandin(object):
+    """Serves `root` over anonymous FTP on a free local port."""
+
+    def __init__(self, root):
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+
+        # pyftpdlib logs every command to stderr unless its logger is set up.
+        ftp_logger = logging.getLogger('pyftpdlib')
+        ftp_logger.setLevel(logging.WARNING)
+        ftp_logger.addHandler(logging.NullHandler())
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(root)
+        handler = type(str('Handler'), (FTPHandler,), {'authorizer': authorizer})
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self.host, self.port = self.server.address[:2]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'timeout': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.close_all()
+        self.thread.join()
@@ -0,0 +1,164 @@
+"""
+Incremental listing of the hi-res frames on CIRA's archive page.
+
+The page is requested with the ETag/Last-Modified of the previous fetch, so
+an unchanged archive costs a 304 and nothing more. A changed page is
+streamed through a small HTMLParser that stops as soon as it has seen `num`
+frame links (the archive lists the newest first), instead of building a
+BeautifulSoup tree of the whole thing. The links are cached in a JSON file
+between runs, so callers can tell which frames were newly published.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import codecs
+import logging
+import re
+
+try:
+    from html.parser import HTMLParser
+except ImportError:
+    from HTMLParser import HTMLParser
+
+from common import load_json, save_json_atomic
+from downloader import Downloader
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 16 * 1024
+
+# Text of the links to full disk frames.
+LINK_TEXT = re.compile('^Hi-Res Image')
+
+
+class LinkParser(HTMLParser):
+    """
+    Collects the href of every <a> whose text matches `text`, in page order.
+
+    Args:
+        limit (int, optional): stop collecting after this many links.
+        text (regex): pattern the link text must match.
+    """
+
+    def __init__(self, limit=None, text=LINK_TEXT):
+        HTMLParser.__init__(self)
+        self.limit = limit
+        self.text = text
+        self.links = []
+        self._href = None
+        self._data = []
+
+    @property
+    def done(self):
+        return self.limit is not None and len(self.links) >= self.limit
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self._href = dict(attrs).get('href')
+            self._data = []
+
+    def handle_data(self, data):
+        if self._href is not None:
+            self._data.append(data)
+
+    def handle_endtag(self, tag):
+        if tag != 'a' or self._href is None:
+            return
+        if not self.done and self.text.match(''.join(self._data)):
+            self.links.append(self._href)
+        self._href = None
+
+
+def parse_links(chunks, limit=None, encoding='utf-8'):
+    """
+    Feeds `chunks` (bytes) to a LinkParser until it has `limit` links or
+    they run out.
+
+    Returns:
+        list of link hrefs, in page order.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    parser = LinkParser(limit=limit)
+    for chunk in chunks:
+        parser.feed(decoder.decode(chunk))
+        if parser.done:
+            break
+    else:
+        parser.feed(decoder.decode(b'', final=True))
+        parser.close()
+    return parser.links[:limit]
+
+
+class CiraListing(object):
+    """
+    Args:
+        url (str): the archive page.
+        cache_file (str, optional): where the links and validators are kept
+            between runs.
+        downloader (Downloader, optional): used for its session and retries.
+        chunk_size (int): bytes of the page read at a time.
+    """
+
+    def __init__(self, url, cache_file=None, downloader=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.url = url
+        self.cache_file = cache_file
+        self.downloader = downloader or Downloader()
+        self.chunk_size = chunk_size
+        self.cache = self._load_cache()
+        self.new = []
+        self.modified = False
+
+    def _load_cache(self):
+        return load_json(self.cache_file, {})
+
+    def _save_cache(self):
+        if self.cache_file:
+            save_json_atomic(self.cache_file, self.cache, indent=2, sort_keys=True)
+
+    def _conditional_headers(self, num):
+        # Validators only help if the cached links came from the same page
+        # and went at least as deep as we want now.
+        if self.cache.get('url') != self.url or self.cache.get('num', 0) < num:
+            return {}
+        headers = {}
+        if self.cache.get('etag'):
+            headers['If-None-Match'] = self.cache['etag']
+        if self.cache.get('last_modified'):
+            headers['If-Modified-Since'] = self.cache['last_modified']
+        return headers
+
+    def refresh(self, num=60):
+        """
+        Fetches the archive page if it changed since the last refresh.
+        Afterwards `new` holds the links that weren't listed last time and
+        `modified` says whether the page had changed at all.
+
+        Returns:
+            list of up to `num` frame links, newest first.
+        """
+        with self.downloader.get(self.url, headers=self._conditional_headers(num),
+                                 stream=True) as resp:
+            try:
+                if resp.status_code == 304:
+                    logger.debug("%s not modified", self.url)
+                    self.new, self.modified = [], False
+                    return self.cache['images'][:num]
+                resp.raise_for_status()
+                images = parse_links(resp.iter_content(chunk_size=self.chunk_size), limit=num,
+                                     encoding=resp.encoding or 'utf-8')
+            finally:
+                resp.close()
+
+        known = set(self.cache.get('images', []))
+        self.new = [image for image in images if image not in known]
+        self.modified = True
+        self.cache = {
+            'url': self.url,
+            'num': num,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'images': images,
+        }
+        self._save_cache()
+        logger.debug("Found %s images, %s new", len(images), len(self.new))
+        return images
@@ -1,9 +1,105 @@
+import importlib.util
+import json
 import logging
 import logging.handlers
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict
+from contextlib import contextmanager
 
-import twitter
 import config
 
+logger = logging.getLogger(__name__)
+
+
+class _LazyModule(types.ModuleType):
+    """
+    A module that runs itself the first time one of its attributes is used.
+    The first thread to get there runs it under a lock, and the class only
+    changes once it has finished, so other threads wait for the whole module
+    rather than seeing it half run. If running it fails, the next use runs
+    it again (and fails the same way) instead of seeing what it got to.
+    importlib.util's own lazy modules only take a lock from Python 3.12, and
+    don't recover from a failure; otherwise this follows that version.
+    """
+
+    def __getattribute__(self, attr):
+        spec = object.__getattribute__(self, '__spec__')
+        state = spec.loader_state
+        with state['lock']:
+            if object.__getattribute__(self, '__class__') is _LazyModule:
+                # The loading thread itself (the module's own code, or an
+                # import cycle back to it) gets what's there so far.
+                if state['loading']:
+                    return object.__getattribute__(self, attr)
+                state['loading'] = True
+                # Attributes set on the module before it ran are kept.
+                namespace = object.__getattribute__(self, '__dict__')
+                before = state['__dict__']
+                changed = dict((key, value) for key, value in namespace.items()
+                               if key not in before or before[key] is not value)
+                try:
+                    spec.loader.exec_module(self)
+                finally:
+                    state['loading'] = False
+                namespace.update(changed)
+                self.__class__ = types.ModuleType
+        return getattr(self, attr)
+
+    def __delattr__(self, attr):
+        self.__getattribute__('__class__')
+        delattr(self, attr)
+
+
+class _LazyLoader(importlib.util.LazyLoader):
+    """importlib.util.LazyLoader, making _LazyModules."""
+
+    def exec_module(self, module):
+        module.__spec__.loader = self.loader
+        module.__loader__ = self.loader
+        module.__spec__.loader_state = {'__dict__': module.__dict__.copy(),
+                                        'lock': threading.RLock(), 'loading': False}
+        module.__class__ = _LazyModule
+
+
+def lazy_import(name):
+    """
+    Returns the module `name` without running it: the real import happens
+    the first time one of its attributes is used. The bots load their heavy
+    dependencies (Pillow, NumPy, Shapely, pyproj, python-twitter...) this
+    way, so a run that finds nothing to do never pays for them. The first
+    use is safe from any number of threads at once.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named {0!r}".format(name), name=name)
+    loader = _LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def preload(*modules):
+    """
+    Finishes loading lazy_import'ed `modules` now, so the worker threads
+    about to use them don't all start by waiting on one of them to load
+    them, and an import error surfaces here rather than once per task.
+    """
+    for module in modules:
+        getattr(module, '__name__')
+
+
+twitter = lazy_import('twitter')
+
 
 def get_api():
     """Returns an authenticated Twitter API instance"""
@@ -19,14 +115,247 @@ def get_api():
     return api
 
 
+# Libraries that log every request or file at DEBUG; they're kept at INFO
+# or above whatever level the bots log at.
+QUIET_LOGGERS = ('urllib3', 'requests', 'requests_oauthlib', 'oauthlib', 'PIL', 'pyftpdlib')
+
+
 def set_up_logging(log_file=None, level=logging.DEBUG):
     global logger
     logger = logging.getLogger(__name__)
     logger.setLevel(level)
 
-    handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=1048576, backupCount=5)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    # Attach to the root logger so helper modules (downloader, etc.) that log
+    # under their own names end up in the same file. Each file is attached
+    # once, however often this is called (the scheduler calls it per job).
+    root = logging.getLogger()
+    root.setLevel(level)
+    path = os.path.abspath(log_file)
+    if not any(getattr(h, 'baseFilename', None) == path for h in root.handlers):
+        handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=1048576,
+                                                       backupCount=5)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        handler.setFormatter(formatter)
+        root.addHandler(handler)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(level, logging.INFO))
 
     return logger
+
+
+def current_rss_mb():
+    """Resident set size of this process right now, in MB, or None where
+    /proc isn't available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1048576.0
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    # getrusage carries the parent's peak across fork/exec on Linux, so
+    # prefer the per-address-space high water mark where it's available.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes.
+    return rss / 1024.0 if sys.platform != 'darwin' else rss / 1048576.0
+
+
+PART_SUFFIX = '.part'
+
+
+def load_json(path, default):
+    """
+    Reads a JSON file written by save_json_atomic.
+
+    Returns:
+        The parsed contents, or `default` if `path` is None, doesn't exist
+        or can't be read (the last is logged).
+    """
+    if not path or not os.path.exists(path):
+        return default
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        logger.warning("Ignoring unreadable %s", path, exc_info=True)
+        return default
+
+
+def save_json_atomic(path, obj, **kwargs):
+    """Writes `obj` to `path` as JSON through a PART_SUFFIX file renamed into
+    place, so readers never see half a file. `kwargs` go to json.dump."""
+    tmp = path + PART_SUFFIX
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, **kwargs)
+    os.rename(tmp, path)
+
+
+class JsonLinesSink(object):
+    """Appends one JSON object per run to `path`."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, job, snapshot):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(dict(snapshot, job=job), sort_keys=True) + '\n')
+
+
+class PrometheusTextfileSink(object):
+    """Writes the last run of each job to `<folder>/himawari_<job>.prom` for
+    node_exporter's textfile collector."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def write(self, job, snapshot):
+        labels = 'job="{0}"'.format(job)
+        lines = ['himawari_last_run_timestamp_seconds{{{0}}} {1}'.format(labels,
+                                                                         snapshot['time'])]
+        for stage, timing in snapshot['stages'].items():
+            for key, value in sorted(timing.items()):
+                if value is not None:
+                    lines.append('himawari_stage_{0}{{{1},stage="{2}"}} {3}'.format(
+                        key, labels, stage, value))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('himawari_{0}_total{{{1}}} {2}'.format(name, labels, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append('himawari_{0}{{{1}}} {2}'.format(name, labels, value))
+
+        path = os.path.join(self.folder, 'himawari_{0}.prom'.format(job))
+        # The collector may read at any time, so swap the file in whole.
+        with open(path + PART_SUFFIX, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(path + PART_SUFFIX, path)
+
+
+class StatsdSink(object):
+    """Sends each run's figures to a StatsD server over UDP."""
+
+    def __init__(self, host, port=8125, prefix='himawari'):
+        self.address = (host, port)
+        self.prefix = prefix
+
+    def write(self, job, snapshot):
+        base = '{0}.{1}'.format(self.prefix, job)
+        lines = []
+        for stage, timing in snapshot['stages'].items():
+            lines.append('{0}.{1}.seconds:{2:.0f}|ms'.format(base, stage,
+                                                             timing['seconds'] * 1000))
+        lines.extend('{0}.{1}:{2}|c'.format(base, name, value)
+                     for name, value in sorted(snapshot['counters'].items()))
+        lines.extend('{0}.{1}:{2}|g'.format(base, name, value)
+                     for name, value in sorted(snapshot['gauges'].items()))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in lines:
+                sock.sendto(line.encode('utf-8'), self.address)
+        finally:
+            sock.close()
+
+
+_sinks = []
+
+
+def set_up_metrics(metrics_file=None):
+    """
+    Sets where Metrics.flush() writes to: `metrics_file` as JSON lines, plus
+    a Prometheus textfile folder and/or StatsD server if config.py has
+    METRICS_TEXTFILE_DIR or STATSD_HOST (and optionally STATSD_PORT).
+    """
+    sinks = []
+    if metrics_file:
+        sinks.append(JsonLinesSink(metrics_file))
+    if getattr(config, 'METRICS_TEXTFILE_DIR', None):
+        sinks.append(PrometheusTextfileSink(config.METRICS_TEXTFILE_DIR))
+    if getattr(config, 'STATSD_HOST', None):
+        sinks.append(StatsdSink(config.STATSD_HOST, getattr(config, 'STATSD_PORT', 8125)))
+    _sinks[:] = sinks
+    return sinks
+
+
+class Metrics(object):
+    """
+    Stage timings, counters and gauges for one run of a bot.
+
+    Wrap each stage in `with metrics.stage(name):`, count things with
+    incr(), and call flush() at the end of the run to hand everything to
+    the sinks and start afresh. It's safe to use from worker threads.
+
+    Args:
+        job (str): name the figures are reported under.
+        sinks (list, optional): defaults to the ones from set_up_metrics.
+    """
+
+    def __init__(self, job, sinks=None):
+        self.job = job
+        self.sinks = sinks
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = OrderedDict()
+            self.counters = {}
+            self.gauges = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the block. Records wall and CPU seconds, RSS at the end and
+        the process's peak RSS so far. CPU time is for the whole process,
+        so it includes pool threads working for the stage.
+        """
+        start = time.time()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            timing = {
+                'seconds': round(time.time() - start, 3),
+                'cpu_seconds': round(time.process_time() - cpu_start, 3),
+                'rss_mb': current_rss_mb(),
+                'peak_rss_mb': peak_rss_mb(),
+            }
+            with self._lock:
+                # A stage run more than once in a run adds up.
+                if name in self.stages:
+                    for key in ('seconds', 'cpu_seconds'):
+                        timing[key] += self.stages[name][key]
+                self.stages[name] = timing
+            logger.debug('Stage %s took %.2fs', name, timing['seconds'])
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        with self._lock:
+            return {'time': round(time.time(), 3), 'stages': dict(self.stages),
+                    'counters': dict(self.counters), 'gauges': dict(self.gauges)}
+
+    def flush(self):
+        """Writes the run's figures to every sink, then resets them. A
+        failing sink is logged and skipped."""
+        snapshot = self.snapshot()
+        self.reset()
+        logger.info('%s metrics: %s', self.job, json.dumps(snapshot, sort_keys=True))
+        for sink in (_sinks if self.sinks is None else self.sinks):
+            try:
+                sink.write(self.job, snapshot)
+            except Exception:
+                logger.error('Failed to write metrics to %s', sink, exc_info=True)
+        return snapshot
@@ -0,0 +1,130 @@
+"""
+History of the regions the hires bot has posted, so the crop choosers can
+steer away from places it showed recently.
+
+Each post is stored as the OpenStreetMap short code of the crop's centre
+(see osm_shortlink), which decodes back into coordinates. In memory the
+history is a set of cells of a coarse Z-order grid: the leading CELL_BITS
+bits of the interleaved latitude and longitude of each centre, plus the
+cells around it. Whether a point was covered is then one shift and a
+lookup, and whole arrays of candidate points are coded and looked up in
+one go with np.isin.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import logging
+import time
+
+import numpy as np
+
+from common import load_json, save_json_atomic
+from osm_shortlink import decode, deinterleave, encode, interleave, lat_lon_code
+
+logger = logging.getLogger(__name__)
+
+# Bits per axis of the cell grid: 2**6 cells round the world, about 5.6
+# degrees of longitude by 2.8 of latitude each.
+CELL_BITS = 6
+# Cells either side of a posted centre that count as covered too; a crop
+# spans a few cells.
+NEIGHBOURS = 1
+# Zoom level of the stored short codes.
+CODE_ZOOM = 16
+# Posts older than this are forgotten.
+MAX_AGE = 14 * 24 * 3600
+
+
+def cell_keys(lat, lon, bits=CELL_BITS):
+    """
+    Returns the grid cell of each point, as integers. Points with a NaN
+    coordinate (space, to geometry) get -1.
+
+    Args:
+        lat, lon (array-like): coordinates in degrees.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    bad = np.isnan(lat) | np.isnan(lon)
+    codes = lat_lon_code(np.where(bad, 0.0, np.clip(lat, -90.0, 89.999999)),
+                         np.where(bad, 0.0, np.clip(lon, -180.0, 179.999999)))
+    keys = (codes >> np.uint64(62 - 2 * bits)).astype(np.int64)
+    return np.where(bad, -1, keys)
+
+
+def neighbourhood(key, bits=CELL_BITS, radius=NEIGHBOURS):
+    """Returns the cells within `radius` of `key`, wrapping round in
+    longitude."""
+    shift = 32 - bits
+    x, y = deinterleave(int(key) << (62 - 2 * bits))
+    x, y = x >> shift, y >> shift
+    cells = set()
+    for dx in range(-radius, radius + 1):
+        for dy in range(-radius, radius + 1):
+            ny = y + dy
+            if 0 <= ny < 2 ** bits:
+                nx = (x + dx) % 2 ** bits
+                cells.add(interleave(nx << shift, ny << shift) >> (62 - 2 * bits))
+    return cells
+
+
+class CropHistory(object):
+    """
+    Args:
+        history_file (str, optional): where posts are kept between runs.
+        max_age (float): seconds a post is remembered for.
+        clock (callable): for tests.
+    """
+
+    def __init__(self, history_file=None, max_age=MAX_AGE, clock=time.time):
+        self.history_file = history_file
+        self.max_age = max_age
+        self.clock = clock
+        self.posts = self._load()
+        self.cells = set()
+        for post in self.posts:
+            self._cover(post['code'])
+
+    def _load(self):
+        posts = load_json(self.history_file, [])
+        cutoff = self.clock() - self.max_age
+        return [post for post in posts if post['time'] > cutoff]
+
+    def _save(self):
+        if not self.history_file:
+            return
+        save_json_atomic(self.history_file, self.posts, indent=2)
+
+    def _cover(self, code):
+        lat, lon, _ = decode(code)
+        self.cells |= neighbourhood(int(cell_keys(lat, lon)))
+
+    def __len__(self):
+        return len(self.posts)
+
+    def record(self, lat, lon):
+        """Remembers a post centred on `lat`, `lon`."""
+        code = encode(lat, lon, CODE_ZOOM)
+        self.posts.append({'code': code, 'time': self.clock()})
+        self._cover(code)
+        self._save()
+        logger.debug("Recorded crop at %s, %s as %s", lat, lon, code)
+
+    def locations(self):
+        """Returns the (lat, lon) of each remembered post, oldest first."""
+        return [decode(post['code'])[:2] for post in self.posts]
+
+    def covered(self, lat, lon):
+        """
+        Returns whether each point is near a recent post.
+
+        Args:
+            lat, lon (array-like): coordinates in degrees; NaN is never
+                covered.
+
+        Returns:
+            bool array
+        """
+        keys = cell_keys(lat, lon)
+        cells = np.fromiter(self.cells, dtype=keys.dtype, count=len(self.cells))
+        return np.isin(keys, cells)
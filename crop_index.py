@@ -0,0 +1,197 @@
+"""
+Precomputed index of valid crop origins inside a convex polygon.
+
+Because the polygon is convex, the valid origins on each row form one
+contiguous run of x values, so the whole index is two small arrays (first
+and last valid x per row). A uniform draw is a single lookup into the
+running count of valid points, and weighted draws pick a grid cell first.
+
+Coordinates follow Shapely's convention (y counts up from the bottom), like
+POINTS in himawari_hires.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import hashlib
+import logging
+import os
+import random
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CROP_SIZE = 720
+
+
+def _orient_ccw(hull):
+    """Drops the closing point and makes the vertices run counter-clockwise."""
+    pts = np.asarray(hull, dtype=float)
+    if len(pts) > 1 and np.allclose(pts[0], pts[-1]):
+        pts = pts[:-1]
+    x, y = pts[:, 0], pts[:, 1]
+    area = np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)
+    return pts if area > 0 else pts[::-1]
+
+
+def _x_bounds(hull, ys):
+    """
+    For each y, the open interval (low, high) of x strictly inside the
+    convex, counter-clockwise `hull`. Empty rows get low >= high.
+    """
+    ys = np.asarray(ys, dtype=float)
+    low = np.full(ys.shape, -np.inf)
+    high = np.full(ys.shape, np.inf)
+    for (x0, y0), (x1, y1) in zip(hull, np.roll(hull, -1, axis=0)):
+        # Inside means left of the edge: a * x > t
+        a = -(y1 - y0)
+        t = -((x1 - x0) * (ys - y0) + (y1 - y0) * x0)
+        if a > 0:
+            low = np.maximum(low, t / a)
+        elif a < 0:
+            high = np.minimum(high, t / a)
+        else:
+            high = np.where(t < 0, high, -np.inf)
+    return low, high
+
+
+def _key(hull, x_range, y_range, whole_window):
+    data = repr((np.round(hull, 6).tolist(), x_range, y_range, whole_window))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class CropIndex(object):
+    """
+    Valid crop origins: on row y0 + i, every integer x in lo[i]..hi[i].
+
+    Use CropIndex.build or CropIndex.load_or_build rather than calling this
+    directly.
+    """
+
+    def __init__(self, lo, hi, y0, key=None):
+        self.lo = np.asarray(lo, dtype=np.int64)
+        self.hi = np.asarray(hi, dtype=np.int64)
+        self.y0 = y0
+        self.key = key
+        self.counts = np.maximum(self.hi - self.lo + 1, 0)
+        self.cumulative = np.cumsum(self.counts)
+        self.total = int(self.cumulative[-1]) if len(self.cumulative) else 0
+
+    @classmethod
+    def build(cls, hull, x_range, y_range, whole_window=False):
+        """
+        Args:
+            hull (list): vertices of a convex polygon, e.g.
+                himawari_hires.earth_polygon().exterior.coords.
+            x_range, y_range (tuple): inclusive bounds on the origin.
+            whole_window (bool): also require every corner of the
+                CROP_SIZE window below and right of the origin to be inside
+                the polygon, so the crop never touches space.
+        """
+        hull = _orient_ccw(hull)
+        ys = np.arange(y_range[0], y_range[1] + 1)
+        low, high = _x_bounds(hull, ys)
+        if whole_window:
+            # The window runs right (+x) and down the image (-y in Shapely).
+            below_low, below_high = _x_bounds(hull, ys - CROP_SIZE)
+            low = np.maximum(low, below_low)
+            high = np.minimum(high, below_high) - CROP_SIZE
+        # Clip before converting to ints so empty rows (+/-inf) stay empty.
+        lo = np.clip(np.floor(low) + 1, x_range[0], x_range[1] + 1)
+        hi = np.clip(np.ceil(high) - 1, x_range[0] - 1, x_range[1])
+        return cls(lo, hi, y_range[0], key=_key(hull, x_range, y_range, whole_window))
+
+    @classmethod
+    def load_or_build(cls, path, hull, x_range, y_range, whole_window=False):
+        """Loads the index saved at `path` if it was built from the same
+        inputs, otherwise builds it and saves it there."""
+        key = _key(_orient_ccw(hull), x_range, y_range, whole_window)
+        if os.path.exists(path):
+            try:
+                data = np.load(path)
+                if str(data['key']) == key:
+                    return cls(data['lo'], data['hi'], int(data['y0']), key=key)
+                logger.debug("Crop index at %s is stale, rebuilding", path)
+            except Exception:
+                logger.error("Failed to load crop index %s", path, exc_info=True)
+        index = cls.build(hull, x_range, y_range, whole_window=whole_window)
+        index.save(path)
+        return index
+
+    def save(self, path):
+        tmp = path + '.part.npz'
+        np.savez(tmp, lo=self.lo, hi=self.hi, y0=self.y0, key=self.key)
+        os.rename(tmp, path)
+
+    def __len__(self):
+        return self.total
+
+    def __contains__(self, point):
+        x, y = point
+        i = y - self.y0
+        return 0 <= i < len(self.lo) and self.lo[i] <= x <= self.hi[i]
+
+    def _nth(self, n):
+        row = int(np.searchsorted(self.cumulative, n, side='right'))
+        before = int(self.cumulative[row - 1]) if row else 0
+        return (int(self.lo[row]) + n - before, self.y0 + row)
+
+    def sample(self, rng=random):
+        """Returns a uniformly random valid (x, y) origin."""
+        if not self.total:
+            raise ValueError("No valid crop origins")
+        return self._nth(rng.randrange(self.total))
+
+    def sample_many(self, num, rng=np.random):
+        """
+        Returns `num` uniformly random valid origins in one go.
+
+        Returns:
+            tuple: (x, y) integer arrays.
+        """
+        if not self.total:
+            raise ValueError("No valid crop origins")
+        n = rng.randint(0, self.total, num)
+        rows = np.searchsorted(self.cumulative, n, side='right')
+        before = np.where(rows > 0, self.cumulative[rows - 1], 0)
+        return (self.lo[rows] + n - before, self.y0 + rows)
+
+    def sample_weighted(self, weights, cell, height, rng=random):
+        """
+        Returns a random valid (x, y) origin, favouring grid cells with
+        larger weights.
+
+        Args:
+            weights (array): non-negative weight per `cell` x `cell` block of
+                the image, indexed [image row // cell, x // cell] with image
+                rows counting down from the top (image row = height - y).
+            cell (int): size of a weight cell in px.
+            height (int): image height, to flip y into image rows.
+        """
+        weights = np.asarray(weights, dtype=float)
+        rows, cols = weights.shape
+
+        # Valid origins per (row of the index, weight column).
+        col_lo = np.arange(cols) * cell
+        col_hi = col_lo + cell - 1
+        per_col = np.clip(np.minimum(self.hi[:, None], col_hi) -
+                          np.maximum(self.lo[:, None], col_lo) + 1, 0, None)
+        band = np.clip((height - (self.y0 + np.arange(len(self.lo)))) // cell, 0, rows - 1)
+        counts = np.zeros(weights.shape)
+        np.add.at(counts, band, per_col)
+
+        mass = np.cumsum((counts * weights).ravel())
+        if not len(mass) or mass[-1] <= 0:
+            return self.sample(rng)
+        chosen = int(np.searchsorted(mass, rng.random() * mass[-1], side='right'))
+        chosen = min(chosen, len(mass) - 1)
+        band_row, col = divmod(chosen, cols)
+
+        in_band = np.nonzero(band == band_row)[0]
+        options = np.cumsum(per_col[in_band, col])
+        n = rng.randrange(int(options[-1]))
+        i = int(np.searchsorted(options, n, side='right'))
+        before = int(options[i - 1]) if i else 0
+        row = in_band[i]
+        x = max(int(self.lo[row]), int(col_lo[col])) + n - before
+        return (x, self.y0 + int(row))
@@ -0,0 +1,101 @@
+"""
+Scores candidate crop windows on a downsampled copy of a frame so the hires
+bot can pick an interesting region instead of a random one.
+
+Every score comes from summed-area tables, so each candidate costs a handful
+of array lookups however large the window is, and thousands of candidates
+are scored in one vectorized pass.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import logging
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+FULL_SIZE = 5500
+PREVIEW_SIZE = FULL_SIZE // 8
+CROP_SIZE = 720
+
+# Windows darker than this (0-255 mean) are mostly night side or space.
+DARK_LEVEL = 40.0
+# How much cloud-edge density counts relative to brightness variation.
+EDGE_WEIGHT = 2.0
+
+
+def load_preview(frame):
+    """
+    Decodes `frame` at roughly PREVIEW_SIZE px square. JPEGs are decoded at
+    reduced scale directly, so this is far cheaper than a full decode.
+
+    Returns:
+        tuple: (greyscale float array, px of the full frame per preview px)
+    """
+    im = Image.open(frame)
+    full_width = im.size[0]
+    im.draft('L', (PREVIEW_SIZE, PREVIEW_SIZE))
+    im = im.convert('L')
+    if im.size[0] > PREVIEW_SIZE * 2:
+        im = im.resize((PREVIEW_SIZE, PREVIEW_SIZE), Image.BOX)
+    return np.asarray(im, dtype=np.float64), full_width / float(im.size[0])
+
+
+def _summed_area(values):
+    """Summed-area table padded with a leading row and column of zeros."""
+    table = np.zeros((values.shape[0] + 1, values.shape[1] + 1))
+    table[1:, 1:] = values.cumsum(axis=0).cumsum(axis=1)
+    return table
+
+
+def _window_sums(table, top, left, size):
+    bottom, right = top + size, left + size
+    return table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+
+
+def score_windows(preview, scale, lat_px, lng_px, crop_size=CROP_SIZE):
+    """
+    Scores crop windows whose top-left corners are at (lat_px, lng_px) in
+    full-frame px.
+
+    The score is the brightness standard deviation plus EDGE_WEIGHT times
+    the mean gradient magnitude (cloud edges, coastlines), scaled down for
+    windows darker than DARK_LEVEL.
+
+    Returns:
+        array of scores, one per window.
+    """
+    size = max(1, int(round(crop_size / scale)))
+    rows, cols = preview.shape
+    top = np.clip(np.round(np.asarray(lat_px) / scale).astype(int), 0, rows - size)
+    left = np.clip(np.round(np.asarray(lng_px) / scale).astype(int), 0, cols - size)
+
+    edges = np.zeros_like(preview)
+    edges[1:, :] += np.abs(np.diff(preview, axis=0))
+    edges[:, 1:] += np.abs(np.diff(preview, axis=1))
+
+    area = float(size * size)
+    mean = _window_sums(_summed_area(preview), top, left, size) / area
+    mean_sq = _window_sums(_summed_area(preview ** 2), top, left, size) / area
+    std = np.sqrt(np.maximum(mean_sq - mean ** 2, 0))
+    edge = _window_sums(_summed_area(edges), top, left, size) / area
+
+    return (std + EDGE_WEIGHT * edge) * np.minimum(mean / DARK_LEVEL, 1.0)
+
+
+def best_window(frame, lat_px, lng_px):
+    """
+    Returns the (lat_px, lng_px) candidate with the highest score on `frame`.
+
+    Args:
+        frame (str): path to a full disk frame.
+        lat_px, lng_px (array): top-left corners of the candidate windows.
+    """
+    preview, scale = load_preview(frame)
+    scores = score_windows(preview, scale, lat_px, lng_px)
+    best = int(np.argmax(scores))
+    logger.debug("Best of %s windows scored %.1f (median %.1f)",
+                 len(scores), scores[best], np.median(scores))
+    return (int(lat_px[best]), int(lng_px[best]))
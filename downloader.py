@@ -0,0 +1,284 @@
+"""Concurrent, connection-pooled HTTP downloader for satellite frames"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_PER_HOST = 4
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_TIMEOUT = 30
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Leading bytes of the image formats the satellite sites serve.
+IMAGE_SIGNATURES = (
+    b'\x89PNG\r\n\x1a\n',
+    b'\xff\xd8\xff',
+    b'GIF87a',
+    b'GIF89a',
+)
+
+# Statuses worth retrying; anything else is treated as a final answer.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+DownloadJob = namedtuple('DownloadJob', ['url', 'dest'])
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def make_session(pool_size=DEFAULT_WORKERS):
+    """Returns a requests Session whose connection pool can keep `pool_size`
+    keep-alive connections open per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """Returns the process-wide shared Session, creating it on first use."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+        return _session
+
+
+class DownloadStats(object):
+    """Counters for a single download run."""
+
+    def __init__(self):
+        self.downloaded = 0
+        self.skipped = 0
+        self.corrupt = 0
+        self.missing = 0
+        self.failed = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.files = []
+        self.results = []
+
+    @property
+    def frames_per_sec(self):
+        return self.downloaded / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def mb_per_sec(self):
+        return self.bytes / 1048576.0 / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return ("{0} downloaded, {1} skipped, {2} corrupt, {3} missing, {4} failed; "
+                "{5:.1f} MB in {6:.2f}s ({7:.2f} frames/s, {8:.2f} MB/s)").format(
+                    self.downloaded, self.skipped, self.corrupt, self.missing, self.failed,
+                    self.bytes / 1048576.0, self.elapsed,
+                    self.frames_per_sec, self.mb_per_sec)
+
+
+class Downloader(object):
+    """
+    Downloads a batch of URLs to local files using a bounded thread pool.
+
+    Args:
+        session (requests.Session, optional): shared keep-alive session.
+        workers (int): maximum number of downloads in flight.
+        per_host (int): maximum number of concurrent requests to one host.
+        retries (int): attempts after the first one for failed requests.
+        backoff (float): base delay in seconds, doubled on each retry.
+        timeout (float): per-request connect/read timeout in seconds.
+        min_size (int): files smaller than this are considered corrupt; they
+            are deleted after download and re-downloaded if found on disk.
+        chunk_size (int): bytes read from the socket at a time. Only one
+            chunk per download is held in memory.
+        signatures (tuple): accepted leading bytes of the body; anything else
+            is dropped as corrupt. Pass None to accept any content.
+    """
+
+    def __init__(self, session=None, workers=DEFAULT_WORKERS,
+                 per_host=DEFAULT_PER_HOST, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT, min_size=0,
+                 chunk_size=DEFAULT_CHUNK_SIZE, signatures=IMAGE_SIGNATURES):
+        self.session = session or get_session()
+        self.workers = workers
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.min_size = min_size
+        self.chunk_size = chunk_size
+        self.signatures = signatures
+        self._host_limits = {}
+        self._lock = threading.Lock()
+
+    def _host_limit(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_limits[host]
+
+    def _sleep_before_retry(self, attempt):
+        delay = self.backoff * (2 ** attempt)
+        time.sleep(delay + random.uniform(0, delay / 2))
+
+    @contextmanager
+    def _request(self, url, stream=False, headers=None):
+        """
+        GETs `url`, retrying connection errors and 5xx/429 responses with
+        exponential backoff, and yields the final response. A slot of the
+        host's limit is held for each attempt and while the final response
+        is in use, but not during the backoff sleeps.
+        """
+        limit = self._host_limit(url)
+        attempt = 0
+        while True:
+            limit.acquire()
+            try:
+                resp = self.session.get(url, timeout=self.timeout, stream=stream,
+                                        headers=headers)
+            except requests.RequestException:
+                limit.release()
+                if attempt >= self.retries:
+                    raise
+                logger.debug("Request for %s failed, retrying", url, exc_info=True)
+            else:
+                if resp.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    try:
+                        yield resp
+                    finally:
+                        limit.release()
+                    return
+                resp.close()
+                limit.release()
+                logger.debug("Got %s for %s, retrying", resp.status_code, url)
+            self._sleep_before_retry(attempt)
+            attempt += 1
+
+    def get(self, url, headers=None, stream=False):
+        """
+        GETs `url`, retrying connection errors and 5xx/429 responses with
+        exponential backoff. Use as a context manager yielding the final
+        response; the host slot is held until the block exits, so read a
+        streamed body inside it::
+
+            with downloader.get(url, stream=True) as resp:
+                ...
+        """
+        return self._request(url, stream=stream, headers=headers)
+
+    def _valid_start(self, chunk):
+        return self.signatures is None or chunk.startswith(self.signatures)
+
+    def _stream_to_file(self, resp, dest):
+        """
+        Writes the body of `resp` to a temp file next to `dest` one chunk at a
+        time, checking the magic bytes on the first chunk and the size at the
+        end. Only a complete, valid file is renamed into place.
+
+        Returns:
+            int: bytes written, or None if the body was rejected.
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest) or '.',
+                                   prefix='.' + os.path.basename(dest), suffix='.part')
+        nbytes = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                head = b''
+                for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                    if len(head) < 8:
+                        head += chunk[:8 - len(head)]
+                        if len(head) == 8 and not self._valid_start(head):
+                            break
+                    f.write(chunk)
+                    nbytes += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            if nbytes < self.min_size or not self._valid_start(head):
+                logger.debug("Rejected %s (%s bytes, starts %r)", resp.url, nbytes, head)
+                return None
+            os.rename(tmp, dest)
+            tmp = None
+            return nbytes
+        finally:
+            resp.close()
+            if tmp is not None:
+                os.remove(tmp)
+
+    def _is_present(self, dest):
+        return os.path.exists(dest) and os.path.getsize(dest) > self.min_size
+
+    def fetch(self, job):
+        """
+        Downloads a single job.
+
+        Returns:
+            tuple: (status, bytes written) where status is one of 'skipped',
+                'downloaded', 'corrupt', 'missing' (a 404) or 'failed'.
+        """
+        if self._is_present(job.dest):
+            logger.debug("Skipping previously downloaded image %s", job.dest)
+            return ('skipped', 0)
+
+        try:
+            with self._request(job.url, stream=True) as resp:
+                if resp.status_code == 404:
+                    resp.close()
+                    logger.debug("Not found: %s", job.url)
+                    return ('missing', 0)
+                resp.raise_for_status()
+                nbytes = self._stream_to_file(resp, job.dest)
+        except (requests.RequestException, IOError, OSError):
+            logger.error("Failed to download %s", job.url, exc_info=True)
+            return ('failed', 0)
+
+        if nbytes is None:
+            logger.debug("Dropping corrupt image %s", job.url)
+            if os.path.exists(job.dest):
+                os.remove(job.dest)
+            return ('corrupt', 0)
+
+        logger.debug("Successfully downloaded %s", job.url)
+        return ('downloaded', nbytes)
+
+    def download(self, jobs):
+        """
+        Downloads every job, `workers` at a time.
+
+        Args:
+            jobs (list): list of DownloadJob tuples.
+
+        Returns:
+            DownloadStats for the run.
+        """
+        stats = DownloadStats()
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for job, (status, nbytes) in zip(jobs, pool.map(self.fetch, jobs)):
+                setattr(stats, status, getattr(stats, status) + 1)
+                stats.results.append((job, status))
+                if status == 'downloaded':
+                    stats.bytes += nbytes
+                    stats.files.append(job.dest)
+        stats.elapsed = time.time() - start
+        logger.info("Download run: %s", stats)
+        return stats
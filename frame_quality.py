@@ -0,0 +1,275 @@
+"""
+Rejects repeated, blank and partially rendered frames before they're
+encoded.
+
+Each frame is reduced once to a small greyscale thumbnail (JPEGs are
+decoded straight at 1/8 scale), from which a difference hash and a few
+statistics are worked out for all frames at once with NumPy. The results
+are cached in a JSON file keyed by each file's size and mtime, so a run
+only looks at frames it hasn't seen before. A frame is rejected as:
+
+- blank: hardly any contrast anywhere, e.g. all black;
+- partial: a run of flat rows reaching in from the top or bottom edge
+  covers a large share of the frame, as when the bottom of a frame never
+  arrived. Flat rows elsewhere, such as across the night side of the
+  disk, don't count;
+- duplicate: its hash is within DUP_DISTANCE bits of the last kept frame's
+  and its brightness hasn't moved, so nothing changed between the two.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename, exists, join
+
+import numpy as np
+from PIL import Image
+
+from common import load_json, save_json_atomic
+
+logger = logging.getLogger(__name__)
+
+THUMB_SIZE = 64
+# The hash compares neighbouring blocks on a HASH_SIZE square grid.
+HASH_SIZE = 16
+# Standard deviation (in grey levels, 0-255) below which a frame is blank.
+BLANK_STD = 2.0
+# Rows flatter than this are counted as missing...
+ROW_STD = 0.5
+# ...and a frame whose top or bottom edge has a run of missing rows this
+# share of its height is partial.
+PARTIAL_ROWS = 0.2
+DUP_DISTANCE = 4
+DUP_MEAN = 0.5
+DEFAULT_WORKERS = 4
+
+
+def thumbnail(path, size=THUMB_SIZE):
+    """Returns `path` as a `size` x `size` greyscale uint8 array, decoding
+    as little of it as the format allows."""
+    with Image.open(path) as im:
+        im.draft('L', (size, size))
+        return np.asarray(im.convert('L').resize((size, size), Image.BOX))
+
+
+def features(thumbs):
+    """
+    Works out the hash and statistics of a stack of thumbnails.
+
+    Args:
+        thumbs (array): N x THUMB_SIZE x THUMB_SIZE uint8.
+
+    Returns:
+        dict: 'hash' (packed bits, whether each block of a HASH_SIZE grid is
+            brighter than the one to its left), 'mean', 'std' and
+            'edge_rows' (the longer of the runs of flat rows from the top
+            and from the bottom edge, as a share of the height), one per
+            thumbnail.
+    """
+    thumbs = np.asarray(thumbs, dtype=np.float32)
+    n, size = thumbs.shape[:2]
+    step = size // HASH_SIZE
+    blocks = thumbs.reshape(n, HASH_SIZE, step, HASH_SIZE, step).mean(axis=(2, 4))
+    bits = blocks[:, :, 1:] > blocks[:, :, :-1]
+    flat = thumbs.std(axis=2) < ROW_STD
+    # The first row from each edge that isn't flat; argmin gives 0 when all are.
+    runs = np.stack([np.argmin(flat, axis=1), np.argmin(flat[:, ::-1], axis=1)])
+    runs[:, flat.all(axis=1)] = size
+    return {
+        'hash': np.packbits(bits.reshape(n, -1), axis=1),
+        'mean': thumbs.mean(axis=(1, 2)),
+        'std': thumbs.std(axis=(1, 2)),
+        'edge_rows': runs.max(axis=0) / float(size),
+    }
+
+
+def hash_distance(a, b):
+    """Number of bits that differ between two hashes, as hex."""
+    return int(np.unpackbits(np.bitwise_xor(np.frombuffer(bytes.fromhex(a), np.uint8),
+                                            np.frombuffer(bytes.fromhex(b), np.uint8))).sum())
+
+
+def is_duplicate(entry, last):
+    """Whether the frame with features `entry` shows nothing new since the
+    one with features `last`."""
+    return (abs(entry['mean'] - last['mean']) < DUP_MEAN and
+            hash_distance(entry['hash'], last['hash']) <= DUP_DISTANCE)
+
+
+class FilterStats(object):
+    """Counts of the frames kept and rejected by one filter_frames run."""
+
+    def __init__(self):
+        self.kept = 0
+        self.duplicate = 0
+        self.blank = 0
+        self.partial = 0
+        self.unreadable = 0
+
+    @property
+    def rejected(self):
+        return self.duplicate + self.blank + self.partial + self.unreadable
+
+    def counters(self):
+        """The counts as metric counter names and values."""
+        return {'frames_rejected': self.rejected, 'frames_duplicate': self.duplicate,
+                'frames_blank': self.blank, 'frames_partial': self.partial}
+
+    def __str__(self):
+        return ("{0} kept, {1} rejected ({2} duplicate, {3} blank, {4} partial, "
+                "{5} unreadable)").format(self.kept, self.rejected, self.duplicate,
+                                          self.blank, self.partial, self.unreadable)
+
+
+class QualityCache(object):
+    """
+    Args:
+        cache_file (str, optional): where frame features are kept between
+            runs.
+        workers (int): frames thumbnailed at once.
+    """
+
+    def __init__(self, cache_file=None, workers=DEFAULT_WORKERS):
+        self.cache_file = cache_file
+        self.workers = workers
+        self.entries = self._load()
+
+    def _load(self):
+        return load_json(self.cache_file, {})
+
+    def _save(self):
+        if self.cache_file:
+            save_json_atomic(self.cache_file, self.entries, sort_keys=True)
+
+    @staticmethod
+    def _key(path):
+        st = os.stat(path)
+        return '{0}:{1}'.format(st.st_size, int(st.st_mtime))
+
+    @staticmethod
+    def _current(entry, key):
+        # Entries cached before 'edge_rows' replaced 'flat_rows' are redone.
+        return bool(entry) and entry['key'] == key and 'edge_rows' in entry
+
+    def _thumbnail(self, path):
+        try:
+            return thumbnail(path)
+        except Exception:
+            logger.error("Failed to read %s", path, exc_info=True)
+            return None
+
+    def analyze(self, paths):
+        """
+        Returns the features of each of `paths`, working out only the ones
+        not already cached. Entries for frames not in `paths` are dropped.
+
+        Returns:
+            list: a dict per path ('hash' as hex, 'mean', 'std',
+                'edge_rows'), or None if it couldn't be read.
+        """
+        keys = {}
+        for path in paths:
+            try:
+                keys[path] = self._key(path)
+            except OSError:
+                keys[path] = None
+        todo = [p for p in paths if keys[p] is not None and
+                not self._current(self.entries.get(basename(p)), keys[p])]
+        if todo:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                thumbs = list(pool.map(self._thumbnail, todo))
+            read = [(p, t) for p, t in zip(todo, thumbs) if t is not None]
+            if read:
+                found = features(np.stack([t for _, t in read]))
+                for i, (path, _) in enumerate(read):
+                    self.entries[basename(path)] = {
+                        'key': keys[path],
+                        'hash': found['hash'][i].tobytes().hex(),
+                        'mean': round(float(found['mean'][i]), 3),
+                        'std': round(float(found['std'][i]), 3),
+                        'edge_rows': round(float(found['edge_rows'][i]), 3),
+                    }
+        names = set(basename(p) for p in paths)
+        self.entries = {name: entry for name, entry in self.entries.items() if name in names}
+        self._save()
+        found = []
+        for path in paths:
+            entry = self.entries.get(basename(path))
+            found.append(entry if self._current(entry, keys[path]) else None)
+        return found
+
+
+def filter_frames(paths, cache=None):
+    """
+    Drops the blank, partial, duplicate and unreadable frames from `paths`
+    (oldest first).
+
+    Args:
+        paths (list): frame paths.
+        cache (QualityCache, optional): defaults to an in-memory one.
+
+    Returns:
+        tuple: (list of the frames kept, FilterStats)
+    """
+    cache = cache or QualityCache()
+    stats = FilterStats()
+    kept = []
+    last = None
+    for path, entry in zip(paths, cache.analyze(paths)):
+        if entry is None:
+            stats.unreadable += 1
+        elif entry['std'] < BLANK_STD:
+            stats.blank += 1
+        elif entry['edge_rows'] >= PARTIAL_ROWS:
+            stats.partial += 1
+        elif last is not None and is_duplicate(entry, last):
+            stats.duplicate += 1
+        else:
+            kept.append(path)
+            last = entry
+            continue
+        logger.debug("Rejected %s", path)
+    stats.kept = len(kept)
+    logger.info("Frame quality: %s", stats)
+    return kept, stats
+
+
+def check_frames(frames, cache_file, metrics):
+    """
+    filter_frames with the features cached in `cache_file`, timed as the
+    'quality' stage of `metrics` and the rejections counted in it.
+
+    Args:
+        frames (list): frame paths, oldest first.
+        cache_file (str): the bot's QualityCache file.
+        metrics (common.Metrics): the bot's metrics.
+
+    Returns:
+        list: the frames kept.
+    """
+    with metrics.stage('quality'):
+        kept, stats = filter_frames(frames, QualityCache(cache_file))
+    for name, value in stats.counters().items():
+        metrics.incr(name, value)
+    return kept
+
+
+def link_frames(frames, folder):
+    """
+    Fills `folder` with symlinks to `frames` under their own names, for the
+    render scripts that take a folder rather than a list of frames. Anything
+    already in `folder` is removed first.
+
+    Returns:
+        str: `folder`
+    """
+    if exists(folder):
+        for name in os.listdir(folder):
+            os.remove(join(folder, name))
+    else:
+        os.makedirs(folder)
+    for frame in frames:
+        os.symlink(os.path.abspath(frame), join(folder, basename(frame)))
+    return folder
@@ -0,0 +1,336 @@
+"""
+Interchangeable sources of the same frames, each fetch going to whichever
+has lately been fastest.
+
+A FrameSource fetches frames from one place: JMA or CIRA over HTTP, NOAA
+over FTP. SourcePool keeps a running record of each source's latency,
+throughput and error rate in a JSON file, sends each batch to the best
+healthy source, and hands any frames it failed on to the next one. Frames
+a source reports as missing aren't passed on: the source is up, it just
+doesn't have them. So that the others' figures stay current, a source that
+hasn't been measured for PROBE_INTERVAL is given one frame of the batch.
+A source that fails outright is left alone for a cooldown that doubles
+each time it fails again, as frame_store does for missing frames.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import logging
+import time
+from collections import namedtuple
+
+from common import load_json, save_json_atomic
+from downloader import Downloader, DownloadJob
+
+logger = logging.getLogger(__name__)
+
+DOWNLOADED = 'downloaded'
+SKIPPED = 'skipped'
+MISSING = 'missing'
+FAILED = 'failed'
+
+# Weight of the latest fetch in the running averages.
+ALPHA = 0.3
+# A source that fails outright is skipped for COOLDOWN seconds, doubling
+# with each failure in a row up to MAX_COOLDOWN.
+COOLDOWN = 300
+MAX_COOLDOWN = 6 * 3600
+# Floor on the share of frames a source delivers, so one bad run can't
+# make its score infinite.
+MIN_YIELD = 0.05
+# A healthy source not measured for this long gets a frame of the next
+# batch.
+PROBE_INTERVAL = 3600
+# How long an FTP listing is trusted for before it's fetched again.
+LISTING_TTL = 60
+
+# How one frame fared: the source that answered last, its status, and
+# where the frame was saved.
+Fetched = namedtuple('Fetched', ['source', 'status', 'dest'])
+
+
+class FetchStats(object):
+    """Counters for a single SourcePool.fetch."""
+
+    def __init__(self):
+        self.downloaded = 0
+        self.skipped = 0
+        self.missing = 0
+        self.failed = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.results = []
+        self.sources = {}
+
+    def __str__(self):
+        return ("{0} downloaded, {1} skipped, {2} missing, {3} failed; "
+                "{4:.1f} MB in {5:.2f}s from {6}").format(
+                    self.downloaded, self.skipped, self.missing, self.failed,
+                    self.bytes / 1048576.0, self.elapsed,
+                    ', '.join('{0} {1}'.format(n, c) for n, c in sorted(self.sources.items()))
+                    or 'nowhere')
+
+
+class FrameSource(object):
+    """
+    One place frames can be fetched from. Subclasses implement fetch and
+    dest, and list if they can enumerate what they have.
+
+    Args:
+        name (str): identifies the source in the health records.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def dest(self, frame):
+        """Local path `frame` is saved to."""
+        raise NotImplementedError
+
+    def fetch(self, frames):
+        """
+        Returns:
+            tuple: (status per frame, bytes transferred)
+        """
+        raise NotImplementedError
+
+    def list(self):
+        """Returns the frames the source has."""
+        raise NotImplementedError
+
+
+class HttpSource(FrameSource):
+    """
+    Args:
+        name (str)
+        url (callable): frame -> URL.
+        dest (callable): frame -> local path.
+        downloader (Downloader, optional): a 404 or a 'corrupt' download
+            (e.g. JMA's "no image" placeholder, going by its min_size) counts
+            as missing.
+    """
+
+    def __init__(self, name, url, dest, downloader=None):
+        FrameSource.__init__(self, name)
+        self.url = url
+        self._dest = dest
+        self.downloader = downloader or Downloader()
+
+    def dest(self, frame):
+        return self._dest(frame)
+
+    def fetch(self, frames):
+        stats = self.downloader.download([DownloadJob(self.url(f), self.dest(f)) for f in frames])
+        return ([MISSING if status in ('corrupt', MISSING) else status
+                 for _, status in stats.results], stats.bytes)
+
+
+class FtpSource(FrameSource):
+    """
+    Args:
+        name (str)
+        mirror (FtpMirror): of the directory holding the frames.
+        remote_name (callable, optional): frame -> remote file name; frames
+            are remote names by default.
+    """
+
+    def __init__(self, name, mirror, remote_name=None, clock=time.time):
+        FrameSource.__init__(self, name)
+        self.mirror = mirror
+        self.remote_name = remote_name or (lambda frame: frame)
+        self.clock = clock
+        self._listed = None
+
+    def dest(self, frame):
+        return self.mirror.local_path(self.remote_name(frame))
+
+    def list(self):
+        listing = self.mirror.refresh()
+        self._listed = self.clock()
+        return list(listing)
+
+    def fetch(self, frames):
+        if self._listed is None or self.clock() - self._listed > LISTING_TTL:
+            self.list()
+        names = [self.remote_name(f) for f in frames]
+        stats = self.mirror.download([n for n in names if n in self.mirror.listing])
+        found = dict(stats.results)
+        return [found.get(n, MISSING) for n in names], stats.bytes
+
+
+class SourceHealth(object):
+    """
+    Running latency, throughput and error rate of each source.
+
+    Args:
+        health_file (str, optional): where the records are kept between runs.
+        clock (callable): for tests.
+    """
+
+    def __init__(self, health_file=None, clock=time.time):
+        self.health_file = health_file
+        self.clock = clock
+        self.records = self._load()
+
+    def _load(self):
+        return load_json(self.health_file, {})
+
+    def _save(self):
+        if self.health_file:
+            save_json_atomic(self.health_file, self.records, indent=2, sort_keys=True)
+
+    def record(self, name, attempted, failed, nbytes, elapsed):
+        """Folds one fetch of `attempted` frames, `failed` of which failed,
+        into the record of source `name`."""
+        if not attempted:
+            return
+        rec = self.records.setdefault(name, {'fetches': 0, 'failures': 0, 'down_until': 0})
+
+        def average(key, value):
+            rec[key] = value if key not in rec else (1 - ALPHA) * rec[key] + ALPHA * value
+
+        # Seconds per frame delivered, including the time lost on failures;
+        # a run that delivered nothing says nothing about speed.
+        if failed < attempted:
+            average('latency', elapsed / (attempted - failed))
+        average('error_rate', failed / float(attempted))
+        if nbytes and elapsed:
+            average('throughput', nbytes / elapsed)
+        rec['fetches'] += 1
+        rec['updated'] = self.clock()
+        if failed == attempted:
+            rec['failures'] += 1
+            rec['down_until'] = self.clock() + min(COOLDOWN * 2 ** (rec['failures'] - 1),
+                                                   MAX_COOLDOWN)
+            logger.warning("Source %s failed %s time(s) in a row; skipping it for %.0fs", name,
+                           rec['failures'], rec['down_until'] - self.clock())
+        else:
+            rec['failures'] = 0
+            rec['down_until'] = 0
+        self._save()
+
+    def is_up(self, name):
+        return self.records.get(name, {}).get('down_until', 0) <= self.clock()
+
+    def is_stale(self, name, interval=PROBE_INTERVAL):
+        """Whether source `name` hasn't been measured in `interval` seconds."""
+        return self.clock() - self.records.get(name, {}).get('updated', 0) > interval
+
+    def score(self, name):
+        """Expected seconds per frame delivered by source `name`, or None if
+        it has never been tried."""
+        rec = self.records.get(name)
+        if not rec or 'latency' not in rec:
+            return None
+        return rec['latency'] / max(1 - rec['error_rate'], MIN_YIELD)
+
+
+class SourcePool(object):
+    """
+    Args:
+        sources (list): FrameSources for the same frames, in order of
+            preference for sources that haven't been measured yet.
+        health (SourceHealth, optional): defaults to an in-memory one.
+        probe_interval (float, optional): how often to give a frame to each
+            source that isn't first choice; None to only use them when the
+            better ones fail.
+    """
+
+    def __init__(self, sources, health=None, probe_interval=PROBE_INTERVAL):
+        self.sources = list(sources)
+        self.health = health or SourceHealth()
+        self.probe_interval = probe_interval
+
+    def ranked(self):
+        """The sources in the order to try them: healthy ones before those
+        cooling down, then the lowest score, then unmeasured ones in the
+        order given."""
+        def key(item):
+            i, source = item
+            score = self.health.score(source.name)
+            return (not self.health.is_up(source.name), score is None, score or 0, i)
+        return [source for _, source in sorted(enumerate(self.sources), key=key)]
+
+    def _plan(self, ranked, frames):
+        """Splits `frames` into (source, batch) pairs: a frame for each
+        healthy source due a probe, the rest for the best source."""
+        frames = list(frames)
+        probes = []
+        if self.probe_interval is not None:
+            for source in ranked[1:]:
+                if (len(frames) > 1 and self.health.is_up(source.name) and
+                        self.health.is_stale(source.name, self.probe_interval)):
+                    probes.append((source, [frames.pop()]))
+        return [(ranked[0], frames)] + probes
+
+    def _attempt(self, source, frames):
+        start = time.time()
+        try:
+            statuses, nbytes = source.fetch(frames)
+        except Exception:
+            logger.error("Fetching from %s failed", source.name, exc_info=True)
+            statuses, nbytes = [FAILED] * len(frames), 0
+        elapsed = time.time() - start
+        attempted = sum(1 for status in statuses if status != SKIPPED)
+        self.health.record(source.name, attempted, statuses.count(FAILED), nbytes, elapsed)
+        return statuses, nbytes
+
+    def fetch(self, frames):
+        """
+        Fetches `frames` from the best source, passing any it fails on to
+        the next, until every frame is accounted for or the sources run
+        out.
+
+        Returns:
+            FetchStats, with a Fetched per frame in `results`.
+        """
+        stats = FetchStats()
+        start = time.time()
+        ranked = self.ranked()
+        results = {}
+        tried = dict((frame, set()) for frame in frames)
+        queue = self._plan(ranked, frames) if frames else []
+        while queue:
+            source, batch = queue.pop(0)
+            statuses, nbytes = self._attempt(source, batch)
+            stats.bytes += nbytes
+            retry = {}
+            for frame, status in zip(batch, statuses):
+                results[frame] = Fetched(source.name, status, source.dest(frame))
+                tried[frame].add(source.name)
+                if status == DOWNLOADED:
+                    stats.sources[source.name] = stats.sources.get(source.name, 0) + 1
+                elif status == FAILED:
+                    nxt = next((s for s in ranked if s.name not in tried[frame]), None)
+                    if nxt is not None:
+                        retry.setdefault(nxt.name, (nxt, []))[1].append(frame)
+            for nxt, failed in retry.values():
+                logger.info("%s failed on %s frames, trying %s", source.name, len(failed),
+                            nxt.name)
+                queue.append((nxt, failed))
+        stats.results = [results[frame] for frame in frames]
+        for fetched in stats.results:
+            setattr(stats, fetched.status, getattr(stats, fetched.status) + 1)
+        stats.elapsed = time.time() - start
+        logger.info("Fetch run: %s", stats)
+        return stats
+
+    def list(self):
+        """Returns the frames listed by the best source that can list them.
+        Raises the last error if none can."""
+        error = None
+        for source in self.ranked():
+            start = time.time()
+            try:
+                frames = source.list()
+            except NotImplementedError:
+                continue
+            except Exception as e:
+                logger.error("Listing %s failed", source.name, exc_info=True)
+                self.health.record(source.name, 1, 1, 0, time.time() - start)
+                error = e
+                continue
+            return frames
+        if error is not None:
+            raise error
+        raise ValueError("None of the sources can list frames")
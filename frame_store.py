@@ -0,0 +1,195 @@
+"""
+Persistent index of the frames in a rolling window, keyed by capture time.
+
+Each frame is 'present' (downloaded), 'processed' (ready for the GIF) or
+'missing' (the source had nothing usable for it). Missing frames double as
+a negative cache: they aren't asked for again until their backoff expires.
+Retention marks frames 'deleted' rather than dropping them straight away,
+so the next render can see what left the window as well as what joined it.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+PRESENT = 'present'
+PROCESSED = 'processed'
+MISSING = 'missing'
+DELETED = 'deleted'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    captured TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS frames_status ON frames (status, captured);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+# Missing frames are retried after RETRY_BASE seconds, doubling with each
+# failed attempt up to RETRY_MAX.
+RETRY_BASE = 600
+RETRY_MAX = 6 * 3600
+
+
+class FrameStore(object):
+    """
+    Args:
+        path (str): sqlite database file.
+        clock (callable): returns the current time; for tests.
+        retry_base, retry_max (float): backoff schedule for missing frames.
+    """
+
+    def __init__(self, path, clock=time.time, retry_base=RETRY_BASE, retry_max=RETRY_MAX):
+        self.path = path
+        self.clock = clock
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def is_empty(self):
+        return self.db.execute("SELECT 1 FROM frames LIMIT 1").fetchone() is None
+
+    def import_existing(self, frames, status=PROCESSED):
+        """Records (captured, name) pairs already on disk, e.g. when the store
+        is first created next to an existing folder."""
+        now = self.clock()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO frames (captured, name, status, updated) "
+                "VALUES (?, ?, ?, ?)",
+                [(captured, name, status, now) for captured, name in frames])
+
+    def _rows(self, captured):
+        rows = {}
+        for start in range(0, len(captured), 500):
+            chunk = captured[start:start + 500]
+            rows.update((row[0], row[1:]) for row in self.db.execute(
+                "SELECT captured, status, attempts, updated FROM frames "
+                "WHERE captured IN ({0})".format(','.join('?' * len(chunk))), chunk))
+        return rows
+
+    def retry_at(self, attempts, updated):
+        """When a frame that has been missing `attempts` times in a row, last
+        at `updated`, is next worth asking for."""
+        return updated + min(self.retry_base * 2 ** max(attempts - 1, 0), self.retry_max)
+
+    def _is_deferred(self, row, now):
+        status, attempts, updated = row
+        return status == MISSING and self.retry_at(attempts, updated) > now
+
+    def needed(self, frames):
+        """
+        Returns the (captured, name) pairs from `frames` that should be
+        downloaded: unknown, deleted, or missing and due for a retry.
+        """
+        rows = self._rows([c for c, _ in frames])
+        now = self.clock()
+        return [(c, name) for c, name in frames
+                if c not in rows or (rows[c][0] not in (PRESENT, PROCESSED) and
+                                     not self._is_deferred(rows[c], now))]
+
+    def deferred(self, frames):
+        """Returns the (captured, name) pairs from `frames` known to be missing
+        and still backing off."""
+        rows = self._rows([c for c, _ in frames])
+        now = self.clock()
+        return [(c, name) for c, name in frames if c in rows and self._is_deferred(rows[c], now)]
+
+    def mark(self, captured, name, status):
+        """Records the status of a frame. Marking a frame missing again
+        increments its attempt count; any other status resets it."""
+        # INSERT OR IGNORE then UPDATE rather than an upsert, which needs
+        # SQLite 3.24.
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO frames (captured, name, status, attempts, updated) "
+                "VALUES (?, ?, ?, 0, ?)", (captured, name, status, self.clock()))
+            self.db.execute(
+                "UPDATE frames SET name = ?, status = ?, updated = ?, "
+                "attempts = CASE WHEN ? = ? THEN attempts + 1 ELSE 0 END "
+                "WHERE captured = ?",
+                (name, status, self.clock(), status, MISSING, captured))
+
+    def get(self, captured):
+        """Returns (name, status, attempts) for a frame, or None."""
+        return self.db.execute(
+            "SELECT name, status, attempts FROM frames WHERE captured = ?",
+            (captured,)).fetchone()
+
+    def entries(self, statuses=(PRESENT, PROCESSED)):
+        """Returns (captured, name) for frames with one of `statuses`, oldest
+        first."""
+        return self.db.execute(
+            "SELECT captured, name FROM frames WHERE status IN ({0}) ORDER BY captured".format(
+                ','.join('?' * len(statuses))), statuses).fetchall()
+
+    def frames(self, statuses=(PRESENT, PROCESSED)):
+        """Returns the names of frames with one of `statuses`, oldest first."""
+        return [name for _, name in self.entries(statuses)]
+
+    def expire(self, keep):
+        """
+        Marks all but the newest `keep` downloaded frames as deleted, and
+        forgets missing frames older than the ones kept, which will never be
+        asked for again.
+
+        Returns:
+            list: names of the expired frames, for the caller to remove.
+        """
+        rows = self.db.execute(
+            "SELECT captured, name FROM frames WHERE status IN (?, ?) "
+            "ORDER BY captured DESC LIMIT -1 OFFSET ?",
+            (PRESENT, PROCESSED, keep)).fetchall()
+        now = self.clock()
+        with self.db:
+            self.db.executemany(
+                "UPDATE frames SET status = ?, updated = ? WHERE captured = ?",
+                [(DELETED, now, captured) for captured, _ in rows])
+            if rows:
+                self.db.execute(
+                    "DELETE FROM frames WHERE status = ? AND captured < "
+                    "(SELECT MIN(captured) FROM frames WHERE status IN (?, ?))",
+                    (MISSING, PRESENT, PROCESSED))
+        return [name for _, name in rows]
+
+    def _last_render(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'last_render'").fetchone()
+        return float(row[0]) if row else 0.0
+
+    def changed_since_render(self):
+        """
+        Returns:
+            dict: 'added' (processed since the last render) and 'removed'
+                (expired since the last render) frame names, oldest first.
+        """
+        since = self._last_render()
+        changes = {}
+        for key, status in (('added', PROCESSED), ('removed', DELETED)):
+            changes[key] = [row[0] for row in self.db.execute(
+                "SELECT name FROM frames WHERE status = ? AND updated > ? ORDER BY captured",
+                (status, since))]
+        return changes
+
+    def mark_rendered(self):
+        """Records a render, and forgets frames that had expired before it."""
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_render', ?)",
+                (repr(self.clock()),))
+            self.db.execute("DELETE FROM frames WHERE status = ?", (DELETED,))
@@ -1,17 +1,42 @@
 import datetime
-from ftplib import FTP
+import logging
 import os
 from os.path import abspath, dirname, join
 import shlex
 import subprocess
-import time
 
-from common import get_api, set_up_logging
+from common import Metrics, lazy_import, set_up_logging, set_up_metrics
+from frame_sources import FtpSource, SourceHealth, SourcePool
+from ftp_mirror import FtpMirror
 
+frame_quality = lazy_import('frame_quality')
+uploader = lazy_import('uploader')
+
+logger = logging.getLogger(__name__)
+metrics = Metrics('ftp')
 
 BASE_DIR = dirname(abspath(__file__))
 LOGFILE = join(BASE_DIR, 'lowres.log')
+METRICS_FILE = join(BASE_DIR, 'metrics.jsonl')
 LOWRES_FOLDER = join(BASE_DIR, 'lowres/')
+FTP_HOST = 'ftp.nnvl.noaa.gov'
+FTP_PATH = 'GOES/HIMAWARI/simplecontrast'
+FTP_LISTING = join(BASE_DIR, 'ftp_listing.json')
+# Servers with NOAA's frames, as (host, path, listing cache); each run lists
+# and downloads from the fastest healthy one, failing over to the rest.
+# See frame_sources.
+FTP_MIRRORS = ((FTP_HOST, FTP_PATH, FTP_LISTING),)
+SOURCE_HEALTH = join(BASE_DIR, 'source_health_ftp.json')
+QUALITY_CACHE = join(BASE_DIR, 'quality_ftp.json')
+RENDER_FOLDER = join(BASE_DIR, 'render_frames_ftp')
+
+# Skip rendering and tweeting when the mirror found no new frames.
+SKIP_IF_UNCHANGED = True
+
+# Leave repeated, blank and partial frames out of the GIF; see frame_quality.
+FILTER_FRAMES = True
+
+_pool = None
 
 
 def round_time_10(dt):
@@ -26,36 +51,51 @@ def round_time_10(dt):
     return rounded_date
 
 
-def download_images(num=48):
+def local_name(image):
+    # Local copies are stored without the colons in NOAA's file names.
+    return image.replace(':', '')
+
+
+def get_source_pool():
+    """Returns the module's pool of FTP_MIRRORS. Under the scheduler it, and
+    its FTP connections, are reused from one run to the next."""
+    global _pool
+    if _pool is None:
+        _pool = SourcePool([FtpSource(host, FtpMirror(host, path, LOWRES_FOLDER,
+                                                      listing_file=listing,
+                                                      local_name=local_name))
+                            for host, path, listing in FTP_MIRRORS],
+                           SourceHealth(SOURCE_HEALTH))
+    return _pool
+
+
+def download_images(num=48, mirror=None, pool=None):
     """
     Downloads the most recent `num` images.
 
+    Args:
+        mirror (FtpMirror, optional): use just this mirror.
+        pool (SourcePool, optional): defaults to get_source_pool().
+
     Returns:
-        ISO date of last image.
+        tuple: (ISO date of the last image, SourcePool FetchStats)
     """
-    with FTP("ftp.nnvl.noaa.gov") as ftp:
-        ftp.login()
-        ftp.cwd('GOES/HIMAWARI/simplecontrast')
-        images = list(reversed(sorted(list(ftp.nlst()))))  # ridiculous
-
-        logger.debug('downloading images')
-        rounded_now = round_time_10(datetime.datetime.utcnow())
-        logger.debug('rounded time is {0}'.format(rounded_now))
-        logger.debug('images: {0}'.format(str(images)))
-
-        old_images = os.listdir(LOWRES_FOLDER)
-        logger.debug('old_images: {0}'.format(old_images))
-
-        # import pdb; pdb.set_trace()
-        for image in images[:num]:
-            if image in old_images:
-                logger.debug('skipping {0}'.format(image))
-                continue
-            elif os.path.splitext(image)[1] != '.JPG':
-                continue
-            logger.debug('downloading {0}'.format(image))
-            ftp.retrbinary('RETR {0}'.format(image), open(join(LOWRES_FOLDER, image.replace(':', '')), 'wb').write)
-        return rounded_now.isoformat()
+    if mirror is not None:
+        pool = SourcePool([FtpSource(mirror.host, mirror)])
+    pool = pool or get_source_pool()
+    rounded_now = round_time_10(datetime.datetime.utcnow())
+    logger.debug('rounded time is {0}'.format(rounded_now))
+
+    listing = pool.list()
+    images = sorted((image for image in listing if os.path.splitext(image)[1] == '.JPG'),
+                    reverse=True)[:num]
+    logger.debug('downloading images: {0}'.format(images))
+    stats = pool.fetch(images)
+    metrics.incr('bytes_downloaded', stats.bytes)
+    metrics.incr('frames_downloaded', stats.downloaded)
+    for source, count in stats.sources.items():
+        metrics.incr('frames_from_' + source, count)
+    return rounded_now.isoformat(), stats
 
 
 def delete_old_images(num=48):
@@ -78,38 +118,63 @@ def delete_old_images(num=48):
 
 
 def images_to_gif():
+    """Renders the downloaded frames with giffer_2.sh, which is given a
+    folder of links to the ones that pass frame_quality.check_frames if
+    FILTER_FRAMES. Returns None if no frames passed or the script failed."""
     logger.debug('creating GIF')
-    cmd = ("{0}/giffer_2.sh {1} {0}/gif.mp4".format(BASE_DIR, LOWRES_FOLDER))
+    folder = LOWRES_FOLDER
+    if FILTER_FRAMES:
+        frames = [join(LOWRES_FOLDER, image) for image in sorted(os.listdir(LOWRES_FOLDER))
+                  if os.path.splitext(image)[1] == '.JPG']
+        frames = frame_quality.check_frames(frames, QUALITY_CACHE, metrics)
+        if not frames:
+            logger.warning('No frames to render')
+            return None
+        folder = frame_quality.link_frames(frames, RENDER_FOLDER)
+    out = join(BASE_DIR, 'gif.mp4')
+    if os.path.exists(out):
+        os.remove(out)
+    cmd = ("{0}/giffer_2.sh {1} {2}".format(BASE_DIR, folder, out))
     logger.debug(cmd)
-    subprocess.call(shlex.split(cmd))
-    return os.path.realpath("{0}/gif.mp4".format(BASE_DIR))
+    code = subprocess.call(shlex.split(cmd))
+    if code != 0 or not os.path.exists(out):
+        logger.error('giffer_2.sh exited with {0}'.format(code))
+        return None
+    return os.path.realpath(out)
 
 
 def tweet_gif(gif, status):
     logger.debug("Starting to tweet")
-    api = get_api()
-    uploaded_gif = api.UploadMediaChunked(media=gif)
-    logger.debug('media ID: {0}'.format(uploaded_gif))
-    status = api.PostUpdate(status=status, media=uploaded_gif)
+    status = uploader.post_media(status, gif)
     logger.debug('Finished tweet: {0}'.format(status))
     return status
 
 
 def main():
-    date_time = download_images(num=220)
-    delete_old_images(num=220)
-    gif = images_to_gif()
-    tweet_gif(gif, date_time)
-    os.remove(gif)
+    try:
+        with metrics.stage('download'):
+            date_time, stats = download_images(num=220)
+        with metrics.stage('cleanup'):
+            delete_old_images(num=220)
+        if SKIP_IF_UNCHANGED and not stats.downloaded:
+            logger.info("No new frames; not tweeting")
+            return
+        with metrics.stage('render_gif'):
+            gif = images_to_gif()
+        if gif is None:
+            logger.info("Nothing rendered; not tweeting")
+            return
+        metrics.gauge('gif_bytes', os.path.getsize(gif))
+        with metrics.stage('tweet'):
+            tweet_gif(gif, date_time)
+        os.remove(gif)
+    finally:
+        metrics.flush()
 
 
 if __name__ == '__main__':
-    import logging
+    # Runs once; scheduler.py runs this every three hours.
     logger = set_up_logging(log_file=LOGFILE, level=logging.DEBUG)
+    set_up_metrics(metrics_file=METRICS_FILE)
     logger.info('Started program')
-    while True:
-        try:
-            main()
-        except:
-            pass
-        time.sleep(10800)
+    main()
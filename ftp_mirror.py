@@ -0,0 +1,333 @@
+"""
+One-way mirror of a remote FTP directory over a single reusable connection.
+
+The remote listing is cached in a JSON file between runs, so each sync only
+has to look at entries that are new or whose size/modification time changed.
+MLSD is used for the listing when the server supports it; otherwise the
+mirror falls back to NLST and asks SIZE/MDTM for new entries only.
+Downloads go to `<name>.part` next to the destination and are resumed with
+REST after a dropped connection, then renamed into place once complete.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import ftplib
+import logging
+import os
+import time
+from collections import namedtuple
+
+from common import PART_SUFFIX, load_json, save_json_atomic
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 2
+DEFAULT_BLOCKSIZE = 64 * 1024
+# A connection used more recently than this is assumed to still be up;
+# older ones are checked with a NOOP before reuse.
+KEEPALIVE_CHECK = 60
+
+# size (int) and modified (str, YYYYMMDDHHMMSS) are None when unknown.
+RemoteFile = namedtuple('RemoteFile', ['size', 'modified'])
+
+# Errors after which the connection can't be trusted and is reopened.
+CONNECTION_ERRORS = (ftplib.error_temp, ftplib.error_reply, EOFError, IOError, OSError)
+
+
+class MirrorStats(object):
+    """Counters for a single sync."""
+
+    def __init__(self):
+        self.downloaded = 0
+        self.resumed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.files = []
+        self.results = []
+
+    def __str__(self):
+        return ("{0} downloaded ({1} resumed), {2} skipped, {3} failed; "
+                "{4:.1f} MB in {5:.2f}s").format(
+                    self.downloaded, self.resumed, self.skipped, self.failed,
+                    self.bytes / 1048576.0, self.elapsed)
+
+
+class FtpMirror(object):
+    """
+    Args:
+        host (str): FTP server.
+        path (str): remote directory to mirror.
+        dest (str): local directory.
+        port (int): FTP port.
+        user, passwd (str): login; anonymous by default.
+        timeout (float): socket timeout in seconds.
+        retries (int): reconnect-and-resume attempts per file after the first.
+        listing_file (str, optional): where to cache the remote listing
+            between runs.
+        local_name (callable, optional): maps a remote name to the local
+            file name, e.g. to strip characters that trip up ffmpeg.
+        blocksize (int): bytes read from the data connection at a time.
+    """
+
+    def __init__(self, host, path, dest, port=21, user='anonymous', passwd='',
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, listing_file=None,
+                 local_name=None, blocksize=DEFAULT_BLOCKSIZE):
+        self.host = host
+        self.path = path
+        self.dest = dest
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.timeout = timeout
+        self.retries = retries
+        self.listing_file = listing_file
+        self.local_name = local_name or (lambda name: name)
+        self.blocksize = blocksize
+        self.ftp = None
+        self.connects = 0
+        self._last_used = 0.0
+        # None until we know whether the server does MLSD / REST.
+        self._mlsd = None
+        self._rest = None
+        self.listing = self._load_listing()
+        self._changed = set()
+
+    def _load_listing(self):
+        try:
+            return {name: RemoteFile(*entry)
+                    for name, entry in load_json(self.listing_file, {}).items()}
+        except (AttributeError, TypeError):
+            logger.warning("Ignoring malformed listing cache %s", self.listing_file,
+                           exc_info=True)
+            return {}
+
+    def _save_listing(self):
+        if self.listing_file:
+            save_json_atomic(self.listing_file,
+                             {name: list(entry) for name, entry in self.listing.items()},
+                             sort_keys=True)
+
+    def connect(self):
+        """Returns a logged-in FTP connection in the mirrored directory,
+        reusing the previous one if the server still answers a NOOP."""
+        if self.ftp is not None:
+            try:
+                if time.time() - self._last_used > KEEPALIVE_CHECK:
+                    self.ftp.voidcmd('NOOP')
+                self._last_used = time.time()
+                return self.ftp
+            except ftplib.all_errors:
+                logger.debug("FTP connection to %s went stale, reconnecting", self.host)
+                self.close()
+
+        ftp = ftplib.FTP(timeout=self.timeout)
+        try:
+            ftp.connect(self.host, self.port)
+            ftp.login(self.user, self.passwd)
+            ftp.cwd(self.path)
+        except ftplib.all_errors:
+            ftp.close()
+            raise
+        self.ftp = ftp
+        self.connects += 1
+        self._last_used = time.time()
+        logger.debug("Connected to %s:%s%s", self.host, self.port, self.path)
+        return ftp
+
+    def close(self):
+        if self.ftp is None:
+            return
+        try:
+            self.ftp.quit()
+        except ftplib.all_errors:
+            self.ftp.close()
+        self.ftp = None
+
+    def _list_mlsd(self, ftp):
+        return {name: RemoteFile(int(facts['size']) if 'size' in facts else None,
+                                 facts.get('modify'))
+                for name, facts in ftp.mlsd(facts=['type', 'size', 'modify'])
+                if facts.get('type', 'file') == 'file'}
+
+    def _list_nlst(self, ftp):
+        # NLST has no metadata, so unchanged names keep what we already know
+        # and new ones are filled in by stat() when they're needed.
+        return {name: self.listing.get(name, RemoteFile(None, None))
+                for name in ftp.nlst()}
+
+    def _list(self):
+        ftp = self.connect()
+        if self._mlsd is not False:
+            try:
+                listing = self._list_mlsd(ftp)
+                self._mlsd = True
+                return listing
+            except ftplib.error_perm:
+                logger.debug("%s doesn't support MLSD, falling back to NLST", self.host)
+                self._mlsd = False
+        return self._list_nlst(ftp)
+
+    def refresh(self):
+        """
+        Fetches the remote listing and updates the cache.
+
+        Returns:
+            dict: remote name -> RemoteFile for everything in the directory.
+        """
+        try:
+            listing = self._list()
+        except CONNECTION_ERRORS:
+            logger.debug("Listing %s failed, reconnecting", self.host, exc_info=True)
+            self.close()
+            listing = self._list()
+
+        self._changed = set(name for name, entry in listing.items()
+                            if self.listing.get(name) != entry)
+        logger.debug("%s entries listed, %s new or changed", len(listing), len(self._changed))
+        self.listing = listing
+        self._save_listing()
+        return listing
+
+    def stat(self, name):
+        """Returns the RemoteFile for `name`, asking SIZE/MDTM if the listing
+        didn't say."""
+        entry = self.listing.get(name, RemoteFile(None, None))
+        if entry.size is not None:
+            return entry
+        ftp = self.connect()
+        size, modified = None, entry.modified
+        try:
+            # Listings switch the connection to ASCII, where SIZE is refused.
+            ftp.voidcmd('TYPE I')
+            size = ftp.size(name)
+            modified = ftp.sendcmd('MDTM {0}'.format(name))[4:].strip()
+        except ftplib.error_perm:
+            logger.debug("No SIZE/MDTM for %s", name)
+        entry = RemoteFile(size, modified)
+        self.listing[name] = entry
+        return entry
+
+    def local_path(self, name):
+        return os.path.join(self.dest, self.local_name(name))
+
+    def _is_current(self, name):
+        """Whether the local copy of `name` can be kept."""
+        path = self.local_path(name)
+        if not os.path.exists(path):
+            return False
+        if name not in self._changed:
+            return True
+        # New to the cache (e.g. the first run), so check it against the
+        # remote size rather than fetching it again.
+        size = self.stat(name).size
+        return size is None or size == os.path.getsize(path)
+
+    def _retrieve(self, name, part, offset):
+        ftp = self.connect()
+        with open(part, 'ab' if offset else 'wb') as f:
+            ftp.retrbinary('RETR {0}'.format(name), f.write, self.blocksize,
+                           rest=offset or None)
+
+    def fetch(self, name):
+        """
+        Downloads `name`, resuming from a previous partial download if there
+        is one.
+
+        Returns:
+            tuple: (status, bytes transferred) where status is one of
+                'skipped', 'downloaded', 'resumed' or 'failed'.
+        """
+        if self._is_current(name):
+            return ('skipped', 0)
+
+        path = self.local_path(name)
+        part = path + PART_SUFFIX
+        size = self.stat(name).size
+        resumed = False
+        nbytes = 0
+        attempt = 0
+        while True:
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if offset and (self._rest is False or size is None or offset > size):
+                offset = 0
+            try:
+                # A complete .part left by a run that died before the rename
+                # only needs renaming.
+                if size is None or offset < size or not os.path.exists(part):
+                    self._retrieve(name, part, offset)
+                if offset:
+                    self._rest = resumed = True
+                nbytes += os.path.getsize(part) - offset
+                break
+            except ftplib.error_perm:
+                if not offset:
+                    logger.error("Failed to download %s", name, exc_info=True)
+                    return ('failed', nbytes)
+                # Most likely REST isn't supported; start over from scratch.
+                logger.debug("Resume of %s refused, restarting", name, exc_info=True)
+                self._rest = False
+            except CONNECTION_ERRORS:
+                logger.debug("Transfer of %s interrupted", name, exc_info=True)
+                self.close()
+                if os.path.exists(part):
+                    nbytes += os.path.getsize(part) - offset
+                if attempt >= self.retries:
+                    logger.error("Failed to download %s", name, exc_info=True)
+                    return ('failed', nbytes)
+                attempt += 1
+
+        if size is not None and os.path.getsize(part) != size:
+            logger.error("Size mismatch for %s: got %s of %s bytes", name,
+                         os.path.getsize(part), size)
+            os.remove(part)
+            return ('failed', nbytes)
+        os.rename(part, path)
+        logger.debug("Successfully downloaded %s", name)
+        return ('resumed' if resumed else 'downloaded', nbytes)
+
+    def _remove_stale_parts(self, keep):
+        # Only the mirror's own partials: dest may be shared with other
+        # downloaders whose in-flight temp files also end in .part.
+        keep = set(keep)
+        for name in self.listing:
+            if name in keep:
+                continue
+            part = os.path.join(self.dest, self.local_name(name) + PART_SUFFIX)
+            if os.path.exists(part):
+                logger.debug("Removing abandoned partial download %s", part)
+                os.remove(part)
+
+    def download(self, names):
+        """
+        Makes sure every remote file in `names` is present locally. Partial
+        downloads of files no longer asked for are removed.
+
+        Returns:
+            MirrorStats for the run.
+        """
+        stats = MirrorStats()
+        start = time.time()
+        for name in names:
+            try:
+                status, nbytes = self.fetch(name)
+            except ftplib.all_errors:
+                logger.error("Failed to download %s", name, exc_info=True)
+                self.close()
+                status, nbytes = 'failed', 0
+            stats.bytes += nbytes
+            if status == 'resumed':
+                stats.resumed += 1
+                status = 'downloaded'
+            setattr(stats, status, getattr(stats, status) + 1)
+            stats.results.append((name, status))
+            if status == 'downloaded':
+                stats.files.append(self.local_path(name))
+        self._remove_stale_parts(names)
+        # stat() may have filled in sizes for new entries.
+        self._save_listing()
+        stats.elapsed = time.time() - start
+        logger.info("FTP sync: %s", stats)
+        return stats
@@ -1,7 +1,19 @@
+import numpy as np
 import pyproj
 
 
-sat = pyproj.Proj('+proj=geos +lon_0=140.7 +h=35786369.500000000')
+SAT_PROJ = '+proj=geos +lon_0=140.7 +h=35786369.500000000'
+
+_sat = None
+
+
+def get_sat():
+    """Returns the Himawari-8 geostationary projection, built the first time
+    it's needed."""
+    global _sat
+    if _sat is None:
+        _sat = pyproj.Proj(SAT_PROJ)
+    return _sat
 
 
 def lat_long_to_px(lat=None, lng=None):
@@ -18,7 +30,7 @@ def lat_long_to_px(lat=None, lng=None):
 
     >>> lat_long_to_px(lat=35.255679, lng=139.740923) => (983, 2708)
     """
-    x, y = sat(lng, lat, radians=False, errcheck=True)
+    x, y = get_sat()(lng, lat, radians=False, errcheck=True)
     lng_px = round((x * 2.7188 / 5417) + 2750)
     lat_px = round(-(y * 2.709 / 5417)) + 2750
     return (lat_px, lng_px)
@@ -52,7 +64,7 @@ def km_to_lat_lng(lat_km=None, lng_km=None):
     Returns:
         tuple: real-life latitude and longitude coordinates.
     """
-    lng, lat = sat(lng_km, lat_km, radians=False, errcheck=True, inverse=True)
+    lng, lat = get_sat()(lng_km, lat_km, radians=False, errcheck=True, inverse=True)
     return(-lat, lng)
 
 
@@ -75,3 +87,73 @@ def px_to_lat_long(lat, lng):
         return lat, lng
     except:
         return ("Space, Space")
+
+
+# Array versions of the conversions above. Each takes scalars or array-likes
+# and returns NumPy arrays, so a whole grid of points costs one pyproj call.
+
+def lat_long_to_px_array(lat, lng):
+    """
+    Array version of lat_long_to_px.
+
+    Args:
+        lat (array-like): latitude coordinates
+        lng (array-like): longitude coordinates
+
+    Returns:
+        tuple of integer arrays: (lat_px, lng_px). Points not visible from
+        the satellite raise, as with lat_long_to_px.
+    """
+    x, y = get_sat()(np.asarray(lng, dtype=float), np.asarray(lat, dtype=float),
+                     radians=False, errcheck=True)
+    lng_px = np.rint((x * 2.7188 / 5417) + 2750).astype(int)
+    lat_px = np.rint(-(y * 2.709 / 5417)).astype(int) + 2750
+    return (lat_px, lng_px)
+
+
+def px_to_km_array(lat_px, lng_px):
+    """Array version of px_to_km."""
+    return px_to_km(np.asarray(lat_px, dtype=float), np.asarray(lng_px, dtype=float))
+
+
+def km_to_lat_lng_array(lat_km, lng_km):
+    """
+    Array version of km_to_lat_lng. Points off the edge of the Earth come
+    back as NaN rather than raising.
+    """
+    lng, lat = get_sat()(np.asarray(lng_km, dtype=float), np.asarray(lat_km, dtype=float),
+                         radians=False, errcheck=False, inverse=True)
+    lat = np.where(np.isfinite(lat), -lat, np.nan)
+    lng = np.where(np.isfinite(lng), lng, np.nan)
+    return (lat, lng)
+
+
+def px_to_lat_long_array(lat_px, lng_px):
+    """
+    Array version of px_to_lat_long. Pixels in space come back as NaN.
+
+    >>> px_to_lat_long_array([983, 10], [2708, 10])
+    (array([35.25565507, nan]), array([139.740901, nan]))
+    """
+    return km_to_lat_lng_array(*px_to_km_array(lat_px, lng_px))
+
+
+def lat_long_grid(step=1, size=5500, dtype=np.float32):
+    """
+    Latitude and longitude of every `step`th pixel of the full disk image,
+    for use as a lookup table. Computed a band of rows at a time so the
+    float64 temporaries stay small; at step=1 the result is two 5500x5500
+    arrays (about 240MB as float32).
+
+    Returns:
+        tuple: (lat, lng) arrays indexed [lat_px // step, lng_px // step],
+            NaN in space.
+    """
+    coords = np.arange(0, size, step)
+    lat = np.empty((len(coords), len(coords)), dtype=dtype)
+    lng = np.empty_like(lat)
+    band = max(1, 2 ** 20 // len(coords))
+    for start in range(0, len(coords), band):
+        rows, cols = np.meshgrid(coords[start:start + band], coords, indexing='ij')
+        lat[start:start + band], lng[start:start + band] = px_to_lat_long_array(rows, cols)
+    return (lat, lng)
@@ -0,0 +1,194 @@
+"""
+Rolling GIF builder for the lowres bot.
+
+mp4_to_gif.sh runs ffmpeg twice over every frame on every run: once to
+generate a palette, once to quantize and encode. Here the palette is cached
+and only rebuilt when a new frame no longer fits it, and each frame is
+quantized and LZW-encoded once into a cached GIF block. Building the GIF is
+then a matter of concatenating the cached blocks for the current window.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import hashlib
+import json
+import logging
+import os
+import time
+from io import BytesIO
+from os.path import basename, exists, getmtime, join
+
+from PIL import Image, ImageChops, ImageStat
+
+logger = logging.getLogger(__name__)
+
+# mp4_to_gif.sh renders at 8 fps.
+FRAME_MS = 125
+# Rebuild the palette once a new frame quantizes this much worse than the
+# frames the palette was built from.
+DRIFT_RATIO = 1.25
+# Frames sampled to build a palette, and the size they're sampled at.
+PALETTE_SAMPLE = 8
+SAMPLE_SIZE = 128
+
+GIF_TRAILER = b';'
+# NETSCAPE2.0 application extension: loop forever.
+LOOP_FOREVER = b'!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00'
+
+
+def _split_gif(data):
+    """Splits a single frame GIF into (header, frame block): the header is the
+    signature, screen descriptor and global palette; the block is the
+    graphic control extension, image descriptor and image data."""
+    if data[-1:] != GIF_TRAILER:
+        raise ValueError("Not a complete GIF")
+    flags = bytearray(data[10:11])[0]
+    header_len = 13 + (3 * 2 ** ((flags & 7) + 1) if flags & 0x80 else 0)
+    return data[:header_len], data[header_len:-1]
+
+
+def _write_atomic(path, data):
+    tmp = path + '.part'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+class GifBuilder(object):
+    """
+    Args:
+        cache_dir (str): where the palette and encoded frames are kept.
+        frame_ms (int): display time of each frame.
+        drift_ratio (float): see DRIFT_RATIO.
+    """
+
+    def __init__(self, cache_dir, frame_ms=FRAME_MS, drift_ratio=DRIFT_RATIO):
+        self.cache_dir = cache_dir
+        self.frame_ms = frame_ms
+        self.drift_ratio = drift_ratio
+        self.meta_file = join(cache_dir, 'meta.json')
+        self.palette = None
+        self.meta = {}
+        if not exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._load_palette()
+
+    def _load_palette(self):
+        if not exists(self.meta_file):
+            return
+        with open(self.meta_file) as f:
+            self.meta = json.load(f)
+        self.palette = Image.open(join(self.cache_dir, 'palette.png'))
+        self.palette.load()
+
+    def _error(self, im):
+        """Mean per-channel error of quantizing a thumbnail of `im` to the
+        current palette."""
+        thumb = im.convert('RGB').resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.BOX)
+        quantized = thumb.quantize(palette=self.palette, dither=Image.NONE).convert('RGB')
+        return sum(ImageStat.Stat(ImageChops.difference(thumb, quantized)).mean) / 3.0
+
+    def build_palette(self, frames):
+        """Builds a 256 colour palette from an even sample of `frames`."""
+        step = max(1, len(frames) // PALETTE_SAMPLE)
+        sample = frames[::step][:PALETTE_SAMPLE]
+        montage = Image.new('RGB', (SAMPLE_SIZE * len(sample), SAMPLE_SIZE))
+        thumbs = []
+        for idx, frame in enumerate(sample):
+            thumb = Image.open(frame).convert('RGB').resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.BOX)
+            montage.paste(thumb, (idx * SAMPLE_SIZE, 0))
+            thumbs.append(thumb)
+
+        self.palette = montage.quantize(colors=256, method=Image.MEDIANCUT)
+        palette_id = hashlib.sha1(self.palette.palette.tobytes()).hexdigest()[:12]
+        self.palette.save(join(self.cache_dir, 'palette.png'))
+        self.meta = {
+            'palette_id': palette_id,
+            'baseline_error': sum(self._error(t) for t in thumbs) / len(thumbs),
+        }
+        _write_atomic(self.meta_file, json.dumps(self.meta).encode('utf-8'))
+        logger.debug("Built palette %s from %s frames", palette_id, len(sample))
+
+    def _block_path(self, frame):
+        return join(self.cache_dir, "{0}.{1}.blk".format(basename(frame), self.meta['palette_id']))
+
+    def _header_path(self):
+        return join(self.cache_dir, "header.{0}.bin".format(self.meta['palette_id']))
+
+    def _encode(self, im):
+        quantized = im.convert('RGB').quantize(palette=self.palette, dither=Image.FLOYDSTEINBERG)
+        buf = BytesIO()
+        quantized.save(buf, 'GIF', duration=self.frame_ms, optimize=False)
+        header, block = _split_gif(buf.getvalue())
+        header_path = self._header_path()
+        if not exists(header_path):
+            _write_atomic(header_path, header)
+        else:
+            with open(header_path, 'rb') as f:
+                if f.read() != header:
+                    raise ValueError("Frame doesn't match the cached GIF header")
+        return block
+
+    def _prune(self, keep):
+        for name in os.listdir(self.cache_dir):
+            stale_block = name.endswith('.blk') and name not in keep
+            stale_header = (name.startswith('header.') and
+                            name != basename(self._header_path()))
+            if stale_block or stale_header:
+                os.remove(join(self.cache_dir, name))
+
+    def _blocks(self, frames, stats):
+        """Returns the encoded block of every frame, encoding only new ones.
+        Returns None if a new frame has drifted from the palette."""
+        blocks = []
+        for frame in frames:
+            path = self._block_path(frame)
+            if exists(path) and getmtime(path) >= getmtime(frame):
+                with open(path, 'rb') as f:
+                    blocks.append(f.read())
+                stats['reused'] += 1
+                continue
+
+            im = Image.open(frame)
+            if not stats['palette_rebuilt'] and \
+                    self._error(im) > self.meta['baseline_error'] * self.drift_ratio:
+                logger.debug("%s drifted from palette %s", frame, self.meta['palette_id'])
+                return None
+            block = self._encode(im)
+            _write_atomic(path, block)
+            blocks.append(block)
+            stats['encoded'] += 1
+        return blocks
+
+    def build(self, frames, out):
+        """
+        Writes an animated GIF of `frames` (oldest first) to `out`.
+
+        Returns:
+            dict: frames reused from cache, frames encoded, whether the
+                palette was rebuilt, and wall/CPU seconds taken.
+        """
+        start, cpu_start = time.time(), time.process_time()
+        stats = {'frames': len(frames), 'reused': 0, 'encoded': 0, 'palette_rebuilt': False}
+        if not frames:
+            raise ValueError("No frames to build a GIF from")
+
+        if self.palette is None:
+            self.build_palette(frames)
+            stats['palette_rebuilt'] = True
+        blocks = self._blocks(frames, stats)
+        if blocks is None:
+            self.build_palette(frames)
+            stats['palette_rebuilt'] = True
+            stats['reused'] = stats['encoded'] = 0
+            blocks = self._blocks(frames, stats)
+
+        self._prune(set(basename(self._block_path(frame)) for frame in frames))
+        with open(self._header_path(), 'rb') as f:
+            header = f.read()
+        _write_atomic(out, header + LOOP_FOREVER + b''.join(blocks) + GIF_TRAILER)
+
+        stats['seconds'] = time.time() - start
+        stats['cpu_seconds'] = time.process_time() - cpu_start
+        logger.info("Built %s: %s", out, stats)
+        return stats
@@ -9,30 +9,64 @@
 from __future__ import print_function, unicode_literals, absolute_import
 
 import os
-from os.path import abspath, dirname, join, getsize
+from os.path import abspath, dirname, join
 
 import imghdr
-import random
-import re
+import logging
+import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from PIL import Image
-
-from bs4 import BeautifulSoup
-
-from shapely.geometry import Point, MultiPoint
 from osm_shortlink import short_osm
 
-from common import get_api, set_up_logging
-import geometry
+from cira_listing import CiraListing
+from common import Metrics, lazy_import, preload, set_up_logging, set_up_metrics
+from downloader import Downloader
+import frame_sources
+
+# Only loaded by the stages that use them, so a run with no new frames
+# exits without paying for the image and geo libraries.
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+crop_history = lazy_import('crop_history')
+crop_index = lazy_import('crop_index')
+crop_scoring = lazy_import('crop_scoring')
+frame_quality = lazy_import('frame_quality')
+geometry = lazy_import('geometry')
+raw_frames = lazy_import('raw_frames')
+tiles = lazy_import('tiles')
+uploader = lazy_import('uploader')
+viewport = lazy_import('viewport')
+
+logger = logging.getLogger(__name__)
+metrics = Metrics('hires')
 
 BASE_DIR = dirname(abspath(__file__))
 LOGFILE = join(BASE_DIR, 'hires.log')
+METRICS_FILE = join(BASE_DIR, 'metrics.jsonl')
 HIRES_FOLDER = join(BASE_DIR, 'hires')
+CIRA_LISTING = join(BASE_DIR, 'cira_listing.json')
+QUALITY_CACHE = join(BASE_DIR, 'quality_hires.json')
+CROP_HISTORY = join(BASE_DIR, 'crop_history.json')
+SOURCE_HEALTH = join(BASE_DIR, 'source_health_hires.json')
+
+# Number of frames cropped in parallel.
+CROP_WORKERS = 4
+
+# Pipe crops straight into ffmpeg instead of writing PNGs for hires_mp4.sh.
+STREAM_ENCODE = True
+
+# How new frames are stored for cropping: 'tiles', or 'raw' to also keep
+# uncompressed memory-mapped copies of the newest frames, up to RAW_BUDGET
+# bytes (about 90 MB each); see raw_frames.
+FRAME_STORAGE = 'tiles'
+RAW_BUDGET = 2 * 1024 ** 3
 
 
 CIRA_IMG_BASE_URL = ("http://rammb.cira.colostate.edu/ramsdis/online/")
+# Other base URLs serving the same images as CIRA_IMG_BASE_URL. Frames are
+# downloaded from whichever has lately been fastest; see frame_sources.
+CIRA_MIRRORS = ()
 
 CIRA_LIST_URL = (
     "http://rammb.cira.colostate.edu/ramsdis/online/archive_hi_res.asp"
@@ -53,109 +87,376 @@ POINTS = [
     (0, 1500)
 ]
 
-# Polygon delimiting the 'interesting' parts of the Earth.
-EARTH_POLYGON = MultiPoint(POINTS).convex_hull
+# Cache of the valid crop origins inside earth_polygon(); rebuilt automatically
+# if POINTS or the options below change.
+CROP_INDEX_FILE = join(BASE_DIR, 'crop_index.npz')
+
+# Require the whole crop window, not just its top-left corner, to be inside
+# earth_polygon().
+CROP_WHOLE_WINDOW = False
+
+# Size in px of the blocks get_start_coord weights are given for.
+WEIGHT_CELL = 100
+
+# How make_hires_animation picks a crop when none is given: 'random', or
+# 'interesting' to score SCORE_CANDIDATES windows and use the best one.
+CROP_CHOOSER = 'random'
+SCORE_CANDIDATES = 4000
+
+# Steer both choosers away from regions posted in the last
+# crop_history.MAX_AGE; the random one weights those windows by
+# REPEAT_WEIGHT rather than ruling them out.
+AVOID_REPEATS = True
+REPEAT_WEIGHT = 0.05
+
+# What tweet_video posts: 'crop', a fixed 720x720 window, or 'zoom', which
+# zooms in on the window from a ZOOM_START_WIDTH px wide view of the disk.
+ANIMATION = 'crop'
+ZOOM_START_WIDTH = 4000
+
+# Skip making a video when the refresh found no new frames.
+SKIP_IF_UNCHANGED = True
+
+# Leave repeated, blank and partial frames out of the videos; see
+# frame_quality.
+FILTER_FRAMES = True
+
+_earth_polygon = None
+_crop_index = None
+_crop_history = None
+_cira_listing = None
+_cira_pool = None
+
+
+def earth_polygon():
+    """Returns the polygon delimiting the 'interesting' parts of the Earth,
+    the convex hull of POINTS."""
+    global _earth_polygon
+    if _earth_polygon is None:
+        from shapely.geometry import MultiPoint
+        _earth_polygon = MultiPoint(POINTS).convex_hull
+    return _earth_polygon
+
 
+def get_crop_index():
+    """Returns the index of valid crop origins, loading it from (or saving it
+    to) CROP_INDEX_FILE the first time it's needed."""
+    global _crop_index
+    if _crop_index is None:
+        _crop_index = crop_index.CropIndex.load_or_build(
+            CROP_INDEX_FILE, earth_polygon().exterior.coords,
+            x_range=(1, 4219), y_range=(732, 5499), whole_window=CROP_WHOLE_WINDOW)
+    return _crop_index
 
-def get_start_coord():
+
+def get_crop_history():
+    """Returns the history of posted regions, loading it from CROP_HISTORY
+    the first time it's needed."""
+    global _crop_history
+    if _crop_history is None:
+        _crop_history = crop_history.CropHistory(CROP_HISTORY)
+    return _crop_history
+
+
+def window_centers(lat_px, lng_px):
+    """Latitude and longitude of the middle of the crop windows starting at
+    `lat_px`, `lng_px` (NaN in space)."""
+    return geometry.px_to_lat_long_array(np.asarray(lat_px) + 360, np.asarray(lng_px) + 360)
+
+
+def repeat_weights(cell=WEIGHT_CELL):
+    """
+    REPEAT_WEIGHT for each `cell` x `cell` block of the image whose crop
+    window is centred near a recently posted region, 1 elsewhere.
+    """
+    starts = np.arange(0, 5500, cell)
+    lat_px, lng_px = np.meshgrid(starts, starts, indexing='ij')
+    covered = get_crop_history().covered(*window_centers(lat_px, lng_px))
+    return np.where(covered, REPEAT_WEIGHT, 1.0)
+
+
+def daylight_weights(frame, cell=WEIGHT_CELL):
+    """
+    Brightness of the crop window starting in each `cell` x `cell` block of
+    `frame`, for get_start_coord to favour the day side. The frame is only
+    decoded at a reduced size.
+    """
+    im = Image.open(frame)
+    im.draft('L', (5500 // 8, 5500 // 8))
+    grid = im.convert('L').resize((5500 // cell, 5500 // cell), Image.BOX)
+    grid = np.asarray(grid, dtype=float)
+    # Score each origin by the middle of the window it starts.
+    shift = 360 // cell
+    return np.pad(grid[shift:, shift:], ((0, shift), (0, shift)), 'edge')
+
+
+def get_start_coord(weights=None):
     """
     Get a top-left point to start our downward-rightward crop that
     is inside the Earth polygon
 
+    Args:
+        weights (array, optional): relative weight per WEIGHT_CELL block of
+            the image (e.g. from daylight_weights); uniform if not given.
+            Recently posted regions are weighted down if AVOID_REPEATS.
+
     Returns:
         coordinate tuple (0, 0 being top, left)
     """
     logger.info("Getting coordinates")
-    while True:
-        try_point = Point(random.randint(1, 4219), random.randint(732, 5499))
-        if try_point.within(EARTH_POLYGON):
-            break
-        else:
-            continue
+    index = get_crop_index()
+    if AVOID_REPEATS and len(get_crop_history()):
+        repeats = repeat_weights()
+        weights = repeats if weights is None else weights * repeats
+    if weights is None:
+        x, y = index.sample()
+    else:
+        x, y = index.sample_weighted(weights, WEIGHT_CELL, 5500)
     # When returning the Y Coordinate, need to reverse axis,
     # since Shapely counts up from bottom right and PIL counts
     # down from top left.
-    lng_px, lat_px = (int(try_point.x), int(5500 - try_point.y))
+    lng_px, lat_px = (x, 5500 - y)
     logger.debug("Using coordinates: (%s, %s)", lat_px, lng_px)
     return (lat_px, lng_px)
 
 
-def crop_hires_images(images, lat_start=None, lng_start=None):
+def get_interesting_coord(frame=None, candidates=SCORE_CANDIDATES):
+    """
+    Scores `candidates` random crop windows on a downsampled copy of `frame`
+    (the latest frame by default) and returns the top-left point of the most
+    interesting one; see crop_scoring. With AVOID_REPEATS, candidates near
+    recently posted regions are left out unless that leaves none.
+
+    Returns:
+        coordinate tuple (0, 0 being top, left)
+    """
+    logger.info("Scoring %s candidate crops", candidates)
+    frame = frame or cira_frames()[-1]
+    x, y = get_crop_index().sample_many(candidates)
+    if AVOID_REPEATS and len(get_crop_history()):
+        fresh = ~get_crop_history().covered(*window_centers(5500 - y, x))
+        logger.debug("%s of %s candidates are away from recent posts", fresh.sum(), len(x))
+        if fresh.any():
+            x, y = x[fresh], y[fresh]
+    lat_px, lng_px = crop_scoring.best_window(frame, 5500 - y, x)
+    logger.debug("Using coordinates: (%s, %s)", lat_px, lng_px)
+    return (lat_px, lng_px)
+
+
+def choose_start_coord(chooser=CROP_CHOOSER):
+    """Picks a crop origin with the 'random' or 'interesting' chooser,
+    falling back to random if scoring fails."""
+    if chooser == 'interesting':
+        try:
+            return get_interesting_coord()
+        except Exception as e:
+            logger.error("Failed to score crops", exc_info=True)
+    return get_start_coord()
+
+
+def crop_box(lat_start, lng_start):
+    """Returns the (left, top, right, bottom) crop box for a top-left point."""
+    return (lng_start, lat_start, lng_start + 720, lat_start + 720)
+
+
+def is_valid_frame(filename):
+    """Checks that `filename` looks like an image, deleting it if not."""
+    # If imghdr can't ID the file, then it's probably corrupt and we'll
+    # just drop that frame and delete the file.
+    try:
+        if not imghdr.what(filename):
+            logger.debug("Deleting %s", filename)
+            os.remove(filename)
+            return False
+    except Exception as e:
+        logger.error(str(e), exc_info=True)
+        return False
+    return True
+
+
+def crop_frame(filename, boxes, outs, stats=None):
+    """
+    Crops each of `boxes` out of one full disk frame, saving them as the
+    matching entry of `outs`. The frame is read once for all of the boxes.
+
+    Returns:
+        list of files written; empty if the frame was corrupt or couldn't
+        be cropped.
+    """
+    logger.debug("Cropping %s", filename)
+    if not is_valid_frame(filename):
+        return []
+
+    try:
+        for region, out in zip(tiles.read_regions(filename, boxes, stats=stats), outs):
+            region.save(out)
+        return outs
+    except Exception as e:
+        logger.error("Failed to crop image.", exc_info=True)
+        return []
+
+
+def crop_hires_images(images, lat_start=None, lng_start=None, workers=CROP_WORKERS):
     """
     Create a set of 720,720 png images cropped from the
     5500 x 5500 full-sized images.
 
+    Frames are cropped `workers` at a time on a thread pool; Pillow releases
+    the GIL while decoding, encoding and copying pixels, so the threads use
+    separate cores. Output names follow the sorted input order regardless of
+    which frame finishes first.
+
     Args:
         images (list): List of hi-res images to crop down.
         lat_start, lng_start: upper, left-most point to start the crop
+        workers (int): number of frames to crop at once.
 
     Returns:
         list of cropped images
     """
     logger.info("Cropping images")
-    width, height = 720, 720
-    top, left = lat_start, lng_start
+    box = crop_box(lat_start, lng_start)
 
-    for idx, image in enumerate(sorted(images)):
-        filename = join(HIRES_FOLDER, image)
-        logger.debug("Cropping %s", filename)
+    jobs = [(join(HIRES_FOLDER, image),
+             join(HIRES_FOLDER, "img{0}.png".format(str(idx).zfill(3))))
+            for idx, image in enumerate(sorted(images))]
 
-        # If imghdr can't ID the file, then it's probably corrupt and we'll
-        # just drop that frame and delete the file.
-        try:
-            if not imghdr.what(filename):
-                logger.debug("Deleting %s", filename)
-                os.remove(filename)
-                continue
-        except Exception as e:
-            logger.error(str(e), exc_info=True)
-            continue
+    preload(tiles)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        crops = list(pool.map(lambda job: crop_frame(job[0], [box], [job[1]]), jobs))
+    crops = [crop for frame_crops in crops for crop in frame_crops]
+    metrics.incr('frames_cropped', len(crops))
+    return crops
+
+
+def iter_hires_crops(images, lat_start=None, lng_start=None, workers=CROP_WORKERS):
+    """
+    Yields the cropped frames as in-memory images, in sorted input order,
+    without writing them to disk. Corrupt frames are skipped as in
+    crop_hires_images. At most `workers` * 2 crops are held at once.
+    """
+    box = crop_box(lat_start, lng_start)
 
+    def crop(image):
+        filename = join(HIRES_FOLDER, image)
+        if not is_valid_frame(filename):
+            return None
         try:
-            im = Image.open(filename)
-            im2 = im.crop((left, top, left + width, top + height))
-            crop_fn = "img{0}.png".format(str(idx).zfill(3))
-            im2.save(join(HIRES_FOLDER, crop_fn))
+            return tiles.read_region(filename, box)
         except Exception as e:
             logger.error("Failed to crop image.", exc_info=True)
-            continue
+            return None
+
+    images = sorted(images)
+    batch = workers * 2
+    preload(tiles)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(images), batch):
+            for im in pool.map(crop, images[start:start + batch]):
+                if im is not None:
+                    metrics.incr('frames_cropped')
+                    yield im
+
+
+def region_folder(num):
+    return join(HIRES_FOLDER, "crop_{0:02d}".format(num))
+
+
+def crop_hires_regions(images, starts, workers=CROP_WORKERS):
+    """
+    Like crop_hires_images, but for several crop windows at once: each frame
+    is read a single time and every window is cut from it. Window `n` is
+    written to hires/crop_NN/imgNNN.png.
+
+    Args:
+        images (list): List of hi-res images to crop down.
+        starts (list): (lat_start, lng_start) top-left point of each window.
+        workers (int): number of frames to crop at once.
+
+    Returns:
+        tuple: list of output folders (one per window), tiles.DecodeStats
+    """
+    logger.info("Cropping %s regions", len(starts))
+    boxes = [crop_box(lat_start, lng_start) for lat_start, lng_start in starts]
+    folders = [region_folder(n) for n in range(len(starts))]
+    for folder in folders:
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+
+    stats = tiles.DecodeStats()
+    jobs = []
+    for idx, image in enumerate(sorted(images)):
+        crop_fn = "img{0}.png".format(str(idx).zfill(3))
+        jobs.append((join(HIRES_FOLDER, image), [join(folder, crop_fn) for folder in folders]))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda job: crop_frame(job[0], boxes, job[1], stats=stats), jobs))
+    logger.info("Region crop: %s", stats)
+    return folders, stats
+
+
+def get_cira_listing():
+    """Returns the module's CiraListing, which remembers the archive page
+    between runs in CIRA_LISTING."""
+    global _cira_listing
+    if _cira_listing is None:
+        _cira_listing = CiraListing(CIRA_LIST_URL, cache_file=CIRA_LISTING)
+    return _cira_listing
+
+
+def cira_source(name, base_url=None):
+    """Hi-res images under `base_url`, CIRA_IMG_BASE_URL by default."""
+    # Anything under 1024 bytes is one of the broken ones: it gets deleted
+    # after download and re-fetched if found on disk.
+    return frame_sources.HttpSource(
+        name, lambda image: "{0}{1}".format(base_url or CIRA_IMG_BASE_URL, image),
+        lambda image: join(HIRES_FOLDER, os.path.basename(image)),
+        downloader=Downloader(min_size=1024))
+
+
+def get_cira_pool():
+    """Returns the pool of CIRA and CIRA_MIRRORS, with their health records
+    loaded from SOURCE_HEALTH."""
+    global _cira_pool
+    if _cira_pool is None:
+        sources = [cira_source('cira')] + [cira_source(url, url) for url in CIRA_MIRRORS]
+        _cira_pool = frame_sources.SourcePool(sources, frame_sources.SourceHealth(SOURCE_HEALTH))
+    return _cira_pool
 
 
 def get_cira_images(num=60):
     """
-    Scrapes the CIRA site for links to hi-res images.
+    Lists the hi-res images on the CIRA site and downloads any we don't
+    already have from the best of CIRA and its mirrors, several at a time
+    over a shared connection pool.
 
     Returns:
-        files (list): List of urls to download
+        FetchStats for the run
     """
     logger.info("Fetching images")
-    page_content = requests.get(CIRA_LIST_URL)._content
-    soup = BeautifulSoup(page_content, 'html.parser')
-    links = soup.find_all('a', string=re.compile('^Hi-Res Image'), limit=num)
+    listing = get_cira_listing()
+    image_urls = listing.refresh(num=num)
+    logger.debug("Found %s images, %s new", len(image_urls), len(listing.new))
+    stats = get_cira_pool().fetch(image_urls)
+    for source, count in stats.sources.items():
+        metrics.incr('frames_from_' + source, count)
+    return stats
 
-    image_urls = [link.attrs['href'] for link in links]
-    prev_downloaded_images = os.listdir(HIRES_FOLDER)
 
-    for idx, image in enumerate(image_urls):
-        logger.debug("Getting (%s / %s) image: %s", idx + 1, num, image)
-        image_name = os.path.basename(image)
-        full_image_url = "{0}{1}".format(CIRA_IMG_BASE_URL, image)
-        download_name = join(HIRES_FOLDER, image_name)
+def cira_frames():
+    """Returns full paths of the downloaded full disk frames, oldest first."""
+    return [join(HIRES_FOLDER, img) for img in sorted(os.listdir(HIRES_FOLDER))
+            if img.startswith('full')]
 
-        if image_name in prev_downloaded_images and getsize(download_name) > 1024:
-            # Don't redownload images we already have.
-            logger.debug("Skipping previously downloaded image %s", image_name)
-            continue
 
-        with open(download_name, 'wb') as f:
-            data = requests.get(full_image_url)
-            f.write(data._content)
-            logger.debug("Successfully downloaded %s", full_image_url)
-
-        # If the image is smaller than 1024 bytes, it's one of the broken ones
-        if getsize(download_name) < 1024:
-            logger.debug("Deleting corrupt image %s", image_name)
-            os.remove(download_name)
+def animation_frames():
+    """Returns the frames to animate, oldest first: cira_frames(), checked
+    by frame_quality.check_frames if FILTER_FRAMES."""
+    frames = cira_frames()
+    if FILTER_FRAMES:
+        frames = frame_quality.check_frames(frames, QUALITY_CACHE, metrics)
+    return frames
 
 
 def delete_old_cira_images(num=60):
@@ -175,6 +476,8 @@ def delete_old_cira_images(num=60):
     for img in images[:num_images_to_del]:
         logger.debug("Deleting %s", img)
         os.remove(join(HIRES_FOLDER, img))
+        tiles.delete_tiles(join(HIRES_FOLDER, img))
+        raw_frames.delete_raw(join(HIRES_FOLDER, img))
 
     # delete previously cropped png files too:
     logger.debug("Deleting PNG files")
@@ -182,65 +485,225 @@ def delete_old_cira_images(num=60):
         if os.path.splitext(img)[1] == '.png':
             logger.debug("Deleted %s", img)
             os.remove(join(HIRES_FOLDER, img))
+        elif img.startswith('crop_'):
+            logger.debug("Deleted %s", img)
+            shutil.rmtree(join(HIRES_FOLDER, img))
 
 
 def refresh_images(num=60):
-    """Upadtes images for use by deleting old, getting new.
+    """Upadtes images for use by deleting old, getting new, and tiling any
+    new frames so later crops only decode the part they need.
     Args:
         num (int, optional): number of images to end up with.
+    Returns:
+        FetchStats for the run
     """
     logger.info("Refreshing images")
-    get_cira_images(num=num)
-    delete_old_cira_images(num=num)
-
-
-def make_hires_animation(lat_start=None, lng_start=None):
+    with metrics.stage('download'):
+        stats = get_cira_images(num=num)
+    metrics.incr('bytes_downloaded', stats.bytes)
+    metrics.incr('frames_downloaded', stats.downloaded)
+    with metrics.stage('cleanup'):
+        delete_old_cira_images(num=num)
+    if stats.downloaded:
+        with metrics.stage('tile'):
+            store_frames(cira_frames())
+    return stats
+
+
+def store_frames(frames, storage=FRAME_STORAGE, raw_budget=RAW_BUDGET):
+    """Decodes any new `frames` into the crop caches: tiles, or with
+    storage='raw' raw copies for the newest and tiles for any that don't
+    fit in `raw_budget`."""
+    if storage == 'raw':
+        frames = raw_frames.build_missing(frames, raw_budget)
+        usage = raw_frames.disk_usage(HIRES_FOLDER)
+        logger.info("Raw frames: %s frames, %.1f MB, %.1f MB free", usage['frames'],
+                    usage['bytes'] / 1048576.0, usage['free'] / 1048576.0)
+        metrics.gauge('raw_frames', usage['frames'])
+        metrics.gauge('raw_bytes', usage['bytes'])
+    tiles.build_missing_tiles(frames)
+
+
+def make_hires_animation(lat_start=None, lng_start=None, stream=STREAM_ENCODE,
+                         chooser=CROP_CHOOSER):
     """Creates a video with its center at the lat_start, lng_start pair
     Args:
         lat_start (float, int): center latitude point of the video
         lng_start (float, int): center longitude point of the video
+        stream (bool): pipe crops straight into ffmpeg rather than going
+            through PNG files and hires_mp4.sh
+        chooser (str): 'random' or 'interesting'; how to pick the crop if
+            lat_start and lng_start aren't given
     Returns:
-        (tuple): Coordinates, path for MP4
+        (tuple): Coordinates, path for MP4 (None if encoding failed)
     """
     logger.info("Making hi-res video")
 
-    images = os.listdir(HIRES_FOLDER)
+    images = [os.path.basename(img) for img in animation_frames()]
     out = join(BASE_DIR, "video_out.mp4")
 
     if not (lat_start and lng_start):
-        lat_start, lng_start = get_start_coord()
+        lat_start, lng_start = choose_start_coord(chooser)
 
-    crop_hires_images(images, lat_start=lat_start, lng_start=lng_start)
     coordinates = geometry.px_to_lat_long(lat_start + 360, lng_start + 360)
 
-    cmd = "{0}/hires_mp4.sh {1} {2}".format(BASE_DIR, HIRES_FOLDER, out)
+    if stream:
+        # Cropping and encoding overlap, so they're timed as one stage.
+        with metrics.stage('crop_encode'):
+            frames = iter_hires_crops(images, lat_start=lat_start, lng_start=lng_start)
+            return (coordinates, encode_frames_mp4(frames, out))
+
+    with metrics.stage('crop'):
+        crop_hires_images(images, lat_start=lat_start, lng_start=lng_start)
+    with metrics.stage('encode'):
+        return (coordinates, encode_mp4(HIRES_FOLDER, out))
+
+
+def make_zoom_animation(lat_start=None, lng_start=None, start_width=ZOOM_START_WIDTH,
+                        chooser=CROP_CHOOSER):
+    """Creates a video zooming in on the 720x720 window at lat_start,
+    lng_start, one frame per downloaded image, drawn from the tile pyramid.
+    Args:
+        lat_start, lng_start (int): top-left point of the window zoomed to;
+            picked with `chooser` if not given.
+        start_width (int): width in px of the view the zoom starts from.
+    Returns:
+        (tuple): Coordinates, path for MP4 (None if encoding failed)
+    """
+    logger.info("Making hi-res zoom video")
+
+    frames = [img for img in animation_frames() if is_valid_frame(img)]
+    out = join(BASE_DIR, "video_out.mp4")
+
+    if not (lat_start and lng_start):
+        lat_start, lng_start = choose_start_coord(chooser)
+
+    coordinates = geometry.px_to_lat_long(lat_start + 360, lng_start + 360)
+    path = viewport.zoom_path((lng_start + 360, lat_start + 360), start_width, 720, len(frames))
+    stats = tiles.DecodeStats()
+    with metrics.stage('render_encode'):
+        mp4 = encode_frames_mp4(viewport.render_path(frames, path, workers=CROP_WORKERS,
+                                                     stats=stats), out)
+    metrics.incr('frames_rendered', len(path))
+    logger.info("Zoom render: %s", stats)
+    return (coordinates, mp4)
+
+
+def make_hires_animations(starts=None, count=1):
+    """Creates one video per crop window, reading each frame only once.
+    Args:
+        starts (list, optional): (lat_start, lng_start) top-left point of
+            each video; `count` random points are used if not given.
+        count (int): number of random windows when `starts` is None.
+    Returns:
+        (list): (Coordinates, path for MP4 or None) tuples, one per window
+    """
+    logger.info("Making hi-res videos")
+
+    images = [os.path.basename(img) for img in animation_frames()]
+    if not starts:
+        starts = [get_start_coord() for _ in range(count)]
+
+    folders, stats = crop_hires_regions(images, starts)
+
+    videos = []
+    for n, (folder, (lat_start, lng_start)) in enumerate(zip(folders, starts)):
+        coordinates = geometry.px_to_lat_long(lat_start + 360, lng_start + 360)
+        out = join(BASE_DIR, "video_out_{0:02d}.mp4".format(n))
+        videos.append((coordinates, encode_mp4(folder, out)))
+    return videos
+
+
+def encode_frames_mp4(frames, out, size=(720, 720), fps=6):
+    """
+    Encodes `frames` (an iterable of RGB images) into an MP4 at `out` by
+    writing raw pixels to ffmpeg's stdin. Output settings match
+    hires_mp4.sh.
+
+    Returns:
+        str: path of the MP4, or None if ffmpeg failed or stopped reading
+            frames, in which case nothing is left at `out`.
+    """
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+           '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+           '-s', '{0}x{1}'.format(*size), '-framerate', str(fps), '-i', '-',
+           '-c:v', 'libx264', '-vf', 'fps={0}'.format(fps), '-pix_fmt', 'yuv420p', out]
+    logger.debug("Hires command: %s", ' '.join(cmd))
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    failed = False
+    try:
+        for im in frames:
+            if im.mode != 'RGB':
+                im = im.convert('RGB')
+            proc.stdin.write(im.tobytes())
+    except IOError:
+        logger.error("ffmpeg stopped reading frames", exc_info=True)
+        failed = True
+    finally:
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        proc.wait()
+    if proc.returncode:
+        logger.error("ffmpeg exited with %s", proc.returncode)
+        failed = True
+    if failed:
+        if os.path.exists(out):
+            os.remove(out)
+        return None
+    return os.path.realpath(out)
+
+
+def encode_mp4(folder, out):
+    """Encodes the imgNNN.png frames in `folder` into an MP4 at `out`.
+    Returns its path, or None if hires_mp4.sh failed."""
+    cmd = "{0}/hires_mp4.sh {1} {2}".format(BASE_DIR, folder, out)
     logger.debug("Hires command: %s", cmd)
-    subprocess.call(cmd, shell=True)
-    mp4_path = os.path.realpath(out)
-    return (coordinates, mp4_path)
+    code = subprocess.call(cmd, shell=True)
+    if code or not os.path.exists(out):
+        logger.error("hires_mp4.sh exited with %s", code)
+        return None
+    return os.path.realpath(out)
 
 
 def tweet_video(coordinates=None, mp4=None):
     logger.info("Starting tweet")
 
-    if not mp4:
-        refresh_images(num=55)
-        coordinates, mp4 = make_hires_animation()
-
-    short_link = short_osm(coordinates[0], coordinates[1], zoom=6, marker=True)
-    logger.info(short_link)
-
     try:
-        api = get_api()
-        api.PostUpdate(
-            status="Coordinates: {0}; {1}".format(str(coordinates), short_link),
-            media=mp4)
-    except Exception as e:
-        logger.error("Failed to tweet", exc_info=True)
-    os.remove(mp4)
-    logger.info("Finished tweet")
+        if not mp4:
+            stats = refresh_images(num=55)
+            if SKIP_IF_UNCHANGED and not stats.downloaded:
+                logger.info("No new frames; not tweeting")
+                return
+            if ANIMATION == 'zoom':
+                coordinates, mp4 = make_zoom_animation()
+            else:
+                coordinates, mp4 = make_hires_animation()
+            if mp4 is None:
+                logger.error("No video made; not tweeting")
+                return
+        metrics.gauge('video_bytes', os.path.getsize(mp4))
+
+        short_link = short_osm(coordinates[0], coordinates[1], zoom=6, marker=True)
+        logger.info(short_link)
+
+        try:
+            with metrics.stage('tweet'):
+                status = "Coordinates: {0}; {1}".format(str(coordinates), short_link)
+                uploader.post_media(status, mp4, media_category='tweet_video')
+            if isinstance(coordinates, tuple):
+                get_crop_history().record(*coordinates)
+        except Exception as e:
+            logger.error("Failed to tweet", exc_info=True)
+        os.remove(mp4)
+        logger.info("Finished tweet")
+    finally:
+        metrics.flush()
 
 
 if __name__ == '__main__':
     logger = set_up_logging(log_file=LOGFILE)
+    set_up_metrics(metrics_file=METRICS_FILE)
     tweet_video()
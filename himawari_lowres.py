@@ -1,21 +1,83 @@
 import os
-from os.path import abspath, dirname, join
+from os.path import abspath, basename, dirname, exists, join
 
 import datetime
-import requests
+import logging
+import shutil
 import subprocess
 import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from PIL import Image
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
 
-from common import get_api, set_up_logging
+from common import Metrics, lazy_import, preload, set_up_logging, set_up_metrics
+from downloader import Downloader
+from ftp_mirror import FtpMirror
+import frame_sources
+import frame_store
 
+# Only loaded by the stages that use them; see himawari_hires.
+Image = lazy_import('PIL.Image')
+frame_quality = lazy_import('frame_quality')
+gif_builder = lazy_import('gif_builder')
+uploader = lazy_import('uploader')
+
+logger = logging.getLogger(__name__)
+metrics = Metrics('lowres')
 
 BASE_DIR = dirname(abspath(__file__))
 LOGFILE = join(BASE_DIR, 'lowres.log')
+METRICS_FILE = join(BASE_DIR, 'metrics.jsonl')
 LOWRES_FOLDER = join(BASE_DIR, 'lowres/')
+PROCESSED_FOLDER = join(LOWRES_FOLDER, 'processed/')
 JMA_URL = "http://himawari8-dl.nict.go.jp/himawari8/img/D531106/1d/550/"
 NOAA_URL = "ftp://ftp.nnvl.noaa.gov/GOES/HIMAWARI/simplecontrast/"
+NOAA_NAME = "%Y-%m-%dT%H:%M:%S.JPG"
+# NOAA frames fetched when JMA fails are kept apart from the ones ftp_lowres
+# mirrors into LOWRES_FOLDER, which it prunes on its own schedule.
+NOAA_FOLDER = join(LOWRES_FOLDER, 'noaa/')
+NOAA_LISTING = join(BASE_DIR, 'noaa_listing.json')
+SOURCE_HEALTH = join(BASE_DIR, 'source_health_lowres.json')
+FRAME_DB = join(BASE_DIR, 'lowres_frames.sqlite')
+GIF_CACHE = join(BASE_DIR, 'gif_cache')
+QUALITY_CACHE = join(BASE_DIR, 'quality_lowres.json')
+RENDER_FOLDER = join(BASE_DIR, 'render_frames')
+JMA_TIMEOUT = 10
+
+# Where frames are fetched from, in order of preference; see frame_sources.
+# NOAA's frames look a little different, so they aren't mixed in to measure
+# NOAA: it's only used when JMA fails, and kept while it's the faster of
+# the two.
+LOWRES_SOURCES = ('jma', 'noaa')
+
+# JMA frames are padded onto a PADDED_SIZE black square, then scaled to
+# FRAME_SIZE. Frames of other sizes (NOAA's) are framed as if they were
+# JMA_SIZE.
+JMA_SIZE = 550
+PADDED_SIZE = 650
+FRAME_SIZE = 500
+PREP_WORKERS = 4
+# Processed frames are only read back by the GIF renderer, so favour fast
+# writes over small files.
+PNG_COMPRESS_LEVEL = 1
+
+# Render with the two-pass ffmpeg script instead of GifBuilder.
+USE_GIF_SCRIPT = False
+
+# Skip rendering and tweeting when no frames were added or expired since
+# the last render.
+SKIP_IF_UNCHANGED = True
+
+# Leave repeated, blank and partial frames out of the GIF; see frame_quality.
+FILTER_FRAMES = True
+
+_frame_store = None
+_source_pool = None
+_canvases = threading.local()
 
 
 def round_time_10(dt):
@@ -45,6 +107,80 @@ def date_to_jma_filename(date):
     return date.strftime("%Y/%m/%d/%H%M00_0_0.png")
 
 
+def jma_capture_time(image):
+    """
+    Capture time of a JMA image from either its URL path or its local name,
+    i.e. "2016/10/23/115000_0_0.png" or "20161023115000_0_0.png".
+    """
+    return datetime.datetime.strptime(image.replace('/', '')[:12], "%Y%m%d%H%M")
+
+
+def capture_time(name):
+    """Capture time of a downloaded frame, from its JMA or local NOAA
+    name."""
+    try:
+        return jma_capture_time(basename(name))
+    except ValueError:
+        return datetime.datetime.strptime(basename(name), noaa_local_name(NOAA_NAME))
+
+
+def noaa_local_name(name):
+    """NOAA's file name without its colons, which trip up ffmpeg."""
+    return name.replace(':', '')
+
+
+def get_frame_store():
+    """Returns the index of frames in LOWRES_FOLDER, seeding it from the
+    folder contents the first time it's created."""
+    global _frame_store
+    if _frame_store is None:
+        _frame_store = frame_store.FrameStore(FRAME_DB)
+        if _frame_store.is_empty():
+            existing = []
+            for img in os.listdir(LOWRES_FOLDER):
+                try:
+                    existing.append((jma_capture_time(img).isoformat(), img))
+                except ValueError:
+                    continue
+            logger.debug('importing {0} existing frames'.format(len(existing)))
+            _frame_store.import_existing(existing, status=frame_store.PRESENT)
+    return _frame_store
+
+
+def jma_source(downloader=None):
+    """JMA's PNGs over HTTP."""
+    # Anything under 8 KiB is JMA's "no image" placeholder.
+    return frame_sources.HttpSource(
+        'jma', lambda captured: JMA_URL + date_to_jma_filename(captured),
+        lambda captured: LOWRES_FOLDER + date_to_jma_filename(captured).replace('/', ''),
+        downloader=downloader or Downloader(min_size=2**13, timeout=JMA_TIMEOUT))
+
+
+def noaa_source():
+    """NOAA's JPEGs of the same frames over FTP."""
+    url = urlsplit(NOAA_URL)
+    if not exists(NOAA_FOLDER):
+        os.makedirs(NOAA_FOLDER)
+    mirror = FtpMirror(url.hostname, url.path, NOAA_FOLDER, port=url.port or 21,
+                       listing_file=NOAA_LISTING, local_name=noaa_local_name)
+    return frame_sources.FtpSource('noaa', mirror,
+                                   remote_name=lambda captured: captured.strftime(NOAA_NAME))
+
+
+SOURCES = {'jma': jma_source, 'noaa': noaa_source}
+
+
+def get_source_pool():
+    """Returns the pool of LOWRES_SOURCES, with their health records
+    loaded from SOURCE_HEALTH."""
+    global _source_pool
+    if _source_pool is None:
+        _source_pool = frame_sources.SourcePool(
+            [SOURCES[name]() for name in LOWRES_SOURCES],
+            frame_sources.SourceHealth(SOURCE_HEALTH), probe_interval=None)
+    return _source_pool
+
+
 def get_jma_images(start_time=None, num=48):
     """
     Get the most recent [num] images from the JMA.
@@ -70,38 +206,176 @@ def delete_old_images(num=48):
     Only keep the most recent `num` images (my server is not *that* large)
     """
     logger.debug("Starting delete of old images")
-    images = sorted(os.listdir(LOWRES_FOLDER))
-
-    num_images_to_del = len(images) - num
-    if num_images_to_del <= 0:
-        return True
-    images_to_del = images[:abs(num_images_to_del)]
-    for img in images_to_del:
-        if os.path.splitext(img)[1] != '.png':
-            continue
+    for img in get_frame_store().expire(keep=num):
         logger.debug('deleting {0}'.format(img))
-        os.remove(join(LOWRES_FOLDER, img))
+        for path in (join(LOWRES_FOLDER, img), processed_path(img)):
+            if os.path.exists(path):
+                os.remove(path)
     return True
 
 
-def process_image(image):
+def processed_path(image):
+    """Where the processed copy of `image` is kept: a PNG named like JMA's
+    frames whatever the source, so they sort by capture time."""
+    return join(PROCESSED_FOLDER, date_to_jma_filename(capture_time(image)).replace('/', ''))
+
+
+def _inner_box(size):
+    """
+    Where a `size` frame lands once centred on the padded square and scaled
+    to FRAME_SIZE: the whole output px it covers (lo, hi) per axis, and the
+    source box that maps exactly onto them.
+    """
+    scale = PADDED_SIZE / float(FRAME_SIZE)
+    dest, src = [], []
+    for length in size:
+        offset = (PADDED_SIZE - length) // 2
+        lo = -(-offset * FRAME_SIZE // PADDED_SIZE)
+        hi = (offset + length) * FRAME_SIZE // PADDED_SIZE
+        dest.append((lo, hi))
+        src.append((lo * scale - offset, hi * scale - offset))
+    return ((dest[0][0], dest[1][0], dest[0][1], dest[1][1]),
+            (src[0][0], src[1][0], src[0][1], src[1][1]))
+
+
+def _canvas():
+    """A black FRAME_SIZE canvas, one per thread and reused for every frame.
+    Frames are all the same size, so the border is never drawn over."""
+    if getattr(_canvases, 'im', None) is None:
+        _canvases.im = Image.new("RGB", (FRAME_SIZE, FRAME_SIZE))
+    return _canvases.im
+
+
+def process_image(image, out=None):
+    """
+    Pads `image` onto a black PADDED_SIZE square and scales it to
+    FRAME_SIZE, leaving the original untouched. The padding and scaling are
+    a single resize of the frame straight into its place on a reused
+    canvas, so no padded intermediate is ever allocated. PNGs already at
+    FRAME_SIZE (processed in place by older versions) are copied as they are.
+
+    Args:
+        image (str): path to the downloaded frame.
+        out (str, optional): where to write it; defaults to processed_path.
+
+    Returns:
+        bool: whether the processed frame was written.
+    """
     logger.debug('processing image: {0}'.format(image))
+    out = out or processed_path(image)
     try:
         im = Image.open(image)
-        old_size = im.size
-        new_size = (650, 650)
-        new_im = Image.new("RGB", new_size)
-        new_im.paste(im, ((new_size[0] - old_size[0]) // 2,
-                          (new_size[1] - old_size[1]) // 2))
-        new_im = new_im.resize((500, 500))
-        new_im.save(image)
+        # Write next to the output and swap it in, so a crash can't leave a
+        # half-written frame behind.
+        tmp = out + '.part'
+        if im.size == (FRAME_SIZE, FRAME_SIZE) and im.format == 'PNG':
+            shutil.copyfile(image, tmp)
+        else:
+            dest, src = _inner_box((JMA_SIZE, JMA_SIZE))
+            sx, sy = im.size[0] / float(JMA_SIZE), im.size[1] / float(JMA_SIZE)
+            src = (src[0] * sx, src[1] * sy, src[2] * sx, src[3] * sy)
+            canvas = _canvas()
+            canvas.paste(im.convert("RGB").resize((dest[2] - dest[0], dest[3] - dest[1]),
+                                                  Image.BICUBIC, box=src), dest[:2])
+            canvas.save(tmp, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+        os.rename(tmp, out)
+        return True
     except Exception as e:
         logger.error(str(e))
+        return False
+
+
+def process_images(images, workers=PREP_WORKERS):
+    """
+    Runs process_image over `images` on a pool of `workers` threads.
+
+    Returns:
+        list: process_image's result for each image.
+    """
+    if not exists(PROCESSED_FOLDER):
+        os.makedirs(PROCESSED_FOLDER)
+    preload(Image)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(process_image, images))
+
+
+def prepare_frames(store=None, workers=PREP_WORKERS):
+    """
+    Processes every downloaded frame in the store that doesn't have a
+    processed copy yet, and marks it processed.
+
+    Returns:
+        int: number of frames processed.
+    """
+    store = store or get_frame_store()
+    pending = store.entries(statuses=(frame_store.PRESENT,))
+    with metrics.stage('prepare'):
+        results = process_images([join(LOWRES_FOLDER, name) for _, name in pending],
+                                 workers=workers)
+        for (captured, name), processed in zip(pending, results):
+            if processed:
+                store.mark(captured, name, frame_store.PROCESSED)
+    metrics.incr('frames_processed', sum(results))
+    logger.debug('processed {0} of {1} frames'.format(sum(results), len(pending)))
+    return sum(results)
+
+
+def fetch_frames(images, store=None, pool=None):
+    """
+    Downloads whichever of `images` the frame store still needs from the
+    best of the lowres sources, then prepares them with prepare_frames.
+    Frames the source doesn't have yet are recorded as missing and not
+    asked for again until their backoff runs out.
+
+    Args:
+        images (list): JMA image paths, as from get_jma_images.
+        store (FrameStore, optional): defaults to get_frame_store().
+        pool (SourcePool, optional): defaults to get_source_pool().
+
+    Returns:
+        dict: counts of frames 'fetched', 'skipped' (already have them),
+            'deferred' (known missing, backing off), 'missing' (asked for,
+            not available) and 'failed' (request errors; retried next run).
+    """
+    store = store or get_frame_store()
+    pool = pool or get_source_pool()
+
+    frames = [(jma_capture_time(image).isoformat(), image) for image in images]
+    needed = store.needed(frames)
+    deferred = len(store.deferred(frames))
+    counts = {'fetched': 0, 'skipped': len(frames) - len(needed) - deferred,
+              'deferred': deferred, 'missing': 0, 'failed': 0}
+    logger.debug('{0} of {1} images needed'.format(len(needed), len(images)))
+
+    with metrics.stage('download'):
+        stats = pool.fetch([jma_capture_time(image) for _, image in needed])
+    metrics.incr('bytes_downloaded', stats.bytes)
+    for source, count in stats.sources.items():
+        metrics.incr('frames_from_' + source, count)
+
+    for (captured, image), (source, status, dest) in zip(needed, stats.results):
+        # Relative to LOWRES_FOLDER, as NOAA's are kept in NOAA_FOLDER.
+        image_name = os.path.relpath(dest, LOWRES_FOLDER)
+        if status == 'downloaded':
+            store.mark(captured, image_name, frame_store.PRESENT)
+            counts['fetched'] += 1
+        elif status == 'skipped':
+            # On disk from before the store existed.
+            store.mark(captured, image_name, frame_store.PRESENT)
+            counts['skipped'] += 1
+        elif status == 'missing':
+            store.mark(captured, image_name, frame_store.MISSING)
+            counts['missing'] += 1
+        else:
+            counts['failed'] += 1
+    metrics.incr('frames_downloaded', counts['fetched'])
+    prepare_frames(store)
+    return counts
 
 
 def download_jma_images():
     """
-    Downloads the most recent(ish) 20 images from the JMA.
+    Downloads the most recent(ish) 20 images from the best available source.
 
     Returns:
         ISO date of last image.
@@ -112,60 +386,114 @@ def download_jma_images():
     images = get_jma_images(start_time=rounded_now)
     logger.debug('images: {0}'.format(str(images)))
 
-    old_images = os.listdir(LOWRES_FOLDER)
-    logger.debug('old_images: {0}'.format(old_images))
-
-    for image in images:
-        image_name = image.replace('/', '')
-        if image_name in old_images:
-            logger.debug('skipping {0}'.format(image_name))
-            continue
-        logger.debug('downloading {0}'.format(image_name))
-        image_url = JMA_URL + image
-        data = requests.get(image_url)
-        if len(data._content) < 2**13:
-            continue
-        with open(LOWRES_FOLDER + image_name, 'wb') as f:
-            f.write(data._content)
-        process_image(LOWRES_FOLDER + image_name)
+    counts = fetch_frames(images)
+    logger.info('Frames: {0}'.format(counts))
     return rounded_now.isoformat()
 
 
-def images_to_gif():
+def images_to_gif(frames=None, use_script=USE_GIF_SCRIPT):
+    """
+    Renders the processed frames into gif.gif. By default this goes through
+    the cached palette and frame blocks in GIF_CACHE, so only new frames
+    are quantized; mp4_to_gif.sh is used if asked for or if that fails. The
+    script is given a folder of links to `frames` if they're not all of the
+    processed frames.
+
+    Args:
+        frames (list, optional): frame paths, oldest first. Defaults to the
+            processed frames in the frame store.
+        use_script (bool): render with mp4_to_gif.sh instead.
+
+    Returns:
+        str: path of the GIF, or None if there were no frames or the render
+            failed.
+    """
     logger.debug('creating GIF')
-    cmd = ("{0}/mp4_to_gif.sh {0} {0}/gif.gif".format(BASE_DIR))
-    subprocess.call(shlex.split(cmd))
-    return os.path.realpath("{0}/gif.gif".format(BASE_DIR))
+    processed = [processed_path(img)
+                 for img in get_frame_store().frames(statuses=(frame_store.PROCESSED,))]
+    if frames is None:
+        frames = processed
+    if not frames:
+        logger.warning('No frames to render')
+        return None
+    gif = join(BASE_DIR, 'gif.gif')
+    if not use_script:
+        try:
+            gif_builder.GifBuilder(GIF_CACHE).build(frames, gif)
+            return os.path.realpath(gif)
+        except Exception as e:
+            logger.error('GIF builder failed, falling back to script', exc_info=True)
+
+    folder = PROCESSED_FOLDER
+    if frames != processed:
+        folder = frame_quality.link_frames(frames, RENDER_FOLDER)
+    # So a failed render can't leave the last run's GIF to be posted again.
+    if os.path.exists(gif):
+        os.remove(gif)
+    cmd = ("{0}/mp4_to_gif.sh {0} {1} {2}".format(BASE_DIR, gif, folder))
+    code = subprocess.call(shlex.split(cmd))
+    if code != 0 or not os.path.exists(gif):
+        logger.error('mp4_to_gif.sh exited with {0}'.format(code))
+        return None
+    return os.path.realpath(gif)
 
 
 def tweet_gif(gif, status):
     logger.debug("Starting to tweet")
-    api = get_api()
-    uploaded_gif = api.UploadMediaChunked(media=gif, media_category="tweet_gif")
-    logger.debug('media ID: {0}'.format(uploaded_gif))
-    status = api.PostUpdate(status=status, media=uploaded_gif)
+    status = uploader.post_media(status, gif, media_category="tweet_gif")
     logger.debug('Finished tweet: {0}'.format(status))
     return status
 
 
+def render_gif():
+    """Renders the GIF and records the render in the frame store. Returns
+    None, leaving the render unrecorded, if nothing was rendered."""
+    store = get_frame_store()
+    changes = store.changed_since_render()
+    logger.debug('{0} new, {1} expired frames since last render'.format(
+        len(changes['added']), len(changes['removed'])))
+    frames = [processed_path(img) for img in store.frames(statuses=(frame_store.PROCESSED,))]
+    if FILTER_FRAMES:
+        frames = frame_quality.check_frames(frames, QUALITY_CACHE, metrics)
+    gif = images_to_gif(frames)
+    if gif is not None:
+        store.mark_rendered()
+    return gif
+
+
 def main():
-    status = download_jma_images()
-    delete_old_images()
-    gif = images_to_gif()
     try:
-        tweet_gif(gif, status)
-    except Exception as e:
-        logger.critical(str(e))
+        status = download_jma_images()
+        with metrics.stage('cleanup'):
+            delete_old_images()
+        changes = get_frame_store().changed_since_render()
+        if SKIP_IF_UNCHANGED and not (changes['added'] or changes['removed']):
+            logger.info("No new frames; not tweeting")
+            return
+        with metrics.stage('render_gif'):
+            gif = render_gif()
+        if gif is None:
+            logger.info("Nothing rendered; not tweeting")
+            return
+        metrics.gauge('gif_bytes', os.path.getsize(gif))
+        try:
+            with metrics.stage('tweet'):
+                tweet_gif(gif, status)
+        except Exception as e:
+            logger.critical(str(e))
+    finally:
+        metrics.flush()
 
 
 def make_local_gif():
     status = download_jma_images()
-    gif = images_to_gif()
+    gif = render_gif()
     print(status)
     print(gif)
 
 
 if __name__ == '__main__':
     logger = set_up_logging(log_file=LOGFILE)
+    set_up_metrics(metrics_file=METRICS_FILE)
     logger.info('Started program')
     main()
@@ -1,9 +1,10 @@
 #!/bin/sh
 
 cd $1
+frames=${3:-lowres}
 palette="/tmp/palette.png"
 
 filters="fps=8"
 
-ffmpeg -framerate 8 -pattern_type glob -i "lowres/*.png" -vf "$filters,palettegen" -y $palette
-ffmpeg -framerate 8 -pattern_type glob -i "lowres/*.png" -i $palette -lavfi "$filters [x]; [x][1:v] paletteuse" -y $2
+ffmpeg -framerate 8 -pattern_type glob -i "$frames/*.png" -vf "$filters,palettegen" -y $palette
+ffmpeg -framerate 8 -pattern_type glob -i "$frames/*.png" -i $palette -lavfi "$filters [x]; [x][1:v] paletteuse" -y $2
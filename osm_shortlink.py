@@ -31,15 +31,46 @@ def short_osm(lat, lon, zoom=16, marker=False):
     """
     marker = '?m' if marker else ''
     return 'http://osm.org/go/{0}{1}'.format(
-        _encode(lat, lon, zoom),
+        encode(lat, lon, zoom),
         marker)
 
 
-def _encode(lat, lon, z):
+def decode(code):
+    """Return (lat, lon, zoom) for a short link or code made by short_osm.
+    lat, lon is the south-west corner of the area the code stands for.
+
+    >>> decode('http://osm.org/go/wAAA--')
+    (0.0, 0.0, 3)
+    """
+    code = code.rsplit('/', 1)[-1].split('?')[0].replace('@', '~')
+    value = 0
+    digits = dashes = 0
+    for char in code:
+        if char in '-=':
+            dashes += 1
+            continue
+        value |= ARRAY.index(char) << (56 - 6 * digits)
+        digits += 1
+    x, y = deinterleave(value)
+    return (y * 180.0 / 2**32 - 90.0, x * 360.0 / 2**32 - 180.0,
+            digits * 3 - 8 - (-dashes % 3))
+
+
+def lat_lon_code(lat, lon):
+    """Return the 62 bit interleaved code of a location, of which short
+    links are the leading digits. lat and lon may be NumPy arrays."""
+    return interleave(_fixed((lon + 180.0) * 2**32 / 360.0),
+                      _fixed((lat + 090.0) * 2**32 / 180.0))
+
+
+def _fixed(value):
+    """value as an unsigned integer; NumPy arrays become uint64 arrays."""
+    return value.astype('uint64') if hasattr(value, 'astype') else long(value)
+
+
+def encode(lat, lon, z):
     """given a location and zoom, return a short string representing it."""
-    x = long((lon + 180.0) * 2**32 / 360.0)
-    y = long((lat + 090.0) * 2**32 / 180.0)
-    code = _interleave(x, y)
+    code = lat_lon_code(lat, lon)
     str = ''
     # add eight to the zoom level, which approximates an accuracy of
     # one pixel in a tile.
@@ -54,13 +85,34 @@ def _encode(lat, lon, z):
     return str
 
 
-def _interleave(x, y):
-    """combine 2 32 bit integers to a 64 bit integer"""
-    c = 0
-    for i in range(31, 0, -1):
-        c = (c << 1) | ((x >> i) & 1)
-        c = (c << 1) | ((y >> i) & 1)
-    return c
+def _spread(v):
+    """move bit i of a 32 bit integer to bit 2i"""
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    return (v | (v << 1)) & 0x5555555555555555
+
+
+def _compact(v):
+    """the inverse of _spread: move bit 2i to bit i"""
+    v = v & 0x5555555555555555
+    v = (v | (v >> 1)) & 0x3333333333333333
+    v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v >> 4)) & 0x00FF00FF00FF00FF
+    v = (v | (v >> 8)) & 0x0000FFFF0000FFFF
+    return (v | (v >> 16)) & 0x00000000FFFFFFFF
+
+
+def interleave(x, y):
+    """combine 2 32 bit integers to a 64 bit integer: bits 31..1 of x and y
+    alternate, x first, from bit 61 down. x and y may be uint64 arrays."""
+    return (_spread((x >> 1) & 0x7FFFFFFF) << 1) | _spread((y >> 1) & 0x7FFFFFFF)
+
+
+def deinterleave(c):
+    """split a code from interleave back into x, y (bit 0 of each is lost)"""
+    return (_compact(c >> 1) << 1, _compact(c) << 1)
 
 
 if __name__ == '__main__':
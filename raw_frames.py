@@ -0,0 +1,160 @@
+"""
+Uncompressed, memory-mapped copies of full disk frames.
+
+A frame is decoded once into a `.npy` array of RGB pixels; cropping it is
+then a slice of a memory map, with no decoding and only the rows of the
+window paged in. At about 90 MB per 5500x5500 frame this is far bigger than
+the JPEG or its tiles, so build_missing only keeps raw copies of the newest
+frames that fit in a byte budget (and leaves a margin of free disk); older
+frames are read from the tile cache as before.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import logging
+import os
+import shutil
+from os.path import basename, dirname, exists, join, splitext
+
+import numpy as np
+from PIL import Image
+
+from common import PART_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+RAW_FOLDER = 'raw'
+# Rows converted at a time when writing, so only one decoded frame (plus a
+# band) is held in memory.
+WRITE_BAND = 256
+# Free disk left alone when writing raw frames.
+FREE_MARGIN = 512 * 1024 * 1024
+
+
+def raw_path(frame):
+    """Returns the path of the raw copy of `frame`."""
+    return join(dirname(frame), RAW_FOLDER, splitext(basename(frame))[0] + '.npy')
+
+
+def has_raw(frame):
+    return exists(raw_path(frame))
+
+
+def raw_size(width, height):
+    """Bytes taken by the raw copy of a `width` x `height` frame, give or
+    take the .npy header."""
+    return width * height * 3
+
+
+def build_raw(frame):
+    """
+    Decodes `frame` into its raw copy, written to a scratch file that is
+    renamed into place at the end.
+
+    Returns:
+        int: bytes written.
+    """
+    out = raw_path(frame)
+    if not exists(dirname(out)):
+        os.makedirs(dirname(out))
+    tmp = out + PART_SUFFIX
+
+    im = Image.open(frame)
+    im.load()
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+    width, height = im.size
+    try:
+        arr = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8,
+                                        shape=(height, width, 3))
+        for top in range(0, height, WRITE_BAND):
+            bottom = min(top + WRITE_BAND, height)
+            arr[top:bottom] = np.asarray(im.crop((0, top, width, bottom)))
+        arr.flush()
+        del arr
+        os.rename(tmp, out)
+    finally:
+        if exists(tmp):
+            os.remove(tmp)
+    logger.debug("Wrote raw copy of %s to %s", frame, out)
+    return os.path.getsize(out)
+
+
+def delete_raw(frame):
+    if has_raw(frame):
+        os.remove(raw_path(frame))
+
+
+def disk_usage(folder):
+    """
+    Returns:
+        dict: 'frames' and 'bytes' of the raw copies of frames in `folder`,
+            and 'free' bytes left on its disk.
+    """
+    raw = join(folder, RAW_FOLDER)
+    names = [n for n in os.listdir(raw) if n.endswith('.npy')] if exists(raw) else []
+    return {
+        'frames': len(names),
+        'bytes': sum(os.path.getsize(join(raw, n)) for n in names),
+        'free': shutil.disk_usage(folder).free,
+    }
+
+
+def build_missing(frames, budget, free_margin=FREE_MARGIN):
+    """
+    Gives the newest of `frames` raw copies, as many as fit in `budget`
+    bytes without leaving less than `free_margin` bytes of free disk, and
+    drops the raw copies of the rest. Frames that fail to decode are logged
+    and skipped.
+
+    Returns:
+        list: the frames left without a raw copy, oldest first.
+    """
+    used = 0
+    left_out = []
+    for frame in reversed(frames):
+        if has_raw(frame):
+            size = os.path.getsize(raw_path(frame))
+            if used + size <= budget:
+                used += size
+                continue
+            delete_raw(frame)
+            left_out.append(frame)
+            continue
+        try:
+            with Image.open(frame) as im:
+                size = raw_size(*im.size)
+        except Exception:
+            logger.error("Failed to read %s", frame, exc_info=True)
+            continue
+        free = shutil.disk_usage(dirname(frame)).free
+        if used + size > budget or free - size < free_margin:
+            left_out.append(frame)
+            continue
+        try:
+            used += build_raw(frame)
+        except Exception:
+            logger.error("Failed to write raw copy of %s", frame, exc_info=True)
+            left_out.append(frame)
+    return left_out[::-1]
+
+
+def read_regions(frame, boxes):
+    """
+    Returns each of `boxes` (left, top, right, bottom) from the raw copy of
+    `frame` as an RGB image. Parts of a box outside the frame are black.
+    """
+    arr = np.load(raw_path(frame), mmap_mode='r')
+    height, width = arr.shape[:2]
+    regions = []
+    for left, top, right, bottom in boxes:
+        inside = (max(left, 0), max(top, 0), min(right, width), min(bottom, height))
+        if inside == (left, top, right, bottom):
+            regions.append(Image.fromarray(np.ascontiguousarray(arr[top:bottom, left:right])))
+            continue
+        region = Image.new('RGB', (right - left, bottom - top))
+        if inside[0] < inside[2] and inside[1] < inside[3]:
+            part = np.ascontiguousarray(arr[inside[1]:inside[3], inside[0]:inside[2]])
+            region.paste(Image.fromarray(part), (inside[0] - left, inside[1] - top))
+        regions.append(region)
+    return regions
@@ -0,0 +1,256 @@
+"""
+Resident scheduler for the bots.
+
+Cron starts every run cold, so each one pays the full import cost of Pillow,
+Shapely, pyproj and python-twitter and opens fresh HTTP connections. Here the
+jobs run in one long-lived process instead: modules are imported once, the
+shared downloader session stays warm, and every job runs on its own worker
+thread so that a slow hires render can't hold up a lowres run.
+
+Runs are aligned to the 10-minute Himawari cadence (the same slots
+round_time_10 rounds to), a job that is still running when its next slot
+comes up is skipped rather than started twice, and per-job durations and
+failures are written to STATS_FILE after every run.
+
+    python scheduler.py [job ...]
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import argparse
+import datetime
+import fcntl
+import importlib
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, dirname, join
+
+from common import save_json_atomic, set_up_logging, set_up_metrics
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = dirname(abspath(__file__))
+LOGFILE = join(BASE_DIR, 'scheduler.log')
+STATS_FILE = join(BASE_DIR, 'scheduler_stats.json')
+METRICS_FILE = join(BASE_DIR, 'metrics.jsonl')
+LOCK_DIR = BASE_DIR
+
+# Himawari takes a full disk image every 10 minutes.
+CADENCE = 600
+
+# name: (module, function, interval, offset). Intervals and offsets are in
+# seconds and multiples of CADENCE; these match the old cron entries and the
+# ftp_lowres loop.
+JOBS = {
+    'lowres': ('himawari_lowres', 'main', 4 * 3600, 0),
+    'ftp': ('ftp_lowres', 'main', 3 * 3600, 0),
+    'hires': ('himawari_hires', 'tweet_video', 4 * 3600, 0),
+}
+
+
+def next_slot(now, interval, offset=0):
+    """Returns the first time after `now` that is `offset` seconds past a
+    multiple of `interval` since the epoch."""
+    return ((now - offset) // interval + 1) * interval + offset
+
+
+class JobStats(object):
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_start = None
+        self.last_seconds = None
+        self.total_seconds = 0.0
+        self.last_error = None
+
+    def as_dict(self):
+        return dict(vars(self), mean_seconds=(self.total_seconds / self.runs
+                                              if self.runs else None))
+
+
+class Job(object):
+    """
+    Args:
+        name (str): used in logs, stats and the lock file name.
+        func (callable): run with no arguments.
+        interval, offset (int): see next_slot.
+        lock_dir (str, optional): if given, runs also hold an exclusive lock
+            on `<lock_dir>/<name>.lock`, so they can't overlap a run started
+            by another process (e.g. a leftover cron entry).
+    """
+
+    def __init__(self, name, func, interval, offset=0, lock_dir=None):
+        if interval % CADENCE or offset % CADENCE:
+            raise ValueError("{0}: interval and offset must be multiples of {1}s".format(
+                name, CADENCE))
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.offset = offset
+        self.lock_path = join(lock_dir, '{0}.lock'.format(name)) if lock_dir else None
+        self.stats = JobStats()
+        # One thread per job: runs of a job never overlap, and anything the
+        # job keeps between runs (e.g. the frame store's sqlite connection)
+        # is always used from the same thread.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def next_run(self, now):
+        return next_slot(now, self.interval, self.offset)
+
+    def is_running(self):
+        return self.future is not None and not self.future.done()
+
+    def _acquire_file_lock(self):
+        if self.lock_path is None:
+            return None
+        lock = open(self.lock_path, 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock.close()
+            raise
+        return lock
+
+    def run(self):
+        """Runs the job once, recording how long it took and whether it
+        failed. Exceptions are logged, not raised."""
+        try:
+            lock = self._acquire_file_lock()
+        except (IOError, OSError):
+            logger.warning("%s is locked by another process, skipping", self.name)
+            self.stats.skipped += 1
+            return False
+
+        logger.info("Starting %s", self.name)
+        start = time.time()
+        self.stats.last_start = start
+        ok = True
+        try:
+            self.func()
+            self.stats.last_error = None
+        except Exception:
+            ok = False
+            self.stats.failures += 1
+            self.stats.last_error = traceback.format_exc(limit=5)
+            logger.error("%s failed", self.name, exc_info=True)
+        finally:
+            if lock is not None:
+                lock.close()
+        self.stats.last_seconds = time.time() - start
+        self.stats.total_seconds += self.stats.last_seconds
+        self.stats.runs += 1
+        logger.info("Finished %s in %.1fs", self.name, self.stats.last_seconds)
+        return ok
+
+    def submit(self):
+        """Starts a run on the job's thread unless one is still going.
+
+        Returns:
+            bool: whether a run was started.
+        """
+        if self.is_running():
+            logger.warning("%s is still running, skipping this slot", self.name)
+            self.stats.skipped += 1
+            return False
+        self.future = self.executor.submit(self.run)
+        return True
+
+
+class Scheduler(object):
+    """
+    Args:
+        jobs (list): Job instances.
+        stats_file (str, optional): where to write job stats after each run.
+        clock, sleep (callable): for tests. By default sleeping is cut short
+            by stop().
+    """
+
+    def __init__(self, jobs, stats_file=None, clock=time.time, sleep=None):
+        self.jobs = jobs
+        self.stats_file = stats_file
+        self.clock = clock
+        self._stopped = threading.Event()
+        self.sleep = sleep or self._stopped.wait
+        self._stats_lock = threading.Lock()
+        self.next_runs = {}
+
+    def write_stats(self, *args):
+        if self.stats_file is None:
+            return
+        with self._stats_lock:
+            data = {job.name: job.stats.as_dict() for job in self.jobs}
+            save_json_atomic(self.stats_file, data, indent=2, sort_keys=True)
+
+    def submit(self, job):
+        if job.submit():
+            job.future.add_done_callback(self.write_stats)
+
+    def run_pending(self, due):
+        """Submits every job whose next run is at or before `due`, and
+        returns the time the next job is due after that."""
+        for job in self.jobs:
+            if self.next_runs[job.name] <= due:
+                self.submit(job)
+                self.next_runs[job.name] = job.next_run(max(due, self.clock()))
+        return min(self.next_runs.values())
+
+    def run_forever(self, run_now=False):
+        """
+        Runs jobs at their slots until stop() is called.
+
+        Args:
+            run_now (bool): run every job once straight away, rather than
+                waiting for its first slot.
+        """
+        now = self.clock()
+        self.next_runs = {job.name: now if run_now else job.next_run(now) for job in self.jobs}
+        due = min(self.next_runs.values())
+        while not self._stopped.is_set():
+            wait = due - self.clock()
+            if wait > 0:
+                logger.debug("Next run at %s", datetime.datetime.utcfromtimestamp(due))
+                self.sleep(wait)
+                continue
+            due = self.run_pending(due)
+
+    def stop(self, wait=True):
+        self._stopped.set()
+        for job in self.jobs:
+            job.executor.shutdown(wait=wait)
+
+
+def load_job(name, lock_dir=LOCK_DIR):
+    """Imports the module for one of JOBS once, up front, and wraps it."""
+    module, func, interval, offset = JOBS[name]
+    return Job(name, getattr(importlib.import_module(module), func), interval, offset,
+               lock_dir=lock_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the bots on a schedule.")
+    parser.add_argument('jobs', nargs='*', default=sorted(JOBS),
+                        help="jobs to run: {0} (default: all)".format(', '.join(sorted(JOBS))))
+    parser.add_argument('--now', action='store_true',
+                        help="run every job once at startup")
+    args = parser.parse_args()
+    unknown = set(args.jobs) - set(JOBS)
+    if unknown:
+        parser.error("unknown jobs: {0}".format(', '.join(sorted(unknown))))
+
+    set_up_logging(log_file=LOGFILE)
+    set_up_metrics(metrics_file=METRICS_FILE)
+    scheduler = Scheduler([load_job(name) for name in args.jobs], stats_file=STATS_FILE)
+    logger.info("Scheduling %s", ', '.join(args.jobs))
+    try:
+        scheduler.run_forever(run_now=args.now)
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# encoding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+from benchmarks import standins
+from cira_listing import CiraListing, parse_links
+from downloader import Downloader, make_session
+
+LINK = '<tr><td><a href="images/{0}">Hi-Res Image</a> <a href="thumbs/{0}">Thumb</a></td></tr>\n'
+
+
+def archive_page(names):
+    return ('<html><body><table>\n' + ''.join(LINK.format(n) for n in names) +
+            '</table></body></html>\n').encode('utf-8')
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """Serves server.page with an ETag, answering a matching If-None-Match
+    with a 304."""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        etag = '"{0}"'.format(server.version)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(server.page)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        try:
+            self.wfile.write(server.page)
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class ParseLinksTests(unittest.TestCase):
+    def test_stops_at_limit(self):
+        page = archive_page(['f{0}.jpg'.format(i) for i in range(100)])
+        chunks = [page[i:i + 10] for i in range(0, len(page), 10)]
+        fed = []
+
+        def feed():
+            for chunk in chunks:
+                fed.append(chunk)
+                yield chunk
+
+        self.assertEqual(parse_links(feed(), limit=3),
+                         ['images/f0.jpg', 'images/f1.jpg', 'images/f2.jpg'])
+        self.assertLess(len(fed), len(chunks) // 10)
+
+    def test_whole_page(self):
+        page = archive_page(['a.jpg', 'b.jpg']) + b'<a href="x">Hi-Res Image (old)</a>'
+        self.assertEqual(parse_links([page]), ['images/a.jpg', 'images/b.jpg', 'x'])
+
+
+class CiraListingTests(unittest.TestCase):
+    def setUp(self):
+        self.server = standins.serve(ArchiveHandler, requests=[])
+        self.publish(['f2.jpg', 'f1.jpg'])
+        self.url = self.server.url + '/archive_hi_res.asp'
+        self.folder = tempfile.mkdtemp()
+        self.cache = os.path.join(self.folder, 'cira_listing.json')
+
+    def tearDown(self):
+        standins.stop(self.server)
+        shutil.rmtree(self.folder)
+
+    def publish(self, names):
+        self.server.page = archive_page(names)
+        self.server.version = getattr(self.server, 'version', 0) + 1
+
+    def listing(self):
+        return CiraListing(self.url, cache_file=self.cache,
+                           downloader=Downloader(session=make_session(), backoff=0.01))
+
+    def test_only_new_frames_are_reported(self):
+        listing = self.listing()
+        self.assertEqual(listing.refresh(num=2), ['images/f2.jpg', 'images/f1.jpg'])
+        self.assertEqual(listing.new, ['images/f2.jpg', 'images/f1.jpg'])
+
+        self.publish(['f3.jpg', 'f2.jpg', 'f1.jpg'])
+        listing = self.listing()
+        self.assertEqual(listing.refresh(num=2), ['images/f3.jpg', 'images/f2.jpg'])
+        self.assertEqual(listing.new, ['images/f3.jpg'])
+
+    def test_unchanged_page_is_not_downloaded_again(self):
+        self.listing().refresh(num=2)
+        listing = self.listing()
+        self.assertEqual(listing.refresh(num=2), ['images/f2.jpg', 'images/f1.jpg'])
+        self.assertFalse(listing.modified)
+        self.assertEqual(listing.new, [])
+        self.assertEqual(self.server.requests[-1]['If-None-Match'], '"1"')
+
+    def test_deeper_listing_fetches_whole_page(self):
+        self.listing().refresh(num=1)
+        listing = self.listing()
+        self.assertEqual(listing.refresh(num=2), ['images/f2.jpg', 'images/f1.jpg'])
+        self.assertTrue(listing.modified)
+        self.assertNotIn('If-None-Match', self.server.requests[-1])
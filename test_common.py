@@ -0,0 +1,190 @@
+# encoding: utf-8
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import types
+import unittest
+
+import common
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Loaded only by the stages that need them, never at bot startup.
+HEAVY_MODULES = ('PIL.Image', 'numpy', 'shapely', 'pyproj', 'twitter')
+ENTRY_POINTS = ('himawari_hires', 'himawari_lowres', 'ftp_lowres', 'scheduler')
+# Cumulative import time allowed per entry point; they come in at around
+# a tenth of a second, most of it requests.
+STARTUP_BUDGET = 0.5
+
+
+def import_profile(module):
+    """Imports `module` in a fresh interpreter under -X importtime.
+
+    Returns:
+        dict: cumulative import time in seconds of each module imported.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')]))
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                         cwd=REPO_DIR, env=env, stderr=subprocess.PIPE, check=True).stderr
+    profile = {}
+    for line in out.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        profile[name.strip()] = int(cumulative) / 1e6
+    return profile
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_stages_and_counters(self):
+        metrics = common.Metrics('test', sinks=[])
+        with metrics.stage('download'):
+            metrics.incr('bytes_downloaded', 100)
+        with self.assertRaises(ValueError):
+            with metrics.stage('download'):
+                raise ValueError()
+        threads = [threading.Thread(target=metrics.incr, args=('frames',)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        metrics.gauge('gif_bytes', 5)
+
+        snapshot = metrics.flush()
+        self.assertEqual(list(snapshot['stages']), ['download'])
+        self.assertGreater(snapshot['stages']['download']['peak_rss_mb'], 0)
+        self.assertEqual(snapshot['counters'], {'bytes_downloaded': 100, 'frames': 8})
+        self.assertEqual(snapshot['gauges'], {'gif_bytes': 5})
+        self.assertEqual(metrics.snapshot()['stages'], {})
+
+    def test_sinks(self):
+        jsonl = os.path.join(self.folder, 'metrics.jsonl')
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5)
+        metrics = common.Metrics('lowres', sinks=[
+            common.JsonLinesSink(jsonl),
+            common.PrometheusTextfileSink(self.folder),
+            common.StatsdSink('127.0.0.1', receiver.getsockname()[1]),
+        ])
+        for _ in range(2):
+            with metrics.stage('render_gif'):
+                metrics.incr('frames_processed', 3)
+            metrics.flush()
+
+        with open(jsonl) as f:
+            runs = [json.loads(line) for line in f]
+        self.assertEqual(len(runs), 2)
+        self.assertEqual(runs[1]['job'], 'lowres')
+        self.assertEqual(runs[1]['counters'], {'frames_processed': 3})
+
+        with open(os.path.join(self.folder, 'himawari_lowres.prom')) as f:
+            prom = f.read()
+        self.assertIn('himawari_frames_processed_total{job="lowres"} 3\n', prom)
+        self.assertIn('himawari_stage_seconds{job="lowres",stage="render_gif"} ', prom)
+
+        packets = [receiver.recv(1024).decode('utf-8') for _ in range(2)]
+        receiver.close()
+        self.assertTrue(packets[0].startswith('himawari.lowres.render_gif.seconds:'))
+        self.assertEqual(packets[1], 'himawari.lowres.frames_processed:3|c')
+
+
+class LoggingTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.root = logging.getLogger()
+        self.saved = (self.root.level, list(self.root.handlers))
+
+    def tearDown(self):
+        for handler in self.root.handlers:
+            if handler not in self.saved[1]:
+                self.root.removeHandler(handler)
+                handler.close()
+        self.root.setLevel(self.saved[0])
+        shutil.rmtree(self.folder)
+
+    def test_set_up_logging(self):
+        log_file = os.path.join(self.folder, 'bot.log')
+        common.set_up_logging(log_file=log_file)
+        common.set_up_logging(log_file=log_file)
+        self.assertEqual(len(self.root.handlers), len(self.saved[1]) + 1)
+
+        logging.getLogger('downloader').debug('ours')
+        logging.getLogger('urllib3.connectionpool').debug('theirs')
+        with open(log_file) as f:
+            lines = f.read().splitlines()
+        self.assertEqual([line.rsplit(' - ', 1)[1] for line in lines], ['ours'])
+
+
+class JsonFileTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_round_trip(self):
+        self.assertEqual(common.load_json(None, []), [])
+        self.assertEqual(common.load_json(self.path, {}), {})
+        common.save_json_atomic(self.path, {'a': [1, 2]}, indent=2)
+        self.assertEqual(common.load_json(self.path, {}), {'a': [1, 2]})
+        self.assertEqual(os.listdir(self.folder), ['cache.json'])
+
+    def test_unreadable_file_gives_the_default(self):
+        with open(self.path, 'w') as f:
+            f.write('{"a": ')
+        self.assertEqual(common.load_json(self.path, {}), {})
+
+
+class StartupTests(unittest.TestCase):
+    def test_lazy_import(self):
+        name = 'json.tool'
+        sys.modules.pop(name, None)
+        module = common.lazy_import(name)
+        self.assertIs(sys.modules[name], module)
+        self.assertTrue(callable(module.main))
+        self.assertIs(common.lazy_import(name), module)
+        with self.assertRaises(ImportError):
+            common.lazy_import('no_such_module_here')
+
+    def test_failed_lazy_import_fails_again(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        with open(os.path.join(folder, 'lazy_broken.py'), 'w') as f:
+            f.write('VALUE = 1\nraise ValueError("broken")\n')
+        sys.path.insert(0, folder)
+        self.addCleanup(sys.path.remove, folder)
+        self.addCleanup(sys.modules.pop, 'lazy_broken', None)
+
+        module = common.lazy_import('lazy_broken')
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                module.VALUE
+
+    def test_preload(self):
+        name = 'json.tool'
+        sys.modules.pop(name, None)
+        module = common.lazy_import(name)
+        common.preload(module)
+        self.assertIs(type(module), types.ModuleType)
+        self.assertIn('main', vars(module))
+
+    def test_entry_points_start_light(self):
+        for entry in ENTRY_POINTS:
+            profile = import_profile(entry)
+            self.assertEqual([m for m in HEAVY_MODULES if m in profile], [], entry)
+            self.assertLess(profile[entry], STARTUP_BUDGET, entry)
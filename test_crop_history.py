@@ -0,0 +1,57 @@
+# encoding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from crop_history import CropHistory, cell_keys, neighbourhood
+
+
+class CropHistoryTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.history_file = os.path.join(self.folder, 'crop_history.json')
+        self.now = 1000000.0
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def make_history(self, max_age=3600):
+        return CropHistory(self.history_file, max_age=max_age, clock=lambda: self.now)
+
+    def test_covered_near_recorded_posts(self):
+        history = self.make_history()
+        history.record(-33.9, 151.2)
+        covered = history.covered([-33.0, -35.0, 35.7, np.nan], [150.0, 152.5, 139.7, 140.0])
+        self.assertEqual(covered.tolist(), [True, True, False, False])
+
+    def test_history_is_saved_and_expires(self):
+        self.make_history().record(35.7, 139.7)
+        self.now += 1800
+        self.make_history().record(-33.9, 151.2)
+
+        history = self.make_history()
+        self.assertEqual(len(history), 2)
+        lat, lon = history.locations()[0]
+        self.assertAlmostEqual(lat, 35.7, places=2)
+        self.assertAlmostEqual(lon, 139.7, places=2)
+
+        self.now += 2400
+        history = self.make_history()
+        self.assertEqual(len(history), 1)
+        self.assertFalse(history.covered([35.7], [139.7])[0])
+        self.assertTrue(history.covered([-33.9], [151.2])[0])
+
+    def test_neighbourhood_wraps_in_longitude(self):
+        key = int(cell_keys(0.0, 179.9))
+        cells = neighbourhood(key)
+        self.assertEqual(len(cells), 9)
+        self.assertIn(int(cell_keys(0.0, -179.9)), cells)
+        # Nothing beyond the poles.
+        self.assertEqual(len(neighbourhood(int(cell_keys(89.9, 0.0)))), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
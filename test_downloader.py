@@ -0,0 +1,137 @@
+# encoding: utf-8
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+from benchmarks import standins
+from downloader import Downloader, DownloadJob, make_session
+
+FRAME = b'\xff\xd8\xff\xe0' + b'\x00' * 4096
+
+
+class FrameHandler(BaseHTTPRequestHandler):
+    """Serves fake frames: /<n>.jpg, a tiny broken /small.jpg, an HTML
+    /error.jpg, a /flaky.jpg that fails with a 503 the first time and a 404
+    for /missing.jpg."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.hits[self.path] = server.hits.get(self.path, 0) + 1
+            hits = server.hits[self.path]
+        try:
+            if self.path == '/flaky.jpg' and hits == 1:
+                self.send_response(503)
+                self.end_headers()
+                return
+            if self.path == '/missing.jpg':
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.path == '/small.jpg':
+                body = b'oops'
+            elif self.path == '/error.jpg':
+                body = b'<html>Not Found</html>' * 100
+            else:
+                body = FRAME
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloaderTests(unittest.TestCase):
+    def setUp(self):
+        self.server = standins.serve(FrameHandler, lock=threading.Lock(), active=0,
+                                     max_active=0, hits={})
+        self.base = self.server.url
+        self.folder = tempfile.mkdtemp()
+        self.downloader = Downloader(session=make_session(), workers=4, per_host=2,
+                                     backoff=0.01, min_size=1024)
+
+    def tearDown(self):
+        standins.stop(self.server)
+        shutil.rmtree(self.folder)
+
+    def jobs(self, *names):
+        return [DownloadJob('{0}/{1}'.format(self.base, n), os.path.join(self.folder, n))
+                for n in names]
+
+    def test_download_batch(self):
+        names = ['{0}.jpg'.format(i) for i in range(10)]
+        stats = self.downloader.download(self.jobs(*names))
+        self.assertEqual(stats.downloaded, 10)
+        self.assertEqual(stats.bytes, 10 * len(FRAME))
+        self.assertEqual(sorted(os.listdir(self.folder)), sorted(names))
+        self.assertLessEqual(self.server.max_active, 2)
+        self.assertGreater(stats.frames_per_sec, 0)
+
+    def test_skips_existing_and_drops_corrupt(self):
+        with open(os.path.join(self.folder, 'have.jpg'), 'wb') as f:
+            f.write(FRAME)
+        stats = self.downloader.download(self.jobs('have.jpg', 'small.jpg'))
+        self.assertEqual(stats.skipped, 1)
+        self.assertEqual(stats.corrupt, 1)
+        self.assertNotIn('/have.jpg', self.server.hits)
+        self.assertEqual(os.listdir(self.folder), ['have.jpg'])
+
+    def test_retries_server_errors(self):
+        stats = self.downloader.download(self.jobs('flaky.jpg'))
+        self.assertEqual(stats.downloaded, 1)
+        self.assertEqual(self.server.hits['/flaky.jpg'], 2)
+
+    def test_backoff_frees_the_host_slot(self):
+        self.downloader.per_host = 1
+        free = []
+        limit = self.downloader._host_limit(self.base + '/')
+
+        def sleep(attempt):
+            free.append(limit.acquire(False))
+            if free[-1]:
+                limit.release()
+        self.downloader._sleep_before_retry = sleep
+        stats = self.downloader.download(self.jobs('flaky.jpg'))
+        self.assertEqual((stats.downloaded, free), (1, [True]))
+
+    def test_not_found_is_missing(self):
+        stats = self.downloader.download(self.jobs('missing.jpg', 'a.jpg'))
+        self.assertEqual((stats.missing, stats.failed, stats.downloaded), (1, 0, 1))
+        self.assertEqual(self.server.hits['/missing.jpg'], 1)
+
+    def test_get_holds_the_host_slot_until_closed(self):
+        self.downloader.per_host = 1
+        limit = self.downloader._host_limit(self.base + '/')
+        with self.downloader.get(self.base + '/a.jpg', stream=True) as resp:
+            self.assertFalse(limit.acquire(False))
+            self.assertEqual(resp.raw.read(), FRAME)
+        self.assertTrue(limit.acquire(False))
+        limit.release()
+
+    def test_rejects_non_image_without_leaving_partials(self):
+        stats = self.downloader.download(self.jobs('error.jpg', 'ok.jpg'))
+        self.assertEqual(stats.corrupt, 1)
+        self.assertEqual(os.listdir(self.folder), ['ok.jpg'])
+        with open(os.path.join(self.folder, 'ok.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), FRAME)
+
+    def test_small_chunks(self):
+        self.downloader.chunk_size = 3
+        stats = self.downloader.download(self.jobs('a.jpg'))
+        self.assertEqual(stats.bytes, len(FRAME))
+        self.assertEqual(stats.files, [os.path.join(self.folder, 'a.jpg')])
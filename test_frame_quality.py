@@ -0,0 +1,110 @@
+# encoding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from common import Metrics
+import frame_quality
+from frame_quality import QualityCache, check_frames, filter_frames, link_frames
+
+
+def disk(seed, size=550):
+    """A noisy disk on black, roughly like a full disk frame."""
+    noise = np.random.RandomState(seed).randint(0, 256, (size // 10, size // 10, 3))
+    im = Image.fromarray(noise.astype(np.uint8)).resize((size, size), Image.BILINEAR)
+    mask = Image.new('L', (size, size))
+    ImageDraw.Draw(mask).ellipse((10, 10, size - 10, size - 10), fill=255)
+    out = Image.new('RGB', (size, size))
+    out.paste(im, mask=mask)
+    return out
+
+
+class FrameQualityTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.folder, 'quality.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def save(self, name, im):
+        path = os.path.join(self.folder, name)
+        im.save(path)
+        return path
+
+    def test_rejects_blank_partial_and_repeated_frames(self):
+        partial = disk(3)
+        ImageDraw.Draw(partial).rectangle((0, 300, 550, 550), fill=(0, 0, 0))
+        frames = [self.save('a.jpg', disk(1)),
+                  self.save('b.jpg', disk(1)),
+                  self.save('c.jpg', Image.new('RGB', (550, 550))),
+                  self.save('d.jpg', partial),
+                  self.save('e.jpg', disk(2))]
+        kept, stats = filter_frames(frames)
+        self.assertEqual(kept, [frames[0], frames[4]])
+        self.assertEqual((stats.duplicate, stats.blank, stats.partial), (1, 1, 1))
+        self.assertEqual(stats.rejected, 3)
+
+    def test_night_side_is_not_partial(self):
+        # Only a crescent of the disk is lit, so the rows through the middle
+        # are flat across most of it, but none reach the top or bottom edge.
+        evening, top_missing = disk(5), disk(6)
+        ImageDraw.Draw(evening).rectangle((0, 0, 430, 550), fill=(0, 0, 0))
+        ImageDraw.Draw(top_missing).rectangle((0, 0, 550, 200), fill=(0, 0, 0))
+        frames = [self.save('a.png', evening), self.save('b.png', top_missing)]
+        kept, stats = filter_frames(frames)
+        self.assertEqual((kept, stats.partial), ([frames[0]], 1))
+
+    def test_unreadable_frames_are_rejected(self):
+        good = self.save('a.png', disk(1))
+        bad = os.path.join(self.folder, 'b.png')
+        with open(bad, 'wb') as f:
+            f.write(b'not an image')
+        kept, stats = filter_frames([good, bad, os.path.join(self.folder, 'missing.png')])
+        self.assertEqual(kept, [good])
+        self.assertEqual(stats.unreadable, 2)
+
+    def test_features_are_cached(self):
+        frames = [self.save('{0}.png'.format(i), disk(i)) for i in range(3)]
+        first = QualityCache(self.cache_file).analyze(frames)
+
+        old_thumbnail, calls = frame_quality.thumbnail, []
+        frame_quality.thumbnail = lambda path: calls.append(path) or old_thumbnail(path)
+        try:
+            self.save('1.png', disk(1).transpose(Image.FLIP_LEFT_RIGHT))
+            os.utime(frames[1], (0, 0))
+            second = QualityCache(self.cache_file).analyze(frames[1:])
+        finally:
+            frame_quality.thumbnail = old_thumbnail
+
+        # Only the changed frame is looked at again; the dropped one is pruned.
+        self.assertEqual(calls, [frames[1]])
+        self.assertEqual(second[1], first[2])
+        self.assertNotEqual(second[0]['hash'], first[1]['hash'])
+        self.assertEqual(sorted(QualityCache(self.cache_file).entries), ['1.png', '2.png'])
+
+    def test_check_frames_counts_rejections(self):
+        frames = [self.save('a.png', disk(1)), self.save('b.png', disk(1))]
+        metrics = Metrics('test', sinks=[])
+        self.assertEqual(check_frames(frames, self.cache_file, metrics), frames[:1])
+        snapshot = metrics.snapshot()
+        self.assertEqual((snapshot['counters']['frames_rejected'],
+                          snapshot['counters']['frames_duplicate']), (1, 1))
+        self.assertIn('quality', snapshot['stages'])
+        self.assertTrue(os.path.exists(self.cache_file))
+
+    def test_link_frames(self):
+        frames = [self.save('{0}.png'.format(i), disk(i)) for i in range(3)]
+        out = os.path.join(self.folder, 'render')
+        link_frames(frames, out)
+        link_frames(frames[::2], out)
+        self.assertEqual(sorted(os.listdir(out)), ['0.png', '2.png'])
+        self.assertEqual(os.path.realpath(os.path.join(out, '2.png')), frames[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+# encoding: utf-8
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+from benchmarks import standins
+import frame_sources
+from downloader import Downloader, make_session
+from frame_sources import FtpSource, HttpSource, SourceHealth, SourcePool
+from ftp_mirror import FtpMirror
+
+logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+
+FRAME = b'\x89PNG\r\n\x1a\n' + b'\0' * 20000
+PLACEHOLDER = b'\x89PNG\r\n\x1a\n' + b'\0' * 100
+
+
+class SourceHandler(BaseHTTPRequestHandler):
+    """Serves FRAME for paths in server.available and a placeholder for the
+    rest, after server.delay seconds; answers server.status instead if set."""
+
+    def do_GET(self):
+        self.server.hits.append(self.path)
+        time.sleep(self.server.delay)
+        if self.server.status:
+            self.send_response(self.server.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = FRAME if self.path in self.server.available else PLACEHOLDER
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SourcePoolTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.now = 100000.0
+        self.servers = {}
+        for name in ('a', 'b'):
+            self.servers[name] = standins.serve(
+                SourceHandler, hits=[], delay=0.0, status=None,
+                available=set('/{0}.png'.format(i) for i in range(10)))
+        self.health_file = os.path.join(self.folder, 'health.json')
+
+    def tearDown(self):
+        for server in self.servers.values():
+            standins.stop(server)
+        shutil.rmtree(self.folder)
+
+    def source(self, name):
+        url = self.servers[name].url + '/'
+        folder = os.path.join(self.folder, name)
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        downloader = Downloader(session=make_session(), retries=0, min_size=1024)
+        return HttpSource(name, lambda frame: '{0}{1}.png'.format(url, frame),
+                          lambda frame: os.path.join(folder, '{0}.png'.format(frame)),
+                          downloader=downloader)
+
+    def pool(self, **kwargs):
+        health = SourceHealth(self.health_file, clock=lambda: self.now)
+        return SourcePool([self.source('a'), self.source('b')], health=health, **kwargs)
+
+    def test_fastest_source_goes_first(self):
+        self.servers['a'].delay = 0.05
+        pool = self.pool()
+        stats = pool.fetch([0, 1, 2, 3])
+        # 'a' is first until measured; 'b' gets one frame as a probe.
+        self.assertEqual(stats.sources, {'a': 3, 'b': 1})
+        self.assertEqual([s.name for s in pool.ranked()], ['b', 'a'])
+
+        self.now += 60
+        stats = self.pool().fetch([4, 5, 6])
+        self.assertEqual(stats.sources, {'b': 3})
+        self.assertEqual(stats.downloaded, 3)
+        self.assertGreater(pool.health.records['a']['latency'],
+                           pool.health.records['b']['latency'])
+
+    def test_failed_frames_go_to_the_next_source(self):
+        self.servers['a'].status = 503
+        pool = self.pool(probe_interval=None)
+        stats = pool.fetch([0, 1, 2])
+        self.assertEqual(stats.sources, {'b': 3})
+        self.assertEqual([f.source for f in stats.results], ['b'] * 3)
+        self.assertTrue(os.path.exists(stats.results[0].dest))
+        self.assertFalse(pool.health.is_up('a'))
+
+        # Skipped while cooling down, then tried again once the better
+        # source fails too; failing again doubles the cooldown.
+        pool.fetch([3])
+        self.assertEqual(len(self.servers['a'].hits), 3)
+        self.now += frame_sources.COOLDOWN + 1
+        pool = self.pool(probe_interval=None)
+        self.assertEqual([s.name for s in pool.ranked()], ['b', 'a'])
+        self.servers['b'].status = 503
+        stats = pool.fetch([4])
+        self.assertEqual((stats.failed, len(self.servers['a'].hits)), (1, 4))
+        record = pool.health.records['a']
+        self.assertEqual((record['failures'], record['down_until'] - self.now),
+                         (2, 2 * frame_sources.COOLDOWN))
+
+    def test_missing_frames_are_not_passed_on(self):
+        self.servers['a'].available = set()
+        stats = self.pool(probe_interval=None).fetch([0, 1])
+        self.assertEqual((stats.missing, stats.downloaded), (2, 0))
+        self.assertEqual(self.servers['b'].hits, [])
+
+
+class FtpSourceTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.folder = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'frames'))
+        for name in ('a.JPG', 'b.JPG'):
+            with open(os.path.join(self.root, 'frames', name), 'wb') as f:
+                f.write(FRAME)
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(self.root)
+        handler = type(str('Handler'), (FTPHandler,), {'authorizer': authorizer})
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'timeout': 0.05})
+        self.thread.start()
+        self.mirror = FtpMirror('127.0.0.1', '/frames', self.folder, port=self.server.address[1])
+
+    def tearDown(self):
+        self.mirror.close()
+        self.server.close_all()
+        self.thread.join()
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.folder)
+
+    def test_list_and_fetch(self):
+        pool = SourcePool([FtpSource('noaa', self.mirror)])
+        self.assertEqual(sorted(pool.list()), ['a.JPG', 'b.JPG'])
+        stats = pool.fetch(['a.JPG', 'c.JPG'])
+        self.assertEqual([f.status for f in stats.results], ['downloaded', 'missing'])
+        with open(os.path.join(self.folder, 'a.JPG'), 'rb') as f:
+            self.assertEqual(f.read(), FRAME)
+
+
+if __name__ == '__main__':
+    unittest.main()
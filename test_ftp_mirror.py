@@ -0,0 +1,145 @@
+# encoding: utf-8
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+from ftp_mirror import FtpMirror
+import ftp_lowres
+
+logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+
+NAMES = ['2016-10-23T08:{0}0:00.JPG'.format(i) for i in range(5)]
+
+
+def frame(i):
+    return b'\xff\xd8\xff\xe0' + bytes(bytearray([i])) * 200000
+
+
+class NoMlsdHandler(FTPHandler):
+    def ftp_MLSD(self, path):
+        self.respond('500 Command "MLSD" not understood.')
+
+
+class FtpMirrorTests(unittest.TestCase):
+    handler = FTPHandler
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.folder = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'frames'))
+        for i, name in enumerate(NAMES):
+            self.write_remote(name, frame(i))
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(self.root)
+        handler = type(str('Handler'), (self.handler,), {'authorizer': authorizer})
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'timeout': 0.05})
+        self.thread.start()
+        self.listing = os.path.join(self.folder, 'listing.json')
+        self.mirror = self.make_mirror()
+
+    def tearDown(self):
+        self.mirror.close()
+        self.server.close_all()
+        self.thread.join()
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.folder)
+
+    def make_mirror(self):
+        return FtpMirror('127.0.0.1', '/frames', self.folder, port=self.server.address[1],
+                         listing_file=self.listing, local_name=ftp_lowres.local_name)
+
+    def write_remote(self, name, data):
+        with open(os.path.join(self.root, 'frames', name), 'wb') as f:
+            f.write(data)
+
+    def read_local(self, name):
+        with open(os.path.join(self.folder, ftp_lowres.local_name(name)), 'rb') as f:
+            return f.read()
+
+    def test_sync_and_resync(self):
+        _, stats = ftp_lowres.download_images(num=3, mirror=self.mirror)
+        self.assertEqual(stats.downloaded, 3)
+        self.assertEqual(sorted(f for f in os.listdir(self.folder) if f.endswith('.JPG')),
+                         sorted(ftp_lowres.local_name(n) for n in NAMES[-3:]))
+        self.assertEqual(self.read_local(NAMES[-1]), frame(4))
+
+        self.write_remote('2016-10-23T08:50:00.JPG', frame(5))
+        self.mirror.refresh()
+        stats = self.mirror.download(sorted(self.mirror.listing)[-3:])
+        self.assertEqual((stats.downloaded, stats.skipped), (1, 2))
+        self.assertEqual(self.mirror.connects, 1)
+
+    def test_listing_cache_survives_restart(self):
+        self.mirror.refresh()
+        self.mirror.download(NAMES)
+        self.mirror.close()
+
+        mirror = self.make_mirror()
+        self.assertEqual(set(mirror.listing), set(NAMES))
+        mirror.refresh()
+        stats = mirror.download(NAMES)
+        mirror.close()
+        self.assertEqual((stats.downloaded, stats.skipped), (0, len(NAMES)))
+
+    def test_changed_file_is_fetched_again(self):
+        self.mirror.refresh()
+        self.mirror.download(NAMES)
+        self.write_remote(NAMES[0], frame(9) + b'more')
+        self.mirror.refresh()
+        stats = self.mirror.download(NAMES)
+        self.assertEqual((stats.downloaded, stats.skipped), (1, len(NAMES) - 1))
+        self.assertEqual(self.read_local(NAMES[0]), frame(9) + b'more')
+
+    def test_resumes_partial_download(self):
+        part = os.path.join(self.folder, ftp_lowres.local_name(NAMES[0]) + '.part')
+        with open(part, 'wb') as f:
+            f.write(frame(0)[:50000])
+        # A partial of a listed frame no longer asked for goes; another
+        # downloader's temp file in the same folder stays.
+        for fn in (ftp_lowres.local_name(NAMES[1]) + '.part', '.other.pngx1y2.part'):
+            with open(os.path.join(self.folder, fn), 'wb') as f:
+                f.write(b'x')
+        self.mirror.refresh()
+        stats = self.mirror.download(NAMES[:1])
+        self.assertEqual((stats.downloaded, stats.resumed), (1, 1))
+        self.assertEqual(stats.bytes, len(frame(0)) - 50000)
+        self.assertEqual(self.read_local(NAMES[0]), frame(0))
+        self.assertEqual([f for f in os.listdir(self.folder) if f.endswith('.part')],
+                         ['.other.pngx1y2.part'])
+
+    def test_reconnects_after_dropped_connection(self):
+        self.mirror.refresh()
+        self.mirror.ftp.sock.shutdown(socket.SHUT_RDWR)
+        self.mirror.refresh()
+        stats = self.mirror.download(NAMES)
+        self.assertEqual(stats.downloaded, len(NAMES))
+        self.assertEqual(self.mirror.connects, 2)
+
+
+class NlstFallbackTests(FtpMirrorTests):
+    handler = NoMlsdHandler
+
+    def test_uses_nlst(self):
+        self.mirror.refresh()
+        self.assertFalse(self.mirror._mlsd)
+        self.assertEqual(self.mirror.stat(NAMES[0]).size, len(frame(0)))
+
+    def test_changed_file_is_fetched_again(self):
+        # NLST only tells us about new names, so a rewritten file goes unnoticed.
+        self.mirror.refresh()
+        self.mirror.download(NAMES)
+        self.write_remote(NAMES[0], frame(9))
+        self.mirror.refresh()
+        stats = self.mirror.download(NAMES)
+        self.assertEqual(stats.skipped, len(NAMES))
@@ -0,0 +1,33 @@
+# encoding: utf-8
+import math
+import unittest
+
+import geometry
+
+
+class GeometryTests(unittest.TestCase):
+    PIXELS = [(983, 2708), (2750, 2750), (4617, 2929), (1500, 4000), (3100, 900)]
+
+    def test_px_to_lat_long_array_matches_scalar(self):
+        lat_px, lng_px = zip(*self.PIXELS)
+        lats, lngs = geometry.px_to_lat_long_array(lat_px, lng_px)
+        for (px_lat, px_lng), lat, lng in zip(self.PIXELS, lats, lngs):
+            expected = geometry.px_to_lat_long(px_lat, px_lng)
+            self.assertAlmostEqual(lat, expected[0], places=6)
+            self.assertAlmostEqual(lng, expected[1], places=6)
+
+    def test_space_is_nan(self):
+        lats, lngs = geometry.px_to_lat_long_array([10, 983], [10, 2708])
+        self.assertTrue(math.isnan(lats[0]) and math.isnan(lngs[0]))
+        self.assertFalse(math.isnan(lats[1]))
+
+    def test_lat_long_to_px_array_matches_scalar(self):
+        points = [(35.255679, 139.740923), (-37.8, 144.9), (21.3, -157.8), (0, 100)]
+        lat_px, lng_px = geometry.lat_long_to_px_array(*zip(*points))
+        for (lat, lng), got_lat, got_lng in zip(points, lat_px, lng_px):
+            self.assertEqual((got_lat, got_lng), geometry.lat_long_to_px(lat=lat, lng=lng))
+
+    def test_grid(self):
+        lat, lng = geometry.lat_long_grid(step=500)
+        self.assertEqual(lat.shape, (11, 11))
+        self.assertAlmostEqual(lat[2, 5], geometry.px_to_lat_long(1000, 2500)[0], places=3)
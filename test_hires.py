@@ -0,0 +1,216 @@
+# encoding: utf-8
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+from shapely.geometry import Point
+
+import himawari_hires as hh
+from crop_history import CropHistory
+from crop_index import CropIndex
+import crop_scoring
+import geometry
+import raw_frames
+import tiles
+
+
+class HiResTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.old_folder, hh.HIRES_FOLDER = hh.HIRES_FOLDER, self.folder
+        # The test frames are flat colours, which the quality check rejects.
+        self.old_filter, hh.FILTER_FRAMES = hh.FILTER_FRAMES, False
+        self.old_cache = hh.QUALITY_CACHE
+        hh.QUALITY_CACHE = os.path.join(self.folder, 'quality.json')
+
+    def tearDown(self):
+        hh.HIRES_FOLDER = self.old_folder
+        hh.FILTER_FRAMES = self.old_filter
+        hh.QUALITY_CACHE = self.old_cache
+        shutil.rmtree(self.folder)
+
+    def make_frames(self, count, size=1000):
+        names = []
+        for i in range(count):
+            name = 'full_{0}.png'.format(i)
+            Image.new('RGB', (size, size), (i * 20, 0, 0)).save(os.path.join(self.folder, name))
+            names.append(name)
+        return names
+
+    def test_parallel_crop_keeps_order_and_skips_corrupt(self):
+        images = self.make_frames(4)
+        with open(os.path.join(self.folder, images[1]), 'wb') as f:
+            f.write(b'not an image')
+
+        crops = hh.crop_hires_images(images, lat_start=100, lng_start=200, workers=3)
+
+        self.assertEqual([os.path.basename(c) for c in crops],
+                         ['img000.png', 'img002.png', 'img003.png'])
+        self.assertFalse(os.path.exists(os.path.join(self.folder, images[1])))
+        for idx, crop in zip((0, 2, 3), crops):
+            im = Image.open(crop)
+            self.assertEqual(im.size, (720, 720))
+            self.assertEqual(im.getpixel((0, 0)), (idx * 20, 0, 0))
+
+    def test_region_batch_reads_each_frame_once(self):
+        images = self.make_frames(3)
+        starts = [(0, 0), (200, 100), (280, 280)]
+
+        folders, stats = hh.crop_hires_regions(images, starts, workers=2)
+
+        self.assertEqual(len(folders), 3)
+        for folder in folders:
+            self.assertEqual(sorted(os.listdir(folder)),
+                             ['img000.png', 'img001.png', 'img002.png'])
+        self.assertEqual(stats.decodes, 3)
+        self.assertEqual(stats.saved, 6)
+
+    def test_raw_storage_within_budget(self):
+        frames = [os.path.join(self.folder, name) for name in self.make_frames(3)]
+        hh.store_frames(frames, storage='raw', raw_budget=raw_frames.raw_size(1000, 1000) + 1000)
+        self.assertEqual([raw_frames.has_raw(f) for f in frames], [False, False, True])
+        self.assertEqual([tiles.has_tiles(f) for f in frames], [True, True, False])
+        crops = hh.crop_hires_images([os.path.basename(f) for f in frames], 100, 200)
+        # The first two come from JPEG tiles, so allow for a little loss.
+        for crop, red in zip(crops, (0, 20, 40)):
+            self.assertAlmostEqual(Image.open(crop).getpixel((0, 0))[0], red, delta=2)
+
+    def test_zoom_animation_renders_one_frame_per_image(self):
+        self.make_frames(3, size=2000)
+        rendered = []
+        old_encode = hh.encode_frames_mp4
+        hh.encode_frames_mp4 = lambda frames, out: rendered.extend(frames) or out
+        try:
+            hh.make_zoom_animation(lat_start=500, lng_start=600, start_width=1440)
+        finally:
+            hh.encode_frames_mp4 = old_encode
+
+        self.assertEqual([im.size for im in rendered], [(720, 720)] * 3)
+        self.assertEqual([im.getpixel((360, 360)) for im in rendered],
+                         [(0, 0, 0), (20, 0, 0), (40, 0, 0)])
+
+    def test_failed_encode_leaves_no_video(self):
+        # An ffmpeg that writes a bit of output and quits without reading.
+        bin_dir = os.path.join(self.folder, 'bin')
+        os.mkdir(bin_dir)
+        with open(os.path.join(bin_dir, 'ffmpeg'), 'w') as f:
+            f.write('#!/bin/sh\nfor last; do :; done\necho partial > "$last"\nexit 1\n')
+        os.chmod(os.path.join(bin_dir, 'ffmpeg'), 0o755)
+        old_path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + old_path
+        out = os.path.join(self.folder, 'out.mp4')
+        try:
+            frames = [Image.new('RGB', (720, 720))] * 50
+            self.assertIsNone(hh.encode_frames_mp4(frames, out))
+        finally:
+            os.environ['PATH'] = old_path
+        self.assertFalse(os.path.exists(out))
+
+    def test_animation_frames_drop_repeats_and_blanks(self):
+        for i, seed in enumerate((1, 1, 2)):
+            noise = np.random.RandomState(seed).randint(0, 256, (100, 100, 3)).astype(np.uint8)
+            Image.fromarray(noise).resize((1000, 1000), Image.BILINEAR).save(
+                os.path.join(self.folder, 'full_{0}.png'.format(i)))
+        Image.new('RGB', (1000, 1000)).save(os.path.join(self.folder, 'full_3.png'))
+        hh.FILTER_FRAMES = True
+        rejected = hh.metrics.snapshot()['counters'].get('frames_rejected', 0)
+
+        frames = hh.animation_frames()
+        self.assertEqual([os.path.basename(f) for f in frames], ['full_0.png', 'full_2.png'])
+        self.assertEqual(hh.metrics.snapshot()['counters']['frames_rejected'] - rejected, 2)
+
+    def test_recent_posts_are_weighted_down(self):
+        old_history, hh._crop_history = hh._crop_history, CropHistory()
+        old_weight, hh.REPEAT_WEIGHT = hh.REPEAT_WEIGHT, 0.0
+        old_index = (hh.CROP_INDEX_FILE, hh._crop_index)
+        hh.CROP_INDEX_FILE = os.path.join(self.folder, 'crop_index.npz')
+        hh._crop_index = None
+        try:
+            hh._crop_history.record(*geometry.px_to_lat_long(2000 + 360, 3000 + 360))
+            weights = hh.repeat_weights()
+            self.assertEqual(weights[20, 30], 0.0)
+            self.assertEqual(weights[40, 10], 1.0)
+            for _ in range(20):
+                lat_px, lng_px = hh.get_start_coord()
+                self.assertEqual(weights[lat_px // 100, lng_px // 100], 1.0)
+        finally:
+            hh._crop_history = old_history
+            hh.REPEAT_WEIGHT = old_weight
+            hh.CROP_INDEX_FILE, hh._crop_index = old_index
+
+
+class CropIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.index = CropIndex.build(hh.earth_polygon().exterior.coords,
+                                     x_range=(1, 4219), y_range=(732, 5499))
+
+    def test_matches_shapely(self):
+        rng = random.Random(0)
+        for _ in range(5000):
+            x, y = rng.randint(1, 4219), rng.randint(732, 5499)
+            self.assertEqual((x, y) in self.index, Point(x, y).within(hh.earth_polygon()))
+
+    def test_samples_inside_polygon(self):
+        rng = random.Random(1)
+        for _ in range(500):
+            self.assertTrue(Point(*self.index.sample(rng)).within(hh.earth_polygon()))
+
+    def test_whole_window(self):
+        index = CropIndex.build(hh.earth_polygon().exterior.coords,
+                                x_range=(1, 4219), y_range=(732, 5499), whole_window=True)
+        self.assertLess(len(index), len(self.index))
+        rng = random.Random(2)
+        for _ in range(200):
+            x, y = index.sample(rng)
+            for dx, dy in ((0, 0), (720, 0), (0, -720), (720, -720)):
+                self.assertTrue(Point(x + dx, y + dy).within(hh.earth_polygon()))
+
+    def test_weighted_sampling_only_hits_weighted_cells(self):
+        weights = np.zeros((55, 55))
+        weights[20, 30] = 1.0
+        rng = random.Random(3)
+        for _ in range(100):
+            x, y = self.index.sample_weighted(weights, 100, 5500, rng)
+            self.assertEqual(((5500 - y) // 100, x // 100), (20, 30))
+            self.assertIn((x, y), self.index)
+
+    def test_saved_index_round_trips(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'index.npz')
+            hull = hh.earth_polygon().exterior.coords
+            built = CropIndex.load_or_build(path, hull, (1, 4219), (732, 5499))
+            loaded = CropIndex.load_or_build(path, hull, (1, 4219), (732, 5499))
+            self.assertEqual(len(built), len(loaded))
+            self.assertTrue((built.lo == loaded.lo).all())
+        finally:
+            shutil.rmtree(folder)
+
+
+class CropScoringTests(unittest.TestCase):
+    def test_prefers_textured_daylit_window(self):
+        rng = np.random.RandomState(0)
+        preview = np.full((550, 550), 120.0)
+        preview[300:372, 100:172] += rng.randint(-60, 60, (72, 72))
+        preview[0:100, 400:550] = rng.randint(0, 20, (100, 150))
+        lat_px = np.array([0, 3000, 2900, 500])
+        lng_px = np.array([4000, 1000, 1200, 2000])
+        scores = crop_scoring.score_windows(preview, 10.0, lat_px, lng_px)
+        self.assertEqual(int(np.argmax(scores)), 1)
+
+    def test_best_window_on_frame(self):
+        folder = tempfile.mkdtemp()
+        try:
+            frame = os.path.join(folder, 'full.jpg')
+            im = Image.new('L', (5500, 5500), 120)
+            im.paste(Image.effect_noise((720, 720), 80), (2000, 3000))
+            im.convert('RGB').save(frame)
+            best = crop_scoring.best_window(frame, np.array([500, 3000, 1000]),
+                                            np.array([500, 2000, 3500]))
+            self.assertEqual(best, (3000, 2000))
+        finally:
+            shutil.rmtree(folder)
@@ -1,9 +1,34 @@
 # encoding: utf-8
 import datetime
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from PIL import Image, ImageChops
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+from downloader import Downloader, make_session
+import frame_sources
+import frame_store
+from gif_builder import GifBuilder
 import himawari_lowres as hl
 
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
 
 class LowResTests(unittest.TestCase):
     def test_time_rounding(self):
@@ -24,3 +49,349 @@ class LowResTests(unittest.TestCase):
         self.assertTrue(isinstance(images, list))
         self.assertEqual(images[0], "2016/10/23/081000_0_0.png")
         self.assertEqual(images[1], "2016/10/23/080000_0_0.png")
+
+    def test_jma_capture_time(self):
+        expected = datetime.datetime(2016, 10, 23, 8, 10)
+        self.assertEqual(hl.jma_capture_time("2016/10/23/081000_0_0.png"), expected)
+        self.assertEqual(hl.jma_capture_time("20161023081000_0_0.png"), expected)
+
+
+class RenderTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.old = hl.BASE_DIR, hl.RENDER_FOLDER, hl._frame_store
+        hl.BASE_DIR = self.folder
+        hl.RENDER_FOLDER = os.path.join(self.folder, 'render')
+        hl._frame_store = frame_store.FrameStore(':memory:')
+        self.gif = os.path.join(self.folder, 'gif.gif')
+        with open(self.gif, 'wb') as f:
+            f.write(b'last run')
+        script = os.path.join(self.folder, 'mp4_to_gif.sh')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\nexit 1\n')
+        os.chmod(script, 0o755)
+
+    def tearDown(self):
+        hl.BASE_DIR, hl.RENDER_FOLDER, hl._frame_store = self.old
+        shutil.rmtree(self.folder)
+
+    def test_nothing_to_render(self):
+        self.assertIsNone(hl.images_to_gif([]))
+        self.assertTrue(os.path.exists(self.gif))
+
+    def test_failed_script_leaves_no_gif(self):
+        frame = os.path.join(self.folder, 'a.png')
+        Image.new('RGB', (8, 8)).save(frame)
+        self.assertIsNone(hl.images_to_gif([frame], use_script=True))
+        self.assertFalse(os.path.exists(self.gif))
+
+
+class ProcessImageTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.frame = os.path.join(self.folder, 'frame.png')
+        Image.effect_noise((550, 550), 60).convert('RGB').save(self.frame)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_matches_pad_then_resize(self):
+        out = os.path.join(self.folder, 'out.png')
+        self.assertTrue(hl.process_image(self.frame, out=out))
+        self.assertEqual(Image.open(self.frame).size, (550, 550))
+
+        padded = Image.new('RGB', (650, 650))
+        padded.paste(Image.open(self.frame), (50, 50))
+        expected = padded.resize((500, 500), Image.BICUBIC)
+        diff = ImageChops.difference(Image.open(out), expected)
+        # Only the few px where the filter runs off the frame's edge differ.
+        self.assertLessEqual(max(hi for _, hi in diff.crop((42, 42, 458, 458)).getextrema()), 1)
+        self.assertEqual(diff.crop((0, 0, 500, 38)).getbbox(), None)
+
+    def test_larger_frames_are_framed_like_jma(self):
+        big = os.path.join(self.folder, 'big.jpg')
+        Image.open(self.frame).resize((1100, 1100), Image.BICUBIC).save(big, quality=95)
+        out, expected = (os.path.join(self.folder, name) for name in ('out.png', 'exp.png'))
+        self.assertTrue(hl.process_image(big, out=out))
+        hl.process_image(self.frame, out=expected)
+        diff = ImageChops.difference(Image.open(out), Image.open(expected)).convert('L')
+        self.assertEqual(Image.open(out).size, (500, 500))
+        self.assertEqual(diff.crop((0, 0, 500, 38)).getbbox(), None)
+        self.assertLess(sum(i * n for i, n in enumerate(diff.histogram())) / 250000.0, 4)
+
+    def test_threads_share_the_lazy_imports(self):
+        # In a fresh interpreter, so PIL.Image is still unloaded when the
+        # prep threads first reach it.
+        frames = []
+        for i in range(8):
+            frames.append(os.path.join(self.folder, '201610230{0}0000_0_0.png'.format(i)))
+            shutil.copyfile(self.frame, frames[-1])
+        out = os.path.join(self.folder, 'processed')
+        script = ('import json, sys; import himawari_lowres as hl; '
+                  'hl.PROCESSED_FOLDER = sys.argv[1]; '
+                  'print(json.dumps(hl.process_images(sys.argv[2:])))')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_DIR, env.get('PYTHONPATH')]))
+        result = subprocess.run([sys.executable, '-c', script, out] + frames, cwd=REPO_DIR,
+                                env=env, stdout=subprocess.PIPE, check=True)
+        self.assertEqual(json.loads(result.stdout.decode('utf-8')), [True] * 8)
+        self.assertEqual(sorted(os.listdir(out)), sorted(os.path.basename(f) for f in frames))
+
+    def test_processed_frames_are_copied(self):
+        Image.new('RGB', (500, 500), 'white').save(self.frame)
+        out = os.path.join(self.folder, 'out.png')
+        self.assertTrue(hl.process_image(self.frame, out=out))
+        self.assertEqual(Image.open(out).getextrema(), ((255, 255),) * 3)
+
+
+class FrameStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.store = frame_store.FrameStore(':memory:', clock=lambda: self.now)
+
+    def frames(self, *minutes):
+        return [('2016-10-23T08:{0:02d}:00'.format(m), '2016102308{0:02d}00.png'.format(m))
+                for m in minutes]
+
+    def test_needed_skips_downloaded_frames(self):
+        self.store.import_existing(self.frames(0))
+        self.store.mark(*self.frames(10)[0], status=frame_store.MISSING)
+        self.now += 600
+        needed = self.store.needed(self.frames(0, 10, 20))
+        self.assertEqual([c for c, _ in needed], ['2016-10-23T08:10:00', '2016-10-23T08:20:00'])
+
+    def test_missing_frames_back_off(self):
+        captured, name = self.frames(10)[0]
+        for wait in (600, 1200, 2400):
+            self.store.mark(captured, name, frame_store.MISSING)
+            self.now += wait - 1
+            self.assertEqual(self.store.needed([(captured, name)]), [])
+            self.assertEqual(self.store.deferred([(captured, name)]), [(captured, name)])
+            self.now += 1
+            self.assertEqual(self.store.needed([(captured, name)]), [(captured, name)])
+
+    def test_missing_attempts(self):
+        captured, name = self.frames(10)[0]
+        self.store.mark(captured, name, frame_store.MISSING)
+        self.store.mark(captured, name, frame_store.MISSING)
+        self.assertEqual(self.store.get(captured), (name, frame_store.MISSING, 2))
+        self.store.mark(captured, name, frame_store.PROCESSED)
+        self.assertEqual(self.store.get(captured), (name, frame_store.PROCESSED, 0))
+
+    def test_expire_and_changes(self):
+        self.store.import_existing(self.frames(0, 10, 20, 30))
+        self.store.mark_rendered()
+        self.now += 600
+        self.store.mark(*self.frames(40)[0], status=frame_store.PROCESSED)
+        expired = self.store.expire(keep=3)
+        self.assertEqual(expired, [name for _, name in self.frames(10, 0)])
+        self.assertEqual(self.store.changed_since_render(),
+                         {'added': [name for _, name in self.frames(40)],
+                          'removed': [name for _, name in self.frames(0, 10)]})
+        self.now += 600
+        self.store.mark_rendered()
+        self.assertEqual(self.store.changed_since_render(), {'added': [], 'removed': []})
+        self.assertEqual(len(self.store.frames()), 3)
+
+    def test_expire_forgets_old_missing_frames(self):
+        self.store.import_existing(self.frames(10, 20, 30))
+        for captured, name in self.frames(0, 15, 40):
+            self.store.mark(captured, name, frame_store.MISSING)
+        self.assertEqual(self.store.expire(keep=2), [self.frames(10)[0][1]])
+        self.assertEqual(self.store.entries(statuses=(frame_store.MISSING,)),
+                         self.frames(40))
+
+
+class GifBuilderTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.frames = []
+        for i in range(6):
+            path = os.path.join(self.folder, 'frame{0}.png'.format(i))
+            Image.merge('RGB', [Image.effect_noise((50, 50), 20 + i)] * 3).save(path)
+            self.frames.append(path)
+        self.out = os.path.join(self.folder, 'out.gif')
+        self.builder = GifBuilder(os.path.join(self.folder, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_rolling_window_reuses_cached_frames(self):
+        stats = self.builder.build(self.frames[:4], self.out)
+        self.assertEqual((stats['encoded'], stats['reused']), (4, 0))
+        self.assertTrue(stats['palette_rebuilt'])
+
+        stats = self.builder.build(self.frames[1:5], self.out)
+        self.assertEqual((stats['encoded'], stats['reused']), (1, 3))
+        self.assertFalse(stats['palette_rebuilt'])
+        self.assertEqual(Image.open(self.out).n_frames, 4)
+
+        # A fresh builder picks the cached palette back up.
+        stats = GifBuilder(self.builder.cache_dir).build(self.frames[1:5], self.out)
+        self.assertEqual(stats['reused'], 4)
+
+    def test_palette_rebuilt_on_drift(self):
+        self.builder.build(self.frames[:4], self.out)
+        red = os.path.join(self.folder, 'red.png')
+        Image.new('RGB', (50, 50), (255, 0, 0)).save(red)
+
+        stats = self.builder.build(self.frames[1:4] + [red], self.out)
+        self.assertTrue(stats['palette_rebuilt'])
+        gif = Image.open(self.out)
+        gif.seek(3)
+        self.assertEqual(gif.convert('RGB').getpixel((10, 10)), (255, 0, 0))
+
+
+class JMAStub(BaseHTTPRequestHandler):
+    """Serves a real frame for paths in server.available and JMA's small
+    "no image" placeholder for everything else."""
+
+    def do_GET(self):
+        self.server.hits.append(self.path)
+        body = self.server.frame if self.path in self.server.available else self.server.placeholder
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchJMAFramesTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp() + '/'
+        self.server = HTTPServer(('127.0.0.1', 0), JMAStub)
+        self.server.hits = []
+        self.server.available = set()
+        buf = io.BytesIO()
+        Image.effect_noise((550, 550), 60).save(buf, 'PNG')
+        self.server.frame = buf.getvalue()
+        buf = io.BytesIO()
+        Image.new('RGB', (550, 550)).save(buf, 'PNG')
+        self.server.placeholder = buf.getvalue()
+        threading.Thread(target=self.server.serve_forever).start()
+
+        self.old = hl.JMA_URL, hl.LOWRES_FOLDER, hl.PROCESSED_FOLDER, hl.NOAA_FOLDER
+        hl.JMA_URL = 'http://127.0.0.1:{0}/'.format(self.server.server_address[1])
+        hl.LOWRES_FOLDER = self.folder
+        hl.PROCESSED_FOLDER = self.folder + 'processed/'
+        hl.NOAA_FOLDER = self.folder + 'noaa/'
+        self.now = 1000.0
+        self.store = frame_store.FrameStore(':memory:', clock=lambda: self.now)
+        self.downloader = Downloader(session=make_session(), min_size=2**13, backoff=0.01)
+
+    def tearDown(self):
+        hl.JMA_URL, hl.LOWRES_FOLDER, hl.PROCESSED_FOLDER, hl.NOAA_FOLDER = self.old
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def fetch(self, images, pool=None):
+        pool = pool or frame_sources.SourcePool([hl.jma_source(self.downloader)])
+        return hl.fetch_frames(images, store=self.store, pool=pool)
+
+    def test_fetch_with_negative_cache(self):
+        images = hl.get_jma_images(start_time=datetime.datetime(2016, 10, 23, 8, 29), num=4)
+        self.server.available = set('/' + image for image in images[1:])
+
+        counts = self.fetch(images)
+        self.assertEqual(counts, {'fetched': 3, 'skipped': 0, 'deferred': 0,
+                                  'missing': 1, 'failed': 0})
+        name = images[1].replace('/', '')
+        self.assertEqual(Image.open(self.folder + name).size, (550, 550))
+        self.assertEqual(Image.open(hl.processed_path(name)).size, (500, 500))
+        self.assertEqual(len(self.store.frames(statuses=(frame_store.PROCESSED,))), 3)
+        self.assertEqual(len(self.server.hits), 4)
+
+        # The missing frame isn't asked for again until its backoff is up.
+        counts = self.fetch(images)
+        self.assertEqual((counts['skipped'], counts['deferred']), (3, 1))
+        self.assertEqual(len(self.server.hits), 4)
+
+        self.now += 600
+        self.server.available.add('/' + images[0])
+        counts = self.fetch(images)
+        self.assertEqual((counts['fetched'], counts['skipped']), (1, 3))
+        self.assertEqual(self.server.hits[-1], '/' + images[0])
+
+    def take_jma_down(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        hl.JMA_URL = 'http://127.0.0.1:{0}/'.format(sock.getsockname()[1])
+        sock.close()
+
+    def test_fails_over_when_jma_is_down(self):
+        images = hl.get_jma_images(start_time=datetime.datetime(2016, 10, 23, 8, 29), num=3)
+        self.server.available = set('/' + image for image in images)
+        mirror_url = hl.JMA_URL
+        self.take_jma_down()
+        mirror = frame_sources.HttpSource(
+            'mirror', lambda captured: mirror_url + hl.date_to_jma_filename(captured),
+            lambda captured: self.folder + captured.strftime('%Y%m%d%H%M.png'),
+            downloader=self.downloader)
+        pool = frame_sources.SourcePool([hl.jma_source(self.downloader), mirror])
+
+        counts = self.fetch(images, pool=pool)
+        self.assertEqual(counts['fetched'], 3)
+        self.assertEqual(len(self.server.hits), 3)
+        self.assertEqual(sorted(self.store.frames()),
+                         ['201610230750.png', '201610230800.png', '201610230810.png'])
+        # JMA is cooling down, so the next run goes straight to the mirror.
+        self.assertFalse(pool.health.is_up('jma'))
+        self.assertEqual([s.name for s in pool.ranked()], ['mirror', 'jma'])
+
+    def test_noaa_fallback_keeps_to_its_folder(self):
+        images = hl.get_jma_images(start_time=datetime.datetime(2016, 10, 23, 8, 29), num=3)
+        self.take_jma_down()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.mkdir(os.path.join(root, 'frames'))
+        frame = Image.effect_noise((1100, 1100), 60).convert('RGB')
+        for image in images:
+            name = hl.jma_capture_time(image).strftime(hl.NOAA_NAME)
+            frame.save(os.path.join(root, 'frames', name), 'JPEG')
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(root)
+        handler = type(str('Handler'), (FTPHandler,), {'authorizer': authorizer})
+        ftp = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=ftp.serve_forever, kwargs={'timeout': 0.05})
+        thread.start()
+        self.old_noaa = hl.NOAA_URL, hl.NOAA_LISTING
+        hl.NOAA_URL = 'ftp://127.0.0.1:{0}/frames/'.format(ftp.address[1])
+        hl.NOAA_LISTING = self.folder + 'noaa_listing.json'
+        noaa = hl.noaa_source()
+        try:
+            pool = frame_sources.SourcePool([hl.jma_source(self.downloader), noaa],
+                                            probe_interval=None)
+            counts = self.fetch(images, pool=pool)
+        finally:
+            noaa.mirror.close()
+            ftp.close_all()
+            thread.join()
+            hl.NOAA_URL, hl.NOAA_LISTING = self.old_noaa
+
+        self.assertEqual(counts['fetched'], 3)
+        self.assertEqual(sorted(self.store.frames()),
+                         ['noaa/2016-10-23T075000.JPG', 'noaa/2016-10-23T080000.JPG',
+                          'noaa/2016-10-23T081000.JPG'])
+        # Processed copies are PNGs, named like JMA's.
+        processed = sorted(os.listdir(hl.PROCESSED_FOLDER))
+        self.assertEqual(processed, [image.replace('/', '') for image in sorted(images)])
+        self.assertEqual(Image.open(hl.PROCESSED_FOLDER + processed[0]).format, 'PNG')
+
+        # Retention only touches its own frames, not ftp_lowres's.
+        ftp_frame = self.folder + '2016-10-23T070000.JPG'
+        frame.save(ftp_frame, 'JPEG')
+        old_store, hl._frame_store = hl._frame_store, self.store
+        try:
+            hl.delete_old_images(num=1)
+        finally:
+            hl._frame_store = old_store
+        self.assertTrue(os.path.exists(ftp_frame))
+        self.assertEqual(os.listdir(hl.NOAA_FOLDER), ['2016-10-23T081000.JPG'])
+        self.assertEqual(os.listdir(hl.PROCESSED_FOLDER), ['20161023081000_0_0.png'])
+
+
+if __name__ == '__main__':
+    unittest.main()
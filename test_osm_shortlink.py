@@ -0,0 +1,53 @@
+# encoding: utf-8
+import random
+import unittest
+
+import numpy as np
+
+from osm_shortlink import decode, deinterleave, interleave, lat_lon_code, short_osm
+
+
+def interleave_bits(x, y):
+    """The original bit-at-a-time interleave."""
+    c = 0
+    for i in range(31, 0, -1):
+        c = (c << 1) | ((x >> i) & 1)
+        c = (c << 1) | ((y >> i) & 1)
+    return c
+
+
+class ShortlinkTests(unittest.TestCase):
+    def test_known_links(self):
+        self.assertEqual(short_osm(50.671530961990356, 6.09715461730957),
+                         'http://osm.org/go/0GAjIv8h')
+        self.assertEqual(short_osm(0, 0, 3), 'http://osm.org/go/wAAA--')
+        self.assertEqual(short_osm(0, 0, 4, marker=True), 'http://osm.org/go/wAAA?m')
+
+    def test_interleave_matches_bitwise(self):
+        rng = random.Random(0)
+        pairs = [(rng.getrandbits(32), rng.getrandbits(32)) for _ in range(2000)]
+        for x, y in pairs:
+            self.assertEqual(interleave(x, y), interleave_bits(x, y))
+        xs, ys = (np.array(v, dtype=np.uint64) for v in zip(*pairs))
+        self.assertEqual([int(c) for c in interleave(xs, ys)],
+                         [interleave_bits(x, y) for x, y in pairs])
+        self.assertEqual(deinterleave(interleave(6, 1 << 31)), (6, 1 << 31))
+
+    def test_codes_of_arrays_match_scalars(self):
+        lat, lon = np.array([50.67, -33.9, 0.0]), np.array([6.09, 151.2, 0.0])
+        self.assertEqual([int(c) for c in lat_lon_code(lat, lon)],
+                         [lat_lon_code(a, b) for a, b in zip(lat, lon)])
+
+    def test_decode_round_trips(self):
+        for zoom in range(20):
+            lat, lon, got_zoom = decode(short_osm(-33.9, 151.2, zoom))
+            self.assertEqual(got_zoom, zoom)
+            # The corner of a cell a little over 360 / 2**(zoom + 8) degrees wide.
+            self.assertLessEqual(abs(lon - 151.2), 360.0 / 2 ** (zoom + 8) * 2)
+            self.assertLessEqual(abs(lat + 33.9), 180.0 / 2 ** (zoom + 8) * 2)
+        self.assertEqual(decode('http://osm.org/go/wAAA--'), (0.0, 0.0, 3))
+        self.assertEqual(decode('0GAjIv8h?m')[2], 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import scheduler
+
+
+class SchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_next_slot(self):
+        self.assertEqual(scheduler.next_slot(0, 600), 600)
+        self.assertEqual(scheduler.next_slot(599, 600), 600)
+        self.assertEqual(scheduler.next_slot(600, 600), 1200)
+        self.assertEqual(scheduler.next_slot(7300, 3600, offset=600), 7800)
+
+    def test_interval_must_match_cadence(self):
+        with self.assertRaises(ValueError):
+            scheduler.Job('bad', lambda: None, 900)
+
+    def test_overlapping_runs_are_skipped(self):
+        release = threading.Event()
+        job = scheduler.Job('slow', release.wait, 600)
+        self.assertTrue(job.submit())
+        self.assertFalse(job.submit())
+        release.set()
+        job.future.result()
+        self.assertTrue(job.submit())
+        job.future.result()
+        self.assertEqual((job.stats.runs, job.stats.skipped), (2, 1))
+        job.executor.shutdown()
+
+    def test_file_lock_blocks_other_runs(self):
+        started, release = threading.Event(), threading.Event()
+
+        def hold():
+            started.set()
+            release.wait()
+
+        first = scheduler.Job('locked', hold, 600, lock_dir=self.folder)
+        second = scheduler.Job('locked', lambda: None, 600, lock_dir=self.folder)
+        first.submit()
+        started.wait()
+        self.assertFalse(second.run())
+        release.set()
+        first.future.result()
+        self.assertTrue(second.run())
+        first.executor.shutdown()
+
+    def test_runs_on_slots_and_records_failures(self):
+        now = [1000.0]
+        runs = []
+
+        def fail():
+            raise RuntimeError("boom")
+
+        def sleep(seconds):
+            for job in jobs:
+                if job.future:
+                    job.future.result()
+            now[0] += seconds
+            if now[0] > 4000:
+                sched.stop()
+
+        jobs = [scheduler.Job('ok', lambda: runs.append(now[0]), 600),
+                scheduler.Job('fail', fail, 1800)]
+        stats_file = os.path.join(self.folder, 'stats.json')
+        sched = scheduler.Scheduler(jobs, stats_file=stats_file,
+                                    clock=lambda: now[0], sleep=sleep)
+        sched.run_forever()
+
+        self.assertEqual(runs, [1200, 1800, 2400, 3000, 3600])
+        with open(stats_file) as f:
+            stats = json.load(f)
+        self.assertEqual(stats['ok']['runs'], 5)
+        self.assertEqual((stats['fail']['runs'], stats['fail']['failures']), (2, 2))
+        self.assertIn('boom', stats['fail']['last_error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
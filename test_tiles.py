@@ -0,0 +1,171 @@
+# encoding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image, ImageChops
+
+import raw_frames
+import tiles
+import viewport
+
+
+class TileTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.frame = os.path.join(self.folder, 'full_disk.png')
+        im = Image.effect_noise((130, 110), 80).resize((1300, 1100))
+        Image.merge('RGB', (im, im.rotate(90), im.transpose(Image.FLIP_LEFT_RIGHT))).save(
+            self.frame)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def assertSameImage(self, a, b):
+        self.assertEqual(a.size, b.size)
+        self.assertIsNone(ImageChops.difference(a, b).getbbox())
+
+    def test_region_matches_full_decode(self):
+        tiles.build_tiles(self.frame, tile_size=256, fmt='PNG')
+        folder = tiles.tile_dir(self.frame)
+        self.assertEqual(len([n for n in os.listdir(folder)
+                              if os.path.isfile(os.path.join(folder, n))]), 5 * 6 + 1)
+        full = Image.open(self.frame)
+        for box in [(0, 0, 720, 720), (300, 200, 1020, 920), (580, 380, 1300, 1100),
+                    (256, 256, 512, 512)]:
+            self.assertSameImage(tiles.read_region(self.frame, box), full.crop(box))
+
+    def test_falls_back_without_tiles(self):
+        box = (10, 20, 730, 740)
+        self.assertFalse(tiles.has_tiles(self.frame))
+        self.assertSameImage(tiles.read_region(self.frame, box),
+                             Image.open(self.frame).crop(box))
+
+    def test_delete_tiles(self):
+        tiles.build_missing_tiles([self.frame])
+        self.assertTrue(tiles.has_tiles(self.frame))
+        tiles.delete_tiles(self.frame)
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'tiles', 'full_disk')))
+
+    def test_pyramid_levels(self):
+        tiles.build_tiles(self.frame, tile_size=256, fmt='PNG')
+        folder = tiles.tile_dir(self.frame)
+        # 650x550, 325x275 and 163x138 px.
+        for level, count in ((1, 3 * 3), (2, 2 * 2), (3, 1)):
+            self.assertEqual(len(os.listdir(tiles.level_dir(folder, level))), count)
+        half = Image.open(self.frame).resize((650, 550), Image.BOX)
+        box = (100, 50, 400, 300)
+        self.assertSameImage(tiles.read_regions(self.frame, [box], level=1)[0], half.crop(box))
+
+    def test_view_level(self):
+        self.assertEqual(tiles.view_level((0, 0, 720, 720), (720, 720)), 0)
+        self.assertEqual(tiles.view_level((0, 0, 1439, 1439), (720, 720)), 0)
+        self.assertEqual(tiles.view_level((0, 0, 1440, 1440), (720, 720)), 1)
+        self.assertEqual(tiles.view_level((0, 0, 5500, 5500), (720, 720)), 2)
+        self.assertEqual(tiles.view_level((0, 0, 5500, 5500), (100, 100)), 3)
+        self.assertEqual(tiles.view_level((0, 0, 5500, 5500), (100, 100), levels=1), 0)
+
+    def test_read_view(self):
+        full = Image.open(self.frame)
+        box = (250.5, 100, 1050.5, 900)
+        expected = full.resize((200, 200), Image.BILINEAR, box=box)
+        untiled = tiles.read_view(self.frame, box, (200, 200))
+        self.assertSameImage(untiled, expected)
+
+        tiles.build_tiles(self.frame, tile_size=256, fmt='PNG')
+        stats = tiles.DecodeStats()
+        view = tiles.read_view(self.frame, box, (200, 200), stats=stats)
+        self.assertEqual(view.size, (200, 200))
+        # Read from two tiles of the 1/4 level (325x275 px), not the 20 full
+        # size tiles the box covers.
+        self.assertEqual(stats.decodes, 2)
+        diff = ImageChops.difference(view, expected).convert('L')
+        self.assertLess(diff.getextrema()[1], 64)
+
+        # Off the edge of the disk is black.
+        corner = tiles.read_view(self.frame, (-400, -400, 400, 400), (40, 40))
+        self.assertEqual(corner.getpixel((0, 0)), (0, 0, 0))
+        self.assertNotEqual(corner.getpixel((39, 39)), (0, 0, 0))
+
+    def test_old_tiles_have_one_level(self):
+        tiles.build_tiles(self.frame, tile_size=256, fmt='PNG', levels=1)
+        with open(os.path.join(tiles.tile_dir(self.frame), 'meta'), 'w') as f:
+            f.write('1300 1100 256 PNG\n')
+        box = (0, 0, 1300, 1100)
+        self.assertSameImage(tiles.read_view(self.frame, box, (1300, 1100)),
+                             Image.open(self.frame).convert('RGB'))
+        self.assertEqual(tiles.read_view(self.frame, box, (100, 100)).size, (100, 100))
+
+
+class ViewportTests(unittest.TestCase):
+    def test_zoom_path(self):
+        path = viewport.zoom_path((1000, 2000), 4000, 250, 5)
+        widths = [right - left for left, top, right, bottom in path]
+        self.assertEqual([round(w) for w in widths], [4000, 2000, 1000, 500, 250])
+        for left, top, right, bottom in path:
+            self.assertEqual(((left + right) / 2, (top + bottom) / 2), (1000, 2000))
+
+    def test_pan_path(self):
+        path = viewport.pan_path((0, 0), (100, 50), 20, 3)
+        self.assertEqual(path, [(-10, -10, 10, 10), (40, 15, 60, 35), (90, 40, 110, 60)])
+
+    def test_render_path(self):
+        folder = tempfile.mkdtemp()
+        try:
+            frames = []
+            for i in range(2):
+                frames.append(os.path.join(folder, 'f{0}.png'.format(i)))
+                Image.new('RGB', (400, 400), (100 * i, 0, 0)).save(frames[-1])
+            tiles.build_missing_tiles(frames, tile_size=128, fmt='PNG')
+            boxes = viewport.zoom_path((200, 200), 400, 50, 4)
+            images = list(viewport.render_path(frames, boxes, size=(32, 32), workers=2))
+            self.assertEqual([im.size for im in images], [(32, 32)] * 4)
+            self.assertEqual([im.getpixel((16, 16))[0] for im in images], [0, 0, 100, 100])
+        finally:
+            shutil.rmtree(folder)
+
+
+class RawFrameTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.frames = []
+        for i in range(3):
+            self.frames.append(os.path.join(self.folder, 'full_{0}.png'.format(i)))
+            im = Image.effect_noise((120, 100), 60 + i).resize((600, 500))
+            Image.merge('RGB', (im, im.rotate(90), im.transpose(Image.FLIP_LEFT_RIGHT))).save(
+                self.frames[-1])
+        self.size = raw_frames.raw_size(600, 500)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_crops_are_slices_of_the_raw_copy(self):
+        frame = self.frames[0]
+        raw_frames.build_raw(frame)
+        self.assertTrue(raw_frames.has_raw(frame))
+        full = Image.open(frame)
+        stats = tiles.DecodeStats()
+        boxes = [(10, 20, 330, 340), (-50, 400, 270, 720)]
+        for region, box in zip(tiles.read_regions(frame, boxes, stats=stats), boxes):
+            self.assertIsNone(ImageChops.difference(region, full.crop(box)).getbbox())
+        self.assertEqual(stats.decodes, 0)
+
+    def test_budget_keeps_newest_frames(self):
+        left_out = raw_frames.build_missing(self.frames, budget=2 * self.size + 1000,
+                                            free_margin=0)
+        self.assertEqual(left_out, self.frames[:1])
+        self.assertEqual([raw_frames.has_raw(f) for f in self.frames], [False, True, True])
+        usage = raw_frames.disk_usage(self.folder)
+        self.assertEqual(usage['frames'], 2)
+        self.assertGreaterEqual(usage['bytes'], 2 * self.size)
+
+        left_out = raw_frames.build_missing(self.frames, budget=self.size + 1000, free_margin=0)
+        self.assertEqual(left_out, self.frames[:2])
+        self.assertEqual(raw_frames.disk_usage(self.folder)['frames'], 1)
+
+    def test_keeps_free_disk_margin(self):
+        free = raw_frames.disk_usage(self.folder)['free']
+        left_out = raw_frames.build_missing(self.frames, budget=10 * self.size, free_margin=free)
+        self.assertEqual(left_out, self.frames)
+        self.assertEqual(raw_frames.disk_usage(self.folder)['frames'], 0)
@@ -0,0 +1,198 @@
+# encoding: utf-8
+import email.parser
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import parse_qsl, urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from urlparse import parse_qsl, urlsplit
+
+import twitter
+from PIL import Image
+
+from benchmarks import standins
+import uploader
+
+CHUNK = 16 * 1024
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    """A stand-in for the media upload and status update endpoints. Segment
+    indexes in server.fail get a 503 that many times; videos report
+    'in_progress' once before they're done."""
+
+    def reply(self, code, data=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def form(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        ctype = self.headers['Content-Type']
+        if not ctype.startswith('multipart/'):
+            return dict(parse_qsl(body.decode('utf-8')))
+        msg = email.parser.BytesParser().parsebytes(
+            'Content-Type: {0}\r\n\r\n'.format(ctype).encode('utf-8') + body)
+        return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                for part in msg.get_payload()}
+
+    def do_GET(self):
+        query = dict(parse_qsl(urlsplit(self.path).query))
+        media = self.server.media[query['media_id']]
+        self.reply(200, {'media_id_string': query['media_id'],
+                         'processing_info': {'state': media['state']}})
+
+    def do_POST(self):
+        server = self.server
+        data = self.form()
+        url = urlsplit(self.path)
+        if url.path.endswith('/statuses/update.json'):
+            data.update(parse_qsl(url.query))
+            server.posts.append(data)
+            return self.reply(200, {'id': 1, 'full_text': data['status']})
+
+        command = data['command']
+        if isinstance(command, bytes):
+            data = {k: v if k == 'media' else v.decode('utf-8') for k, v in data.items()}
+            command = data['command']
+        with server.lock:
+            server.commands.append(command)
+            if command == 'INIT':
+                media_id = str(len(server.media) + 1000)
+                server.media[media_id] = {'total': int(data['total_bytes']), 'segments': {},
+                                          'video': data['media_type'] == 'video/mp4',
+                                          'state': None}
+                return self.reply(202, {'media_id': int(media_id), 'media_id_string': media_id,
+                                        'expires_after_secs': 3600})
+            media = server.media[data['media_id']]
+            if command == 'APPEND':
+                index = int(data['segment_index'])
+                if server.fail.get(index):
+                    server.fail[index] -= 1
+                    return self.reply(503)
+                media['segments'][index] = data['media']
+                return self.reply(204)
+            if command == 'FINALIZE':
+                body = b''.join(media['segments'][i] for i in sorted(media['segments']))
+                if len(body) != media['total']:
+                    return self.reply(400, {'error': 'segments do not add up'})
+                media['body'] = body
+                resp = {'media_id_string': data['media_id'], 'size': len(body)}
+                if media['video']:
+                    media['state'] = 'succeeded'
+                    resp['processing_info'] = {'state': 'in_progress', 'check_after_secs': 1}
+                return self.reply(201, resp)
+
+    def log_message(self, *args):
+        pass
+
+
+class UploaderTests(unittest.TestCase):
+    def setUp(self):
+        self.server = standins.serve(UploadHandler, lock=threading.Lock(), media={}, fail={},
+                                     commands=[], posts=[])
+        url = self.server.url
+        self.api = twitter.Api('key', 'secret', 'token', 'token_secret', base_url=url,
+                               upload_url=url, sleep_on_rate_limit=False)
+        self.folder = tempfile.mkdtemp()
+        self.cache = os.path.join(self.folder, 'media_cache.json')
+        self.sleeps = []
+
+        self.mp4 = os.path.join(self.folder, 'video_out.mp4')
+        self.content = os.urandom(CHUNK * 5 + 100)
+        with open(self.mp4, 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        standins.stop(self.server)
+        shutil.rmtree(self.folder)
+
+    def make_uploader(self, retries=3):
+        return uploader.MediaUploader(api=self.api, cache_file=self.cache, chunk_size=CHUNK,
+                                      workers=3, retries=retries, backoff=0.01,
+                                      sleep=self.sleeps.append)
+
+    def test_upload_in_parallel_segments(self):
+        self.server.fail = {2: 1}
+        media_id = self.make_uploader().upload(self.mp4, media_category='tweet_video')
+        media = self.server.media[media_id]
+        self.assertEqual(media['body'], self.content)
+        self.assertEqual(len(media['segments']), 6)
+        # One retry of segment 2, then one wait for processing.
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertEqual(self.server.commands.count('INIT'), 1)
+
+    def test_cached_media_id_is_reused(self):
+        first = self.make_uploader().upload(self.mp4)
+        second = self.make_uploader().upload(self.mp4)
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.commands.count('INIT'), 1)
+
+    def test_failed_upload_resumes(self):
+        self.server.fail = {4: 5}
+        with self.assertRaises(uploader.UploadError):
+            self.make_uploader(retries=1).upload(self.mp4)
+        appended = self.server.commands.count('APPEND')
+
+        self.server.fail = {}
+        media_id = self.make_uploader().upload(self.mp4)
+        self.assertEqual(self.server.commands.count('INIT'), 1)
+        self.assertEqual(self.server.commands.count('APPEND') - appended, 1)
+        self.assertEqual(self.server.media[media_id]['body'], self.content)
+
+    def test_expired_media_is_uploaded_again(self):
+        self.make_uploader().upload(self.mp4)
+        with open(self.cache) as f:
+            cache = json.load(f)
+        for entry in cache.values():
+            entry['expires'] = 0
+        with open(self.cache, 'w') as f:
+            json.dump(cache, f)
+        self.make_uploader().upload(self.mp4)
+        self.assertEqual(self.server.commands.count('INIT'), 2)
+
+    def test_post_media(self):
+        uploader.post_media('hello', self.mp4, uploader=self.make_uploader())
+        self.assertEqual(len(self.server.posts), 1)
+        self.assertEqual(self.server.posts[0]['status'], 'hello')
+        self.assertIn(self.server.posts[0]['media_ids'], [str(i) for i in self.server.media])
+
+    def test_small_files_are_left_alone(self):
+        self.assertEqual(uploader.fit_to_budget(self.mp4), self.mp4)
+
+    def test_budget_depends_on_media_category(self):
+        big = os.path.join(self.folder, 'big.mp4')
+        with open(big, 'wb') as f:
+            f.truncate(16 * uploader.MB)
+        self.assertEqual(uploader.fit_to_budget(big, media_category='tweet_video'), big)
+        # Uncategorised videos are held to 15 MB, so this one has to shrink;
+        # it isn't a real video, so it can't.
+        with self.assertRaises(uploader.UploadError):
+            uploader.fit_to_budget(big)
+
+    def test_post_media_resumes_failed_upload(self):
+        self.server.fail = {1: 3}
+        uploader.post_media('hello', self.mp4, uploader=self.make_uploader(retries=1))
+        self.assertEqual(self.server.commands.count('INIT'), 1)
+        self.assertEqual(len(self.server.posts), 1)
+
+    @unittest.skipUnless(shutil.which('ffmpeg'), 'needs ffmpeg')
+    def test_gif_is_shrunk_to_budget(self):
+        gif = os.path.join(self.folder, 'gif.gif')
+        frames = [Image.effect_noise((500, 500), 80 + i).convert('P') for i in range(20)]
+        frames[0].save(gif, save_all=True, append_images=frames[1:], duration=100)
+        budget = os.path.getsize(gif) // 2
+        out = uploader.fit_to_budget(gif, budget=budget)
+        self.assertNotEqual(out, gif)
+        self.assertLessEqual(os.path.getsize(out), budget)
+        self.assertEqual(Image.open(out).size[0], uploader.GIF_LADDER[0])
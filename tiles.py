@@ -0,0 +1,283 @@
+"""
+On-disk tile cache for full disk frames.
+
+Neither JPEG nor PNG can be decoded a region at a time, so cropping a 720x720
+window out of a 5500x5500 frame means decoding all ~30 megapixels. Instead,
+each frame is decoded once when it is downloaded and cut into TILE_SIZE
+square tiles; a crop then only decodes the (at most nine) tiles it overlaps.
+
+The tiles form a pyramid: level 0 is the frame at full size, and each of the
+PYRAMID_LEVELS - 1 levels above it is half the size of the one below. A
+zoomed-out view (see read_view) reads the smallest level that still has
+enough pixels, so even the whole disk costs a handful of small tiles.
+
+Frames with a raw copy (see raw_frames) are read from that instead at full
+size.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import logging
+import math
+import os
+import shutil
+import threading
+import time
+from os.path import basename, dirname, exists, join, splitext
+
+from PIL import Image
+
+import raw_frames
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 512
+TILE_FORMAT = 'JPEG'
+TILE_QUALITY = 95
+TILE_FOLDER = 'tiles'
+# Full size, 1/2, 1/4 and 1/8.
+PYRAMID_LEVELS = 4
+# Extra px read around a view; see read_view.
+VIEW_MARGIN = 4
+
+_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png'}
+
+
+def tile_dir(frame):
+    """Returns the directory holding the tiles for `frame`."""
+    return join(dirname(frame), TILE_FOLDER, splitext(basename(frame))[0])
+
+
+def tile_name(row, col, fmt=TILE_FORMAT):
+    return "{0:02d}_{1:02d}{2}".format(row, col, _EXTENSIONS[fmt])
+
+
+def level_dir(folder, level):
+    """Returns the directory in a frame's tile `folder` holding `level`."""
+    return folder if level == 0 else join(folder, 'L{0}'.format(level))
+
+
+def level_size(width, height, level):
+    scale = 2 ** level
+    return (-(-width // scale), -(-height // scale))
+
+
+def has_tiles(frame):
+    return exists(tile_dir(frame))
+
+
+def _save_grid(im, folder, tile_size, fmt, save_args):
+    width, height = im.size
+    for row, top in enumerate(range(0, height, tile_size)):
+        for col, left in enumerate(range(0, width, tile_size)):
+            tile = im.crop((left, top, min(left + tile_size, width),
+                            min(top + tile_size, height)))
+            tile.save(join(folder, tile_name(row, col, fmt)), fmt, **save_args)
+
+
+def build_tiles(frame, tile_size=TILE_SIZE, fmt=TILE_FORMAT, levels=PYRAMID_LEVELS):
+    """
+    Decodes `frame` once and writes it out as a pyramid of tile grids. The
+    tiles are written to a scratch directory that is renamed into place at
+    the end, so a half-built cache is never used.
+
+    Args:
+        frame (str): path to the full disk image.
+        tile_size (int): edge length of each tile in px.
+        fmt (str): 'JPEG' or 'PNG'.
+        levels (int): pyramid levels, including the full size one.
+
+    Returns:
+        str: directory the tiles were written to.
+    """
+    out = tile_dir(frame)
+    tmp = out + '.part'
+    if exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    im = Image.open(frame)
+    im.load()
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+    width, height = im.size
+    save_args = {'quality': TILE_QUALITY} if fmt == 'JPEG' else {'compress_level': 1}
+
+    for level in range(levels):
+        if level:
+            # Each level is box-filtered down from the one below it.
+            im = im.resize(level_size(width, height, level), Image.BOX)
+            os.makedirs(level_dir(tmp, level))
+        _save_grid(im, level_dir(tmp, level), tile_size, fmt, save_args)
+
+    with open(join(tmp, 'meta'), 'w') as f:
+        f.write("{0} {1} {2} {3} {4}\n".format(width, height, tile_size, fmt, levels))
+
+    if exists(out):
+        shutil.rmtree(out)
+    os.rename(tmp, out)
+    logger.debug("Tiled %s into %s", frame, out)
+    return out
+
+
+def build_missing_tiles(frames, tile_size=TILE_SIZE, fmt=TILE_FORMAT, levels=PYRAMID_LEVELS):
+    """Builds tiles for any of `frames` that don't have them yet. Frames that
+    fail to decode are logged and left untiled."""
+    for frame in frames:
+        if has_tiles(frame):
+            continue
+        try:
+            build_tiles(frame, tile_size=tile_size, fmt=fmt, levels=levels)
+        except Exception:
+            logger.error("Failed to tile %s", frame, exc_info=True)
+
+
+def delete_tiles(frame):
+    if has_tiles(frame):
+        shutil.rmtree(tile_dir(frame))
+
+
+def _read_meta(folder):
+    """Returns (width, height, tile_size, fmt, levels). Tiles built before
+    the pyramid have just the full size level."""
+    with open(join(folder, 'meta')) as f:
+        fields = f.read().split()
+    width, height, tile_size, fmt = fields[:4]
+    levels = int(fields[4]) if len(fields) > 4 else 1
+    return int(width), int(height), int(tile_size), fmt, levels
+
+
+class DecodeStats(object):
+    """
+    Thread-safe tally of decodes done by read_regions, and of the decodes
+    that would have been needed had each region been read on its own.
+    """
+
+    def __init__(self):
+        self.decodes = 0
+        self.saved = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, decodes, saved, seconds):
+        with self._lock:
+            self.decodes += decodes
+            self.saved += saved
+            self.seconds += seconds
+
+    @property
+    def seconds_saved(self):
+        """Estimated decode time avoided, from the mean time per decode."""
+        return self.seconds / self.decodes * self.saved if self.decodes else 0.0
+
+    def __str__(self):
+        return "{0} decodes in {1:.2f}s, {2} avoided (~{3:.2f}s saved)".format(
+            self.decodes, self.seconds, self.saved, self.seconds_saved)
+
+
+def _decode(path):
+    im = Image.open(path)
+    im.load()
+    return im
+
+
+def _overlapping_tiles(box, width, height, tile_size):
+    left, top, right, bottom = box
+    for row in range(max(top, 0) // tile_size, (min(bottom, height) - 1) // tile_size + 1):
+        for col in range(max(left, 0) // tile_size, (min(right, width) - 1) // tile_size + 1):
+            yield row, col
+
+
+def read_regions(frame, boxes, stats=None, level=0):
+    """
+    Returns each of `boxes` (left, top, right, bottom) from `frame` as an RGB
+    image. Every tile is decoded at most once however many boxes overlap it,
+    and an untiled frame is decoded once in full for all of them.
+
+    Args:
+        frame (str): path to the full disk image.
+        boxes (list): regions to read.
+        stats (DecodeStats, optional): updated with the decodes done/avoided.
+        level (int): pyramid level the boxes are given in; it must have been
+            built (see read_view).
+    """
+    folder = tile_dir(frame)
+    start = time.time()
+
+    if level == 0 and raw_frames.has_raw(frame):
+        regions = raw_frames.read_regions(frame, boxes)
+        if stats is not None:
+            stats.add(0, len(boxes), time.time() - start)
+        return regions
+
+    if not exists(folder):
+        im = _decode(frame)
+        if level:
+            im = im.resize(level_size(im.width, im.height, level), Image.BOX)
+        if stats is not None:
+            stats.add(1, len(boxes) - 1, time.time() - start)
+        return [im.crop(box) for box in boxes]
+
+    width, height, tile_size, fmt, levels = _read_meta(folder)
+    if level >= levels:
+        raise ValueError("{0} has no pyramid level {1}".format(frame, level))
+    width, height = level_size(width, height, level)
+    folder = level_dir(folder, level)
+    decoded = {}
+    requested = 0
+    regions = []
+    for box in boxes:
+        left, top, right, bottom = box
+        region = Image.new('RGB', (right - left, bottom - top))
+        for row, col in _overlapping_tiles(box, width, height, tile_size):
+            requested += 1
+            if (row, col) not in decoded:
+                decoded[(row, col)] = _decode(join(folder, tile_name(row, col, fmt)))
+            region.paste(decoded[(row, col)], (col * tile_size - left, row * tile_size - top))
+        regions.append(region)
+
+    if stats is not None:
+        stats.add(len(decoded), requested - len(decoded), time.time() - start)
+    return regions
+
+
+def read_region(frame, box):
+    """
+    Returns the `box` (left, top, right, bottom) region of `frame` as an RGB
+    image, decoding only the tiles that overlap it. Falls back to decoding the
+    whole frame if it hasn't been tiled.
+    """
+    return read_regions(frame, [box])[0]
+
+
+def view_level(box, size, levels=PYRAMID_LEVELS):
+    """
+    Returns the pyramid level to read `box` (in full size px) from to fill
+    an output of `size`: the smallest one with at least one pixel per output
+    pixel.
+    """
+    left, top, right, bottom = box
+    factor = min((right - left) / float(size[0]), (bottom - top) / float(size[1]))
+    if factor < 2:
+        return 0
+    return min(int(math.log(factor, 2) + 1e-9), levels - 1)
+
+
+def read_view(frame, box, size, stats=None, resample=Image.BILINEAR):
+    """
+    Returns the `box` (left, top, right, bottom, in full size px; need not
+    be whole numbers) region of `frame` resized to `size`, read from the
+    smallest pyramid level that keeps it sharp. An untiled frame is decoded
+    in full. Parts of the box outside the frame come out black.
+    """
+    folder = tile_dir(frame)
+    level = view_level(box, size, _read_meta(folder)[4]) if exists(folder) else 0
+    scale = float(2 ** level)
+    left, top, right, bottom = [v / scale for v in box]
+    # Read a little beyond the box so the filter has pixels to work with at
+    # its edges.
+    whole = (int(math.floor(left)) - VIEW_MARGIN, int(math.floor(top)) - VIEW_MARGIN,
+             int(math.ceil(right)) + VIEW_MARGIN, int(math.ceil(bottom)) + VIEW_MARGIN)
+    region = read_regions(frame, [whole], stats=stats, level=level)[0]
+    return region.resize(size, resample, box=(left - whole[0], top - whole[1],
+                                              right - whole[0], bottom - whole[1]))
@@ -0,0 +1,328 @@
+"""
+Chunked, resumable media uploads to Twitter.
+
+Files go up with the INIT/APPEND/FINALIZE commands of the media upload
+endpoint, several APPEND segments at a time. Progress is recorded in a
+JSON cache keyed by the file's content, so a failed upload resumes from the
+segments that are still missing, and a file that was already uploaded
+reuses its media ID until Twitter expires it. Media that is over Twitter's
+size limit is re-encoded down a bitrate (or, for GIFs, size) ladder first.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import hashlib
+import logging
+import os
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, dirname, join, splitext
+
+import requests
+from twitter import TwitterError
+
+from common import get_api, load_json, save_json_atomic
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = dirname(abspath(__file__))
+MEDIA_CACHE = join(BASE_DIR, 'media_cache.json')
+
+MB = 1024 * 1024
+# Twitter allows segments of up to 5 MB.
+DEFAULT_CHUNK_SIZE = 1 * MB
+DEFAULT_WORKERS = 2
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+# Whole-upload attempts in post_media; each one resumes where the last
+# stopped.
+UPLOAD_ATTEMPTS = 2
+# How long to wait for Twitter to finish processing a video.
+PROCESSING_TIMEOUT = 600
+# Used when Twitter doesn't say how long an upload stays valid; cached media
+# IDs are dropped EXPIRY_MARGIN seconds before they run out.
+DEFAULT_EXPIRY = 24 * 3600
+EXPIRY_MARGIN = 600
+
+MEDIA_TYPES = {
+    '.gif': 'image/gif',
+    '.mp4': 'video/mp4',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+}
+
+# Limits by media category; without one, by media type. Videos only get
+# the 512 MB limit as 'tweet_video'.
+CATEGORY_LIMITS = {
+    'tweet_video': 512 * MB,
+    'tweet_gif': 15 * MB,
+    'tweet_image': 5 * MB,
+}
+SIZE_LIMITS = {
+    'image/gif': 15 * MB,
+    'video/mp4': 15 * MB,
+    'image/png': 5 * MB,
+    'image/jpeg': 5 * MB,
+}
+
+# Tried in order until the output fits: video bitrates, GIF widths.
+VIDEO_LADDER = ('2500k', '1500k', '1000k', '600k', '400k')
+GIF_LADDER = (400, 320, 240)
+
+
+class UploadError(Exception):
+    pass
+
+
+def media_type(path):
+    try:
+        return MEDIA_TYPES[splitext(path)[1].lower()]
+    except KeyError:
+        raise UploadError("Don't know how to upload {0}".format(path))
+
+
+def size_limit(path, media_category=None):
+    """Twitter's size limit in bytes for `path` uploaded as
+    `media_category`."""
+    if media_category in CATEGORY_LIMITS:
+        return CATEGORY_LIMITS[media_category]
+    return SIZE_LIMITS[media_type(path)]
+
+
+def _fit_cmd(path, out, step):
+    cmd = ['ffmpeg', '-y', '-loglevel', 'error', '-i', path]
+    if media_type(path) == 'image/gif':
+        cmd += ['-vf', ('scale={0}:-1:flags=lanczos,split[a][b];'
+                        '[a]palettegen[p];[b][p]paletteuse').format(step)]
+    else:
+        cmd += ['-c:v', 'libx264', '-b:v', step, '-maxrate', step,
+                '-bufsize', '{0}k'.format(2 * int(step.rstrip('k'))),
+                '-pix_fmt', 'yuv420p', '-an']
+    return cmd + [out]
+
+
+def fit_to_budget(path, budget=None, ladder=None, media_category=None):
+    """
+    Makes sure `path` is at most `budget` bytes (by default Twitter's limit
+    for it as `media_category`), re-encoding it one ladder step at a time
+    until it fits.
+
+    Returns:
+        str: `path` if it already fits, otherwise the path of a smaller
+            copy next to it, which the caller should remove.
+    """
+    mtype = media_type(path)
+    budget = budget or size_limit(path, media_category)
+    size = os.path.getsize(path)
+    if size <= budget:
+        return path
+
+    root, ext = splitext(path)
+    out = '{0}.fit{1}'.format(root, ext)
+    for step in ladder or (GIF_LADDER if mtype == 'image/gif' else VIDEO_LADDER):
+        cmd = _fit_cmd(path, out, step)
+        logger.debug("%s is %s bytes, over %s; trying %s", path, size, budget, step)
+        try:
+            returncode = subprocess.call(cmd)
+        except OSError:
+            raise UploadError("ffmpeg is needed to shrink {0}".format(path))
+        if returncode == 0 and os.path.getsize(out) <= budget:
+            logger.info("Re-encoded %s at %s: %s -> %s bytes", path, step, size,
+                        os.path.getsize(out))
+            return out
+    if os.path.exists(out):
+        os.remove(out)
+    raise UploadError("Couldn't get {0} under {1} bytes".format(path, budget))
+
+
+def file_digest(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(MB), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class MediaUploader(object):
+    """
+    Args:
+        api (twitter.Api, optional): defaults to common.get_api().
+        cache_file (str, optional): where upload progress and media IDs are
+            kept between runs.
+        chunk_size (int): bytes per APPEND segment.
+        workers (int): APPEND segments sent at once.
+        retries (int): attempts after the first for each request.
+        backoff (float): base delay in seconds, doubled on each retry.
+        clock, sleep (callable): for tests.
+    """
+
+    def __init__(self, api=None, cache_file=MEDIA_CACHE, chunk_size=DEFAULT_CHUNK_SIZE,
+                 workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 clock=time.time, sleep=time.sleep):
+        self.api = api or get_api()
+        self.cache_file = cache_file
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self.cache = self._load_cache()
+
+    @property
+    def url(self):
+        return '{0}/media/upload.json'.format(self.api.upload_url)
+
+    def _load_cache(self):
+        cache = load_json(self.cache_file, {})
+        now = self.clock()
+        return {key: entry for key, entry in cache.items() if entry['expires'] > now}
+
+    def _save_cache(self):
+        if not self.cache_file:
+            return
+        with self._lock:
+            save_json_atomic(self.cache_file, self.cache, indent=2, sort_keys=True)
+
+    def _request(self, verb, data):
+        """Sends one command to the upload endpoint, retrying failures with
+        exponential backoff. Returns the parsed response, or {} if it was
+        empty (as APPEND responses are)."""
+        attempt = 0
+        while True:
+            try:
+                resp = self.api._RequestUrl(self.url, verb, data=data)
+                body = resp.content.decode('utf-8')
+                if resp.status_code >= 400 and not body:
+                    raise TwitterError({'message': 'HTTP {0}'.format(resp.status_code)})
+                return self.api._ParseAndCheckTwitter(body) if body else {}
+            except (TwitterError, requests.RequestException):
+                if attempt >= self.retries:
+                    raise
+                logger.debug("%s %s failed, retrying", data.get('command'),
+                             data.get('media_id', ''), exc_info=True)
+            delay = self.backoff * (2 ** attempt)
+            self.sleep(delay + random.uniform(0, delay / 2))
+            attempt += 1
+
+    def _init(self, path, key, category):
+        data = {'command': 'INIT', 'media_type': media_type(path),
+                'total_bytes': os.path.getsize(path)}
+        if category:
+            data['media_category'] = category
+        resp = self._request('POST', data)
+        size = os.path.getsize(path)
+        entry = {
+            'media_id': resp['media_id_string'] if 'media_id_string' in resp
+            else str(resp['media_id']),
+            'segments': max((size + self.chunk_size - 1) // self.chunk_size, 1),
+            'chunk_size': self.chunk_size,
+            'done': [],
+            'finalized': False,
+            'expires': self.clock() + resp.get('expires_after_secs', DEFAULT_EXPIRY) -
+            EXPIRY_MARGIN,
+        }
+        with self._lock:
+            self.cache[key] = entry
+        self._save_cache()
+        return entry
+
+    def _append(self, path, entry, index):
+        with open(path, 'rb') as f:
+            f.seek(index * entry['chunk_size'])
+            chunk = f.read(entry['chunk_size'])
+        self._request('POST', {'command': 'APPEND', 'media_id': entry['media_id'],
+                               'segment_index': str(index), 'media': chunk})
+        with self._lock:
+            entry['done'].append(index)
+        self._save_cache()
+        return len(chunk)
+
+    def _wait_for_processing(self, entry, info):
+        deadline = self.clock() + PROCESSING_TIMEOUT
+        while info and info.get('state') in ('pending', 'in_progress'):
+            if self.clock() > deadline:
+                raise UploadError("Gave up waiting for {0} to be processed".format(
+                    entry['media_id']))
+            self.sleep(info.get('check_after_secs', 1))
+            info = self._request('GET', {'command': 'STATUS',
+                                         'media_id': entry['media_id']}).get('processing_info')
+        if info and info.get('state') == 'failed':
+            raise UploadError("Twitter failed to process {0}: {1}".format(
+                entry['media_id'], info.get('error')))
+
+    def upload(self, path, media_category=None):
+        """
+        Uploads `path`, resuming an earlier partial upload of the same
+        content, or returning its media ID straight away if it was already
+        uploaded and hasn't expired.
+
+        Returns:
+            str: the media ID.
+        """
+        key = '{0}:{1}'.format(file_digest(path), media_category or '')
+        entry = self.cache.get(key)
+        if entry and entry['expires'] <= self.clock():
+            entry = None
+        if entry and entry['finalized']:
+            logger.debug("Reusing media %s for %s", entry['media_id'], path)
+            return entry['media_id']
+        if entry is None:
+            entry = self._init(path, key, media_category)
+        else:
+            logger.info("Resuming upload of %s as media %s, %s of %s segments sent", path,
+                        entry['media_id'], len(entry['done']), entry['segments'])
+
+        todo = [i for i in range(entry['segments']) if i not in entry['done']]
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(self._append, path, entry, i) for i in todo]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            raise UploadError("{0} of {1} segments of {2} failed: {3}".format(
+                len(errors), entry['segments'], path, errors[0]))
+        logger.debug("Sent %s segments of %s in %.2fs", len(todo), path, time.time() - start)
+
+        resp = self._request('POST', {'command': 'FINALIZE', 'media_id': entry['media_id']})
+        try:
+            self._wait_for_processing(entry, resp.get('processing_info'))
+        except UploadError:
+            # The media ID is no use to anyone now; start afresh next time.
+            with self._lock:
+                self.cache.pop(key, None)
+            self._save_cache()
+            raise
+        entry['finalized'] = True
+        self._save_cache()
+        logger.info("Uploaded %s as media %s", path, entry['media_id'])
+        return entry['media_id']
+
+
+def post_media(status, path, media_category=None, api=None, uploader=None):
+    """
+    Posts `status` with `path` attached, shrinking the file first if it's
+    over Twitter's limit.
+
+    Returns:
+        twitter.Status
+    """
+    api = api or (uploader.api if uploader else get_api())
+    uploader = uploader or MediaUploader(api=api)
+    fitted = fit_to_budget(path, media_category=media_category)
+    try:
+        for attempt in range(UPLOAD_ATTEMPTS):
+            try:
+                media_id = uploader.upload(fitted, media_category=media_category)
+                break
+            except (UploadError, TwitterError, requests.RequestException):
+                if attempt + 1 >= UPLOAD_ATTEMPTS:
+                    raise
+                logger.warning("Upload of %s failed, resuming", fitted, exc_info=True)
+    finally:
+        if fitted != path:
+            os.remove(fitted)
+    return api.PostUpdate(status=status, media=int(media_id))
@@ -0,0 +1,75 @@
+"""
+Camera paths across the full disk for animations that pan or zoom, and a
+renderer that draws them from the tile pyramid.
+
+A path is a list of boxes (left, top, right, bottom) in full size px, one
+per output frame. Each box is read with tiles.read_view, so a frame only
+decodes the tiles it overlaps, at the smallest pyramid level that still
+fills the output.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import tiles
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = (720, 720)
+DEFAULT_WORKERS = 4
+
+
+def centered_box(center, width, aspect=1.0):
+    """Returns the box `width` px wide (and `width` / `aspect` high) around
+    `center` (x, y)."""
+    x, y = center
+    height = width / aspect
+    return (x - width / 2.0, y - height / 2.0, x + width / 2.0, y + height / 2.0)
+
+
+def _steps(steps):
+    return [i / float(steps - 1) if steps > 1 else 1.0 for i in range(steps)]
+
+
+def zoom_path(center, start_width, end_width, steps, aspect=1.0):
+    """
+    Zooms from a `start_width` wide view of `center` to an `end_width` wide
+    one. The width changes by the same ratio every frame, so the zoom looks
+    steady rather than slowing down as it closes in.
+    """
+    return [centered_box(center, start_width * (end_width / float(start_width)) ** t, aspect)
+            for t in _steps(steps)]
+
+
+def pan_path(start, end, width, steps, aspect=1.0):
+    """Pans a `width` wide view in a straight line from center `start` to
+    center `end`."""
+    return [centered_box((start[0] + (end[0] - start[0]) * t, start[1] + (end[1] - start[1]) * t),
+                         width, aspect)
+            for t in _steps(steps)]
+
+
+def render_path(frames, boxes, size=DEFAULT_SIZE, workers=DEFAULT_WORKERS, stats=None):
+    """
+    Yields one image of `size` per box, in order. Frames are spread evenly
+    over the path, so each is held for several boxes if there are more
+    boxes than frames. At most `workers` * 2 images are held at once.
+
+    Args:
+        frames (list): full disk frame paths, oldest first.
+        boxes (list): the path, e.g. from zoom_path or pan_path.
+        size (tuple): output size.
+        workers (int): frames rendered in parallel.
+        stats (tiles.DecodeStats, optional): updated with the tile decodes.
+    """
+    def render(i):
+        frame = frames[i * len(frames) // len(boxes)]
+        return tiles.read_view(frame, boxes[i], size, stats=stats)
+
+    batch = workers * 2
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(boxes), batch):
+            for im in pool.map(render, range(start, min(start + batch, len(boxes)))):
+                yield im